@@ -23,6 +23,9 @@ data = dict(
     height=None,                  # enforce image height
     llffhold=8,                   # testsplit
     load_depths=False,            # load depth
+    cache_dir=None,               # keep the decoded blender images here (float16, memory-mapped), None to disable.
+                                  # Cached runs train on float16-rounded targets, not bit-identical to uncached runs
+    load_workers=None,            # threads decoding the blender/llff images, None for min(8, #cpus), 0 to decode serially
 )
 
 data_static = deepcopy(data)
@@ -45,6 +48,10 @@ fine_train = dict(
     lrdecay_scale=1e-1,                             # the lrate decay scale for the final fine stage
     pervoxel_lr=False,                              # view-count-based lr
     ray_sampler='sequential_1im_fixed',             # ray sampling strategies
+    ray_dirs_dtype='float32',                       # dtype of the stored ray directions, float16 halves them (not bit-exact)
+    rays_on_the_fly=False,                          # store only the images and cameras and compute the rays of each batch
+    prefetch_batches=4,                             # batches assembled ahead on a background thread, 0 to draw them in the loop
+    amp=None,                                       # None | 'float16' | 'bfloat16', autocast the MLPs and convolutions (bfloat16 on CPU)
     weight_main=1.0,                                # weight of photometric loss
     weight_entropy_last=0.01,                       # weight of background entropy loss
     weight_rgbper=0.1,                              # weight of per-point rgb loss
@@ -92,6 +99,9 @@ fine_model_and_render = dict(
     num_iterations=3,                               #iterations number in slot attention
     kernel_size=5,
     stride=2,
+    sparse_encoder=False,                           # run the slot attention encoder on the occupied voxels only
+    attention_chunk=0,                              # voxels per chunk of the slot attention (0 for the full attention)
+    attention_checkpoint=False,                     # recompute the keys/values of each chunk in backward
 
     init_weight='default',
     init_bias='default',
@@ -105,9 +115,23 @@ fine_model_and_render = dict(
     rgbnet_width=128,                               # width of the colors MLP
     alpha_init=1e-2,                                # set the alpha values everywhere at the begin of training
     fast_color_thres=1e-4,                          # threshold of alpha value to skip the fine stage sampled point
+    fused_decoder=False,                            # cached sin/cos embeddings and one MLP graph in the decoder
+    compile_decoder=None,                           # None | 'script' | 'compile', TorchScript or torch.compile the fused decoder MLP
+    factored_decoder=False,                         # run the decoder layers fed by the points/slots/views once per point/slot/ray, not per slot and point
+    prune_slots_topk=0,                             # decode the colour of the top-k slots of each point only (0 for all)
+    prune_slots_thres=0.,                           # decode the colour of the slots above this mass at each point only (0 for all)
+    occupancy_grid=False,                           # skip the samples in free space with a coarse occupancy grid (approximate under large deformations)
+    occupancy_downrate=4,                           # number of voxels per occupancy cell along each axis
+    occupancy_every=256,                            # rebuild the occupancy grids of all the frames every N steps
+    deform_cache=False,                             # bake dx of the time net on the voxel grid for the training timesteps
+    deform_cache_every=300,                         # re-bake the dx of a timestep every N steps
+    density_cache=False,                            # memoize the warped density and slot encoder features per timestep
+    density_cache_every=300,                        # re-warp the density of a timestep every N steps
+    density_cache_size=64,                          # max number of timesteps and rendered views kept in the density cache (LRU)
     maskout_near_cam_vox=False,                     # maskout grid points that between cameras and their near planes
     world_motion_bound_scale=1.0,                   # rescale the Motion BBox enclosing the scene
     stepsize=0.5,                                   # sampling stepsize in volume rendering
+    segment_steps=32,                               # steps per marching segment for early ray termination at inference (0 to disable)
 )
 
 del deepcopy
@@ -0,0 +1,88 @@
+'''Lazy loading of the custom CUDA extensions.
+Extensions are only built on first use, into a persistent cache keyed by the hash of
+their sources, the torch/CUDA versions and the target GPU archs. warmup/ and
+dynamic_grounding/ carry identical lib/cuda sources, so both stages hit the same build.
+Populate the cache ahead of time with:
+    python -m lib.cuda_ext --prebuild-extensions
+'''
+import os
+import hashlib
+import argparse
+import functools
+
+import torch
+from torch.utils.cpp_extension import load, CUDA_HOME
+
+
+parent_dir = os.path.dirname(os.path.abspath(__file__))
+EXTENSIONS = {
+    'render_utils_cuda': ['cuda/render_utils.cpp', 'cuda/render_utils_kernel.cu'],
+    'total_variation_cuda': ['cuda/total_variation.cpp', 'cuda/total_variation_kernel.cu'],
+    'adam_upd_cuda': ['cuda/adam_upd.cpp', 'cuda/adam_upd_kernel.cu'],
+}
+
+
+def cuda_available():
+    return torch.cuda.is_available() and CUDA_HOME is not None
+
+
+def cache_root():
+    default = os.path.join(os.path.expanduser('~'), '.cache', 'dynavol', 'torch_extensions')
+    return os.environ.get('DYNAVOL_EXTENSIONS_DIR', default)
+
+
+def source_hash(name):
+    h = hashlib.sha1()
+    h.update(torch.__version__.encode())
+    h.update(str(torch.version.cuda).encode())
+    # the build targets the archs of TORCH_CUDA_ARCH_LIST, or else of the visible GPU
+    h.update(os.environ.get('TORCH_CUDA_ARCH_LIST', '').encode())
+    if torch.cuda.is_available():
+        h.update(str(torch.cuda.get_device_capability()).encode())
+    for path in EXTENSIONS[name]:
+        with open(os.path.join(parent_dir, path), 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()[:16]
+
+
+@functools.lru_cache(maxsize=None)
+def get_extension(name):
+    '''Return the compiled extension, or the pure-PyTorch backend without CUDA.'''
+    if not cuda_available():
+        print(f'cuda_ext: {name} unavailable, fall back to the PyTorch backend')
+        from . import torch_backend
+        return torch_backend
+    build_dir = os.path.join(cache_root(), f'{name}_{source_hash(name)}')
+    os.makedirs(build_dir, exist_ok=True)
+    return load(
+            name=name,
+            sources=[os.path.join(parent_dir, path) for path in EXTENSIONS[name]],
+            build_directory=build_dir,
+            verbose=False)
+
+
+class LazyExtension:
+    '''Module-like proxy which loads the extension on the first attribute access.'''
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(get_extension(self._name), attr)
+
+
+def prebuild_extensions():
+    if not cuda_available():
+        print('cuda_ext: CUDA toolkit not found, nothing to build')
+        return
+    for name in EXTENSIONS:
+        get_extension(name)
+        print(f'cuda_ext: {name} cached in {cache_root()}')
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--prebuild-extensions', action='store_true',
+                        help='compile all the CUDA extensions into the shared cache and exit')
+    args = parser.parse_args()
+    if args.prebuild_extensions:
+        prebuild_extensions()
@@ -5,6 +5,8 @@ import imageio
 import json
 import cv2
 
+from .load_images import load_images
+
 
 trans_t = lambda t : torch.Tensor([
     [1,0,0,0],
@@ -41,7 +43,7 @@ def resize_flow(flow, H_new, W_new):
     return flow_resized
 
 
-def load_blender_data(basedir, half_res=False, testskip=1):
+def load_blender_data(basedir, half_res=False, testskip=1, num_workers=None):
     splits = ['train', 'val', 'test']
     metas = {}
     for s in splits:
@@ -55,7 +57,9 @@ def load_blender_data(basedir, half_res=False, testskip=1):
     for s in splits:
         meta = metas[s]
 
-        imgs = []
+        imgs = load_images(
+                [os.path.join(basedir, frame['file_path'] + '.png') for frame in meta['frames'][::testskip]],
+                num_workers=num_workers)
         poses = []
         times = []
 
@@ -66,9 +70,7 @@ def load_blender_data(basedir, half_res=False, testskip=1):
         skip = testskip
     
         for t, frame in enumerate(meta['frames'][::skip]):
-            fname = os.path.join(basedir, frame['file_path'] + '.png')
-            imgs.append(imageio.imread(fname))
-            H, W = imageio.imread(fname).shape[:2]
+            H, W = imgs[t].shape[:2]
             if half_res:
                 H = H // 2
                 W = W // 2
@@ -135,7 +137,7 @@ def load_blender_data(basedir, half_res=False, testskip=1):
     return imgs, poses, times, render_poses, render_times, [H, W, focal], i_split, flows_b, flow_masks_b
 
 
-def load_blender_data_woflow(basedir, half_res=False, testskip=1):
+def load_blender_data_woflow(basedir, half_res=False, testskip=1, num_workers=None):
     splits = ['train', 'val', 'test']
     metas = {}
     for s in splits:
@@ -149,7 +151,9 @@ def load_blender_data_woflow(basedir, half_res=False, testskip=1):
     for s in splits:
         meta = metas[s]
 
-        imgs = []
+        imgs = load_images(
+                [os.path.join(basedir, frame['file_path'] + '.png') for frame in meta['frames'][::testskip]],
+                num_workers=num_workers)
         poses = []
         times = []
 
@@ -160,9 +164,7 @@ def load_blender_data_woflow(basedir, half_res=False, testskip=1):
         skip = testskip
     
         for t, frame in enumerate(meta['frames'][::skip]):
-            fname = os.path.join(basedir, frame['file_path'] + '.png')
-            imgs.append(imageio.imread(fname))
-            H, W = imageio.imread(fname).shape[:2]
+            H, W = imgs[t].shape[:2]
             if half_res:
                 H = H // 2
                 W = W // 2
@@ -3,6 +3,8 @@ import os, imageio
 import torch
 import cv2
 
+from .load_images import load_images
+
 import pdb
 
 ########## Slightly modified version of LLFF data loading code
@@ -90,7 +92,7 @@ def _minify(basedir, factors=[], resolutions=[]):
         print('Done')
 
 
-def _load_data(basedir, factor=None, width=None, height=None, load_imgs=True, load_depths=False):     # v1: load poses from static processed poses
+def _load_data(basedir, factor=None, width=None, height=None, load_imgs=True, load_depths=False, num_workers=None):     # v1: load poses from static processed poses
 
     poses = np.load(os.path.join(basedir, 'poses.npy'))
     bds = np.load(os.path.join(basedir, 'bds.npy'))
@@ -148,7 +150,7 @@ def _load_data(basedir, factor=None, width=None, height=None, load_imgs=True, lo
             return            
 
         imgfiles = [os.path.join(imgdir, f) for f in sorted(os.listdir(imgdir)) if f.endswith('JPG') or f.endswith('jpg') or f.endswith('png')]
-        imgs = [imread(f)[...,:4]/255. for f in imgfiles]
+        imgs = load_images(imgfiles, reader=lambda f: imread(f)[...,:4]/255., num_workers=num_workers)
         all_imgs[idx] = imgs
         all_poses[idx] = [pose] * imgs_perview
         all_bds[idx] = [bds[-(num_views-i+1), ...]] * imgs_perview
@@ -315,10 +317,10 @@ def spherify_poses(poses, bds, depths):
 
 
 def load_llff_data(basedir, factor=8, width=None, height=None,
-                   recenter=True, bd_factor=.75, spherify=False, path_zflat=False, load_depths=False):
+                   recenter=True, bd_factor=.75, spherify=False, path_zflat=False, load_depths=False, num_workers=None):
 
     poses, bds, imgs, times, flows_b, flow_masks_b, *depths = _load_data(basedir, factor=factor, width=width, height=height,
-                                           load_depths=load_depths)
+                                           load_depths=load_depths, num_workers=num_workers)
     print('Loaded', basedir, bds.min(), bds.max())
     if load_depths:
         depths = depths[0]
@@ -0,0 +1,187 @@
+'''Pure-PyTorch implementation of the custom CUDA extensions.
+It mirrors the interface of render_utils_cuda, total_variation_cuda and adam_upd_cuda
+so it can be used as a drop-in replacement when CUDA or nvcc is unavailable.
+All the ops are vectorized and run on any device.
+'''
+import math
+
+import torch
+
+
+''' Points sampling
+'''
+def infer_t_minmax(rays_o, rays_d, xyz_min, xyz_max, near, far):
+    vec = torch.where(rays_d==0, torch.full_like(rays_d, 1e-6), rays_d)
+    rate_a = (xyz_max - rays_o) / vec
+    rate_b = (xyz_min - rays_o) / vec
+    t_min = torch.minimum(rate_a, rate_b).amax(-1).clamp(max=far).clamp(min=near)
+    t_max = torch.maximum(rate_a, rate_b).amin(-1).clamp(max=far).clamp(min=near)
+    return [t_min, t_max]
+
+
+def infer_n_samples(t_min, t_max, stepdist):
+    # at least 1 point for easier implementation in the later sample_pts_on_rays
+    return ((t_max - t_min) / stepdist).ceil().clamp(min=1).long()
+
+
+def infer_ray_start_dir(rays_o, rays_d, t_min):
+    rays_start = rays_o + rays_d * t_min[:,None]
+    rays_dir = rays_d / rays_d.norm(dim=-1, keepdim=True)
+    return [rays_start, rays_dir]
+
+
+def sample_pts_on_rays(rays_o, rays_d, xyz_min, xyz_max, near, far, stepdist):
+    n_rays = rays_o.shape[0]
+    device = rays_o.device
+
+    # Compute ray-bbox intersection
+    t_min, t_max = infer_t_minmax(rays_o, rays_d, xyz_min, xyz_max, near, far)
+
+    # Compute the number of points required.
+    # Assign ray index and step index to each.
+    N_steps = infer_n_samples(t_min, t_max, stepdist)
+    N_steps_cumsum = N_steps.cumsum(0)
+    ray_id = torch.repeat_interleave(torch.arange(n_rays, device=device), N_steps)
+    step_id = torch.arange(len(ray_id), device=device) - (N_steps_cumsum - N_steps)[ray_id]
+
+    # Compute the global xyz of each point
+    rays_start, rays_dir = infer_ray_start_dir(rays_o, rays_d, t_min)
+    dist = stepdist * step_id.to(rays_o.dtype)
+    rays_pts = rays_start[ray_id] + rays_dir[ray_id] * dist[:,None]
+    mask_outbbox = ((xyz_min > rays_pts) | (xyz_max < rays_pts)).any(-1)
+    return [rays_pts, mask_outbbox, ray_id, step_id, N_steps, t_min, t_max]
+
+
+''' MaskCache lookup to skip known freespace.
+'''
+def maskcache_lookup(world, xyz, xyz2ijk_scale, xyz2ijk_shift):
+    ijk = xyz * xyz2ijk_scale + xyz2ijk_shift
+    # round half away from zero as the CUDA round() does
+    ijk = (ijk.sign() * (ijk.abs() + 0.5).floor()).long()
+    size = torch.tensor(world.shape, device=ijk.device)
+    inside = ((ijk >= 0) & (ijk < size)).all(-1)
+    out = torch.zeros([xyz.shape[0]], dtype=torch.bool, device=xyz.device)
+    i, j, k = ijk[inside].unbind(-1)
+    out[inside] = world[i, j, k]
+    return out
+
+
+''' Ray marching helper function.
+'''
+def raw2alpha(density, shift, interval):
+    exp_d = torch.exp(density + shift)  # can be inf
+    alpha = 1 - (1 + exp_d).pow(-interval)
+    return [exp_d, alpha]
+
+
+def raw2alpha_backward(exp_d, grad_back, interval):
+    return exp_d.clamp(max=1e10) * (1 + exp_d).pow(-interval - 1) * interval * grad_back
+
+
+def _segment_bounds(ray_id, n_rays):
+    '''Start/end index of each ray segment and the position of each point in its segment.
+    Points must be sorted by ray_id, as returned by sample_pts_on_rays.
+    '''
+    count = torch.bincount(ray_id, minlength=n_rays)
+    i_end = count.cumsum(0)
+    i_start = i_end - count
+    pos = torch.arange(len(ray_id), device=ray_id.device) - i_start[ray_id]
+    return i_start, i_end, count, pos
+
+
+def alpha2weight(alpha, ray_id, n_rays):
+    n_pts = alpha.shape[0]
+    device = alpha.device
+
+    weight = torch.zeros_like(alpha)
+    T = torch.ones_like(alpha)
+    alphainv_last = torch.ones([n_rays], dtype=alpha.dtype, device=device)
+    i_start = torch.zeros([n_rays], dtype=torch.long, device=device)
+    i_end = torch.zeros([n_rays], dtype=torch.long, device=device)
+    if n_pts == 0:
+        return [weight, T, alphainv_last, i_start, i_end]
+
+    seg_start, seg_end, count, pos = _segment_bounds(ray_id, n_rays)
+    hit = count > 0
+    i_start[hit] = seg_start[hit]
+
+    # accumulated transmittance in a padded [n_rays, max_steps] layout
+    trans = torch.ones([n_rays, int(count.max())], dtype=alpha.dtype, device=device)
+    trans[ray_id, pos] = 1 - alpha
+    T_incl = trans.cumprod(-1)
+    T_excl = torch.cat([torch.ones_like(T_incl[:,:1]), T_incl[:,:-1]], -1)
+
+    # a ray stops marching right after its transmittance drops below 1e-3
+    T_pts = T_excl[ray_id, pos]
+    active = T_pts >= 1e-3
+    weight[active] = (T_pts * alpha)[active]
+    T[active] = T_pts[active]
+
+    n_active = torch.zeros([n_rays], dtype=torch.long, device=device).index_add_(0, ray_id, active.long())
+    i_end[hit] = i_start[hit] + n_active[hit]
+    alphainv_last[hit] = T_incl[hit, n_active[hit]-1]
+    return [weight, T, alphainv_last, i_start, i_end]
+
+
+def alpha2weight_backward(alpha, weight, T, alphainv_last, i_start, i_end, n_rays, grad_weights, grad_last):
+    grad = torch.zeros_like(alpha)
+    if n_rays == 0 or alpha.shape[0] == 0:
+        return grad
+
+    device = alpha.device
+    n_active = i_end - i_start
+    ray_id = torch.repeat_interleave(torch.arange(n_rays, device=device), n_active)
+    pos = torch.arange(len(ray_id), device=device) - (n_active.cumsum(0) - n_active)[ray_id]
+    idx = i_start[ray_id] + pos
+
+    # accumulate the gradient from the far end of each ray
+    back = torch.zeros([n_rays, max(int(n_active.max()), 1)], dtype=alpha.dtype, device=device)
+    back[ray_id, pos] = grad_weights[idx] * weight[idx]
+    back_cum = back.flip(-1).cumsum(-1).flip(-1) - back
+    back_cum = back_cum + (grad_last * alphainv_last)[:,None]
+    grad[idx] = grad_weights[idx] * T[idx] - back_cum[ray_id, pos] / (1 - alpha[idx] + 1e-10)
+    return grad
+
+
+''' Total variation
+'''
+def total_variation_add_grad(param, grad, wx, wy, wz, dense_mode):
+    wx, wy, wz = wx / 6, wy / 6, wz / 6
+    grad_to_add = torch.zeros_like(param)
+    # the CUDA kernel weights the first spatial axis with wz as well
+    for dim, w in zip([2, 3, 4], [wz, wy, wz]):
+        n = param.shape[dim]
+        diff = (param.narrow(dim, 1, n-1) - param.narrow(dim, 0, n-1)).clamp(-1, 1)
+        grad_to_add.narrow(dim, 1, n-1).add_(w * diff)
+        grad_to_add.narrow(dim, 0, n-1).sub_(w * diff)
+    if not dense_mode:
+        grad_to_add = grad_to_add * (grad != 0)
+    grad.add_(grad_to_add)
+
+
+''' Adam updates
+'''
+def _adam_step_size(step, beta1, beta2, lr):
+    return lr * math.sqrt(1 - beta2 ** step) / (1 - beta1 ** step)
+
+
+def adam_upd(param, grad, exp_avg, exp_avg_sq, step, beta1, beta2, lr, eps):
+    step_size = _adam_step_size(step, beta1, beta2, lr)
+    exp_avg.mul_(beta1).add_(grad, alpha=1-beta1)
+    exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1-beta2)
+    param.addcdiv_(exp_avg, exp_avg_sq.sqrt().add_(eps), value=-step_size)
+
+
+def masked_adam_upd(param, grad, exp_avg, exp_avg_sq, step, beta1, beta2, lr, eps):
+    step_size = _adam_step_size(step, beta1, beta2, lr)
+    mask = grad != 0
+    exp_avg.copy_(torch.where(mask, beta1 * exp_avg + (1-beta1) * grad, exp_avg))
+    exp_avg_sq.copy_(torch.where(mask, beta2 * exp_avg_sq + (1-beta2) * grad * grad, exp_avg_sq))
+    param.sub_(mask * step_size * exp_avg / (exp_avg_sq.sqrt() + eps))
+
+
+def adam_upd_with_perlr(param, grad, exp_avg, exp_avg_sq, perlr, step, beta1, beta2, lr, eps):
+    step_size = _adam_step_size(step, beta1, beta2, lr)
+    exp_avg.mul_(beta1).add_(grad, alpha=1-beta1)
+    exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1-beta2)
+    param.sub_(step_size * perlr * exp_avg / (exp_avg_sq.sqrt() + eps))
@@ -1,4 +1,4 @@
-import os, math
+import os, math, time, queue, threading
 import numpy as np
 import scipy.signal
 from typing import List, Optional
@@ -9,7 +9,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 from .masked_adam import MaskedAdam
 
-import lib_extra.metrics_jax as metrics_jax 
+import lib_extra.metrics as metrics
 import matplotlib.pyplot as plt
 from skimage.color import label2rgb
 import cv2
@@ -26,6 +26,114 @@ mse2psnr = lambda x : -10. * torch.log10(x)
 to8b = lambda x : (255*np.clip(x,0,1)).astype(np.uint8)
 
 
+class RenderWriter:
+    '''Write the rendered frames as they come, to PNGs and to the rgb/depth videos.
+    The depth maps are normalized by their max over the whole sequence, so they are
+    spilled to a memory-mapped file and written out on close().
+    '''
+    def __init__(self, savedir, n_frames, video_name='video', fps=10, depth_png=True):
+        self.savedir = savedir
+        self.n_frames = n_frames
+        self.video_name = video_name
+        self.fps = fps
+        self.depth_png = depth_png
+        self.rgb_video = None
+        self.depths = None
+        self.depth_max = -np.inf
+
+    def append(self, i, rgb, depth):
+        rgb8 = to8b(rgb)
+        imageio.imwrite(os.path.join(self.savedir, '{:03d}.png'.format(i)), rgb8)
+        if self.rgb_video is None:
+            self.rgb_video = imageio.get_writer(
+                    os.path.join(self.savedir, f'{self.video_name}.rgb.mp4'), fps=self.fps, quality=8)
+            self.depths = np.lib.format.open_memmap(
+                    os.path.join(self.savedir, f'{self.video_name}.depth.npy'), mode='w+',
+                    dtype=np.float32, shape=(self.n_frames, *depth.shape))
+        self.rgb_video.append_data(rgb8)
+        self.depths[i] = depth
+        self.depth_max = max(self.depth_max, float(depth.max()))
+
+    def close(self):
+        if self.rgb_video is None:
+            return
+        self.rgb_video.close()
+        if self.depth_png:
+            os.makedirs(os.path.join(self.savedir, 'depth'), exist_ok=True)
+        depth_video = imageio.get_writer(
+                os.path.join(self.savedir, f'{self.video_name}.depth.mp4'), fps=self.fps, quality=8)
+        for i in range(self.n_frames):
+            depth8 = to8b(1 - self.depths[i] / self.depth_max)
+            if self.depth_png:
+                imageio.imwrite(os.path.join(self.savedir, 'depth', '{:03d}.png'.format(i)), depth8)
+            depth_video.append_data(depth8)
+        depth_video.close()
+        path = self.depths.filename
+        self.rgb_video = self.depths = None
+        os.remove(path)
+
+
+class AsyncWriter:
+    '''Run the frame writers on background threads while the next frame renders.
+    Jobs of the same stream run in submission order on one thread, each stream queue
+    is bounded so a slow disk throttles rendering instead of piling frames up in memory.
+    '''
+    def __init__(self, max_queue=8, enabled=True):
+        self.max_queue = max_queue
+        self.enabled = enabled
+        self.streams = {}
+        self.errors = []
+        self.busy = 0.
+        self.waited = 0.
+        self.lock = threading.Lock()
+
+    def submit(self, stream, fn, *args):
+        if not self.enabled:
+            self._run(fn, args)
+            return
+        if stream not in self.streams:
+            jobs = queue.Queue(self.max_queue)
+            worker = threading.Thread(target=self._work, args=(jobs,), daemon=True)
+            worker.start()
+            self.streams[stream] = (jobs, worker)
+        t0 = time.time()
+        self.streams[stream][0].put((fn, args))
+        self.waited += time.time() - t0
+
+    def _run(self, fn, args):
+        t0 = time.time()
+        try:
+            fn(*args)
+        except Exception as e:
+            self.errors.append(e)
+        with self.lock:
+            self.busy += time.time() - t0
+
+    def _work(self, jobs):
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            self._run(*job)
+
+    def close(self):
+        '''Wait for every submitted job. Returns the time the writers were busy and the
+        time the caller was blocked on them (both equal when disabled).
+        '''
+        t0 = time.time()
+        for jobs, worker in self.streams.values():
+            jobs.put(None)
+        for jobs, worker in self.streams.values():
+            worker.join()
+        self.waited += time.time() - t0
+        self.streams = {}
+        if self.errors:
+            raise self.errors[0]
+        if not self.enabled:
+            self.waited = self.busy
+        return self.busy, self.waited
+
+
 def create_optimizer_or_freeze_model(model, cfg_train, global_step):
     decay_steps = cfg_train.lrate_decay * 1000
     decay_factor = 0.1 ** (global_step/decay_steps)
@@ -56,10 +164,22 @@ def create_optimizer_or_freeze_model(model, cfg_train, global_step):
     return MaskedAdam(param_group)
 
 
+def create_amp(cfg_train, device):
+    '''Autocast dtype (None for fp32) and gradient scaler of the cfg_train.amp mixed precision mode.'''
+    amp = cfg_train.get('amp', None)
+    if amp not in [None, 'float16', 'bfloat16']:
+        raise ValueError(f"amp must be None, 'float16' or 'bfloat16', got {amp!r}")
+    if amp == 'float16' and device.type != 'cuda':
+        raise ValueError("float16 autocast needs a GPU, use amp='bfloat16' on CPU")
+    # bfloat16 has the range of fp32 and needs no loss scaling
+    scaler = torch.amp.GradScaler('cuda', enabled=(amp == 'float16'))
+    return (getattr(torch, amp) if amp else None), scaler
+
+
 
 
 def load_model_ours(model_class, ckpt_path):
-    ckpt = torch.load(ckpt_path)
+    ckpt = torch.load(ckpt_path, map_location=None if torch.cuda.is_available() else 'cpu')
     model = model_class(**ckpt['model_kwargs'])
     model.load_state_dict(ckpt['model_state_dict'], strict=False)
     return model
@@ -67,7 +187,7 @@ def load_model_ours(model_class, ckpt_path):
 
 def load_pretrained_model_whole_hyper(model_class, num_voxels_motion, timesteps, warp_ray, ckpt_path, world_motion_bound_scale, kwargs):
     # TODO ndc condition
-    ckpt = torch.load(ckpt_path)
+    ckpt = torch.load(ckpt_path, map_location=None if torch.cuda.is_available() else 'cpu')
     kwargs['xyz_min'] = ckpt['model_kwargs']['xyz_min']
     kwargs['xyz_max'] = ckpt['model_kwargs']['xyz_max']
     model = model_class(num_voxels_motion=num_voxels_motion, timesteps=timesteps, warp_ray=warp_ray, world_motion_bound_scale=world_motion_bound_scale, **kwargs)
@@ -81,7 +201,7 @@ def load_pretrained_model_whole_hyper(model_class, num_voxels_motion, timesteps,
 
 def load_pretrained_model_whole(model_class, num_voxels_motion, timesteps, warp_ray, ckpt_path, world_motion_bound_scale, kwargs):
     # TODO ndc condition
-    ckpt = torch.load(ckpt_path)
+    ckpt = torch.load(ckpt_path, map_location=None if torch.cuda.is_available() else 'cpu')
     kwargs['xyz_min'] = ckpt['model_kwargs']['xyz_min']
     kwargs['xyz_max'] = ckpt['model_kwargs']['xyz_max']
     # pdb.set_trace()
@@ -167,27 +287,15 @@ class ARI(nn.Module):
   """ARI."""
 
   def forward(self, pr_seg, gt_seg):
-    input_pad =np.ones(pr_seg.shape).astype(np.int64)
+    #pr_seg, gt_seg: [bs, seq_len, H, W]
     gt_instance = gt_seg.max()+1
     pr_instance = pr_seg.max()+1
-    
 
-    
-    ari_bg =  metrics_jax.Ari.from_model_output(
-      predicted_segmentations=pr_seg, ground_truth_segmentations=gt_seg,
-      padding_mask=input_pad,
-      ground_truth_max_num_instances=gt_instance,
-      predicted_max_num_instances=pr_instance,
-      ignore_background=False)
-    
-    ari_nobg =  metrics_jax.Ari.from_model_output(
-      predicted_segmentations=pr_seg, ground_truth_segmentations=gt_seg,
-      padding_mask=input_pad, 
-      ground_truth_max_num_instances=gt_instance,
-      predicted_max_num_instances=pr_instance,
-      ignore_background=True)
-    
-    return ari_bg, ari_nobg
+    table = metrics.contingency_table(gt_seg, pr_seg, gt_instance, pr_instance)
+    ari_bg = metrics.ari_from_contingency(table)
+    ari_nobg = metrics.ari_from_contingency(table, ignore_background=True)
+
+    return {'total': ari_bg.sum(), 'count': len(ari_bg)}, {'total': ari_nobg.sum(), 'count': len(ari_nobg)}
 
 def plot_image(ax, img, label=None):
 		ax.imshow(img)
@@ -205,40 +313,33 @@ def vis_seg(vid, pr_masks, gt_masks, savedir): # [seq, H, W]
     vid: (L, H, W, C)
     gt_mask: (L, H, W, C)
     '''
+    for i in range(len(vid)):
+        vis_seg_frame(i, vid[i], pr_masks[i], gt_masks[i], savedir)
 
-    # pdb.set_trace()
-    seg_pre_array = []
+def vis_seg_frame(i, vid, pr_mask, gt_mask, savedir): # [H, W]
+    '''
+    args:
+    vid: (H, W, C)
+    gt_mask: (H, W, C)
+    '''
     savedir = os.path.join(savedir, 'seg')
-    os.makedirs(savedir, exist_ok=True)
+    seperate_save_dir = os.path.join(savedir, 'seperate')
+    os.makedirs(seperate_save_dir, exist_ok=True)
 
-    T = len(vid)
+    plt.close()
+    fig, ax = plt.subplots(1, 3, dpi=400)
 
-    for i in range(T):
-        plt.close()
-        fig, ax = plt.subplots(1, 3, dpi=400)
+    vidgrey = cv2.cvtColor(vid, cv2.COLOR_RGB2GRAY)[...,None]
+    gt_seg = label2rgb(gt_mask, vidgrey)
+    pred_seg = label2rgb(pr_mask, vidgrey)
 
-        # for t in range(T):
-        # pdb.set_trace()
-        vidgrey = cv2.cvtColor(vid[i], cv2.COLOR_RGB2GRAY)[...,None]
-        gt_seg = label2rgb(gt_masks[i], vidgrey)
-        pred_seg = label2rgb(pr_masks[i], vidgrey)
+    plot_image(ax[0], vid, 'original')
+    plot_image(ax[1], gt_seg[:,:,0,:], 'gt_seg')
+    plot_image(ax[2], pred_seg[:,:,0,:], 'pred_seg')
 
-        plot_image(ax[0], vid[i], 'original')
-        plot_image(ax[1], gt_seg[:,:,0,:], 'gt_seg')
-        plot_image(ax[2], pred_seg[:,:,0,:], 'pred_seg')
+    plt.savefig(os.path.join(savedir, str(i).zfill(3)+'.png'))
 
-        plt.savefig(os.path.join(savedir, str(i).zfill(3)+'.png'))
-
-        seperate_save_dir = os.path.join(savedir, 'seperate')
-        os.makedirs(seperate_save_dir, exist_ok=True)
-
-        # pdb.set_trace()
-        cv2.imwrite(os.path.join(seperate_save_dir, str(i).zfill(3)+'_gt_seg.png'), (gt_seg[:, :, 0, :]*255))
-        cv2.imwrite(os.path.join(seperate_save_dir, str(i).zfill(3)+'_pred_seg.png'), (pred_seg[:, :, 0, :]*255))
-        seg_pre_array.append(pred_seg[:, :, 0, :]*255)
-
-    # pdb.set_trace()
-    #seg_pre_array = np.array(seg_pre_array)
-    #imageio.mimwrite(os.path.join(savedir, 'seg.mp4'), seg_pre_array, fps=10, quality=8)
+    cv2.imwrite(os.path.join(seperate_save_dir, str(i).zfill(3)+'_gt_seg.png'), (gt_seg[:, :, 0, :]*255))
+    cv2.imwrite(os.path.join(seperate_save_dir, str(i).zfill(3)+'_pred_seg.png'), (pred_seg[:, :, 0, :]*255))
         
         
@@ -1,6 +1,10 @@
 import os
 import time
+import queue
+import threading
 import functools
+import collections
+import contextlib
 import numpy as np
 
 import torch
@@ -10,21 +14,9 @@ from torch.nn import init
 
 from torch_scatter import segment_coo
 
-from torch.utils.cpp_extension import load
-parent_dir = os.path.dirname(os.path.abspath(__file__))
-render_utils_cuda = load(
-        name='render_utils_cuda',
-        sources=[
-            os.path.join(parent_dir, path)
-            for path in ['cuda/render_utils.cpp', 'cuda/render_utils_kernel.cu']],
-        verbose=True)
-
-total_variation_cuda = load(
-        name='total_variation_cuda',
-        sources=[
-            os.path.join(parent_dir, path)
-            for path in ['cuda/total_variation.cpp', 'cuda/total_variation_kernel.cu']],
-        verbose=True)
+from lib.cuda_ext import LazyExtension
+render_utils_cuda = LazyExtension('render_utils_cuda')
+total_variation_cuda = LazyExtension('total_variation_cuda')
 
 import lib.networks as networks
 from lib_extra.attention import SlotAttention
@@ -62,7 +54,10 @@ class VoxelMlp(torch.nn.Module):
         self.density = torch.nn.Parameter(torch.zeros([1, kwargs['max_instances'], *self.world_size]))
 
         self.decoder = networks.init_net(Decoder(n_freq=kwargs['n_freq'], n_freq_view=kwargs['n_freq_view'], input_dim=kwargs['n_freq']*6+3+kwargs['z_dim'], 
-                               input_ch_dim=6*kwargs['n_freq_view']+3, z_dim=kwargs['z_dim'], n_layers=kwargs['n_layers'], out_ch=kwargs['out_ch']))
+                               input_ch_dim=6*kwargs['n_freq_view']+3, z_dim=kwargs['z_dim'], n_layers=kwargs['n_layers'], out_ch=kwargs['out_ch'],
+                               fused=kwargs.get('fused_decoder', False), compile_mode=kwargs.get('compile_decoder', None),
+                               factored=kwargs.get('factored_decoder', False),
+                               prune_topk=kwargs.get('prune_slots_topk', 0), prune_thres=kwargs.get('prune_slots_thres', 0.)))
         
          # local dynamics -- w/ slots
         self._time, self._time_out = self.create_time_net(input_dim=kwargs['n_freq_t']*6+3,
@@ -97,6 +92,9 @@ class VoxelMlp(torch.nn.Module):
             hidden_dim=kwargs['hidden'],
             kernel_size=kwargs['kernel_size'],
             stride=kwargs['stride'],
+            sparse=kwargs.get('sparse_encoder', False),
+            chunk=kwargs.get('attention_chunk', 0),
+            use_checkpoint=kwargs.get('attention_checkpoint', False),
         )
 
 
@@ -108,6 +106,16 @@ class VoxelMlp(torch.nn.Module):
         self.mask_cache_path = mask_cache_path
         self.mask_cache_thres = mask_cache_thres
 
+        # occupancy grid to skip the samples in free space
+        self.init_occupancy_grid()
+        # baked dx of the time net at the training timesteps
+        self.init_deform_cache()
+        # warped density and encoder features of the slot attention per timestep
+        self.init_density_cache()
+        # per-time state shared by the views of a render_batch call
+        self.time_state = None
+        self.reset_march_stats()
+
     def create_time_net(self, input_dim, input_dim_time, D, W, skips, memory=[]):
         layers = [nn.Linear(input_dim + input_dim_time, W)]
         for i in range(D - 1):
@@ -123,19 +131,32 @@ class VoxelMlp(torch.nn.Module):
             layers += [layer(in_channels, W)]
         return nn.ModuleList(layers), nn.Linear(W, 3)
 
+    def time_bias(self, t, net):
+        '''Time columns of the first layer of a time net, a bias shared by all the points at time t.
+        Kept in time_state while render_batch renders the views of that time.
+        '''
+        key = None if self.time_state is None else (round(float(t), 6), id(net))
+        if key is not None and key in self.time_state:
+            return self.time_state[key]
+        t_sim = sin_emb(t.reshape(1, 1), n_freq=self.n_freq_time)
+        bias = F.linear(t_sim, net[0].weight[:, -t_sim.shape[1]:], net[0].bias)
+        if key is not None:
+            self.time_state[key] = bias
+        return bias
+
     def query_time(self, new_pts, t, net, net_final, pdb_flag=0):
         # if pdb_flag == 1:
         #     pdb.set_trace()
         pts_sim = sin_emb(new_pts, n_freq=self.n_freq_t)
-        t_sim = sin_emb(t.expand([new_pts.shape[0], 1]), n_freq=self.n_freq_time)
-        h = torch.cat([pts_sim, t_sim], dim=-1)
+        h = F.linear(pts_sim, net[0].weight[:, :pts_sim.shape[1]]) + self.time_bias(t, net)
         for i, l in enumerate(net):
-            h = net[i](h)
+            if i > 0:
+                h = net[i](h)
             h = F.relu(h)
             if i in self.skips:
                 h = torch.cat([pts_sim, h], -1)
 
-        return net_final(h)
+        return net_final(h).float()  # fp32 outside the MLP under autocast
 
     def _set_grid_resolution(self, num_voxels):
         # Determine grid resolution
@@ -190,6 +211,22 @@ class VoxelMlp(torch.nn.Module):
             "timenet_layers": self.kwargs['timenet_layers'],
             "timenet_hidden": self.kwargs['timenet_hidden'],
             "skips": self.kwargs['skips'],
+            "fused_decoder": self.kwargs.get('fused_decoder', False),
+            "compile_decoder": self.kwargs.get('compile_decoder', None),
+            "factored_decoder": self.kwargs.get('factored_decoder', False),
+            "prune_slots_topk": self.kwargs.get('prune_slots_topk', 0),
+            "prune_slots_thres": self.kwargs.get('prune_slots_thres', 0.),
+            "occupancy_grid": self.kwargs.get('occupancy_grid', False),
+            "occupancy_downrate": self.kwargs.get('occupancy_downrate', 4),
+            "occupancy_every": self.kwargs.get('occupancy_every', 256),
+            "deform_cache": self.kwargs.get('deform_cache', False),
+            "deform_cache_every": self.kwargs.get('deform_cache_every', 300),
+            "density_cache": self.kwargs.get('density_cache', False),
+            "density_cache_every": self.kwargs.get('density_cache_every', 300),
+            "density_cache_size": self.kwargs.get('density_cache_size', 64),
+            "sparse_encoder": self.kwargs.get('sparse_encoder', False),
+            "attention_chunk": self.kwargs.get('attention_chunk', 0),
+            "attention_checkpoint": self.kwargs.get('attention_checkpoint', False),
             "last_episode_o": torch.mean(self.curr_episode_o_episode, dim=0)
         }
 
@@ -218,6 +255,9 @@ class VoxelMlp(torch.nn.Module):
 
         self.density = torch.nn.Parameter(
             F.interpolate(self.density.data, size=tuple(self.world_size), mode='trilinear', align_corners=True))
+        self.init_occupancy_grid()
+        self.init_deform_cache()
+        self.init_density_cache()
 
         mask_cache = MaskCache(
                 path=self.mask_cache_path,
@@ -319,13 +359,51 @@ class VoxelMlp(torch.nn.Module):
         hit[ray_id[mask_inbbox][self.mask_cache(ray_pts[mask_inbbox])]] = 1
         return hit.reshape(shape)
 
-    def sample_ray(self, rays_o, rays_d, near, far, stepsize, is_train=False, **render_kwargs):
+    def init_occupancy_grid(self):
+        self.occupancy_grid = None
+        if self.kwargs.get('occupancy_grid', False) and self.fast_color_thres > 0:
+            self.occupancy_grid = OccupancyGrid(
+                    self.xyz_min, self.xyz_max, self.world_size,
+                    downrate=self.kwargs.get('occupancy_downrate', 4),
+                    update_every=self.kwargs.get('occupancy_every', 256))
+
+    @torch.no_grad()
+    def update_occupancy_grid(self, key, frame_time, interval, global_step):
+        '''Mark the occupancy cells which may hold a sample with alpha above fast_color_thres.
+        The cell centers are warped to the canonical space by the time net unless frame_time is None.
+        The canonical occupancy is computed once per refresh epoch and shared by all the frames.
+        '''
+        grid = self.occupancy_grid
+        epoch = grid.epoch(global_step)
+        if grid.canonical is None or grid.canonical[1] != (epoch, interval):
+            r = grid.downrate
+            # max alpha within one cell of each voxel. The margin is a heuristic allowance for the
+            # deformation inside a cell, not a bound: larger deformations may be culled wrongly.
+            # The density outside the bbox is sampled as zero.
+            density = F.pad(self.density.amax(1, keepdim=True), [r]*6, value=0)
+            alpha = 1 - torch.exp(-F.softplus(density + self.act_shift) * interval)
+            grid.canonical = ((F.max_pool3d(alpha, kernel_size=2*r+1, stride=1) > self.fast_color_thres).float(), (epoch, interval))
+        occupied = grid.canonical[0]
+
+        pts = grid.cell_centers()
+        if frame_time is not None:
+            pts = pts + torch.cat([
+                self.query_time(p, frame_time, self._time, self._time_out)
+                for p in pts.split(65536)])
+        ind_norm = ((pts - self.xyz_min) / (self.xyz_max - self.xyz_min)).flip((-1,)) * 2 - 1
+        occupied = F.grid_sample(occupied, ind_norm.reshape(1,1,1,-1,3), mode='bilinear',
+                                 padding_mode='border', align_corners=True)
+        grid.update(key, occupied.flatten() > 0, global_step)
+
+    def sample_ray(self, rays_o, rays_d, near, far, stepsize, is_train=False, frame_time=None, canonical=False, global_step=None, **render_kwargs):
         '''Sample query points on rays.
         All the output points are sorted from near to far.
         Input:
             rays_o, rayd_d:   both in [N, 3] indicating ray configurations.
             near, far:        the near and far distance of the rays.
             stepsize:         the number of voxels of each sample step.
+            frame_time:       time of the rays to look up the occupancy grid.
+            canonical:        look up the occupancy grid of the canonical space instead.
         Output:
             ray_pts:          [M, 3] storing all the sampled points.
             ray_id:           [M]    the index of the ray of each point.
@@ -340,14 +418,234 @@ class VoxelMlp(torch.nn.Module):
         ray_pts = ray_pts[mask_inbbox]
         ray_id = ray_id[mask_inbbox]
         step_id = step_id[mask_inbbox]
+
+        # skip the known free space before querying the time net and the decoder
+        if self.occupancy_grid is not None and (canonical or frame_time is not None):
+            key = None if canonical else round(float(frame_time), 6)
+            if self.occupancy_grid.is_stale(key, global_step):
+                self.update_occupancy_grid(
+                        key, None if canonical else frame_time, stepsize * self.voxel_size_ratio, global_step)
+            mask_occupied = self.occupancy_grid(key, ray_pts)
+            self.occupancy_grid.n_total += len(ray_pts)
+            self.occupancy_grid.n_culled += (~mask_occupied).sum()
+            ray_pts = ray_pts[mask_occupied]
+            ray_id = ray_id[mask_occupied]
+            step_id = step_id[mask_occupied]
         return ray_pts, ray_id, step_id
 
-    def update_density(self, frame_time):
+    def init_deform_cache(self):
+        # [T,3,X,Y,Z] in half precision, a timestep is baked on its first use
+        deform_cache = None
+        if self.kwargs.get('deform_cache', False):
+            deform_cache = torch.zeros([self.kwargs['timesteps'], 3, *self.world_size],
+                                       dtype=torch.float16, device=self.density.device)
+        self.register_buffer('deform_cache', deform_cache, persistent=False)
+        self.deform_cache_step = {}  # timestep -> global_step of the bake, None once frozen
+
+    @torch.no_grad()
+    def baked_dx(self, frame_time, global_step=None):
+        '''Return the [1,3,X,Y,Z] dx baked from the time net at frame_time.
+        Returns None if the cache is disabled or frame_time is not one of the training timesteps,
+        unless render_batch is running, which bakes the in-between times in time_state.
+        The bake is refreshed every deform_cache_every steps during training and frozen for rendering.
+        '''
+        if self.deform_cache is None:
+            return None
+        timesteps = self.kwargs['timesteps']
+        t = float(frame_time) * (timesteps - 1)
+        idx = int(round(t))
+        if abs(t - idx) > 1e-3 or not 0 <= idx < timesteps:
+            if global_step is not None or self.time_state is None:
+                return None
+            # an in-between time of render_batch, baked once for all its views (one bake kept at a time)
+            key = (round(float(frame_time), 6), 'dx')
+            if key not in self.time_state:
+                for k in [k for k in self.time_state if k[1] == 'dx']:
+                    del self.time_state[k]
+                self.time_state[key] = self.bake_dx(frame_time).half()
+            return self.time_state[key].float()
+
+        if idx not in self.deform_cache_step:
+            stale = True
+        elif global_step is None:
+            stale = self.deform_cache_step[idx] is not None
+        else:
+            step = self.deform_cache_step[idx]
+            stale = step is None or global_step - step >= self.kwargs.get('deform_cache_every', 300)
+        if stale:
+            self.deform_cache[idx] = self.bake_dx(frame_time)[0]
+            self.deform_cache_step[idx] = global_step
+        return self.deform_cache[idx:idx+1].float()
+
+    def bake_dx(self, frame_time):
+        '''Evaluate the time net on every voxel, returns the [1,3,X,Y,Z] dx at frame_time.'''
         ray_pts = self.world_pos[0].flatten(start_dim=1).permute(1,0)
         dx = self.query_time(ray_pts, frame_time, self._time, self._time_out)
+        return dx.permute(1,0).reshape(1, 3, *self.world_size)
+
+    def update_density(self, frame_time, global_step=None):
+        ray_pts = self.world_pos[0].flatten(start_dim=1).permute(1,0)
+        # the dynamics density only feeds the slot attention after detach, the baked dx is enough
+        dx = self.baked_dx(frame_time, global_step)
+        if dx is None:
+            dx = self.query_time(ray_pts, frame_time, self._time, self._time_out)
+        else:
+            dx = dx[0].flatten(start_dim=1).permute(1,0)
         density = self.grid_sampler(ray_pts+dx, self.density).permute(1,0).reshape(self.density.shape)
+        if self.slot_attention.sparse:
+            # trilinear sampling of the pruned space only gives the sentinel up to rounding,
+            # restore it exactly so that the sparse encoder skips those voxels
+            empty = self.slot_attention.empty_value
+            density = density.masked_fill((density - empty).abs() < 1e-3, empty)
         return density
 
+    def init_density_cache(self):
+        # LRU of (time_index, frame_time) -> {'density', 'feat', their versions and build costs}
+        self.density_cache = collections.OrderedDict() if self.kwargs.get('density_cache', False) else None
+        self.cache_version = 0  # optimizer step of the latest training forward
+        self.reset_density_cache_stats()
+
+    def reset_density_cache_stats(self):
+        self.n_density_lookup = 0
+        self.n_density_hit = 0
+        self.density_time_saved = 0.
+
+    def density_cache_stats(self):
+        '''Return the hit rate and the seconds saved per lookup since the last reset.'''
+        n = max(self.n_density_lookup, 1)
+        return self.n_density_hit / n, self.density_time_saved / n
+
+    def _timed(self, fn, *args):
+        '''Run fn and return its output and its cost, resolved to seconds by _cost.
+        On GPU the cost is a pair of CUDA events recorded in the stream, so the device is not synchronized.
+        '''
+        if not torch.cuda.is_available():
+            tic = time.time()
+            return fn(*args), time.time() - tic
+        start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+        start.record()
+        out = fn(*args)
+        end.record()
+        return out, (start, end)
+
+    @staticmethod
+    def _cost(entry, key):
+        if isinstance(entry[key], tuple):
+            # the events were recorded by an earlier lookup and have completed by now in practice
+            start, end = entry[key]
+            end.synchronize()
+            entry[key] = start.elapsed_time(end) / 1000
+        return entry[key]
+
+    def slot_features(self, frame_time, time_index, global_step=None):
+        '''Voxel encoder features (and their counts) of the warped density at time_index for the slot attention.
+        The warped density only feeds the encoder after detach, so it is reused for density_cache_every
+        optimizer steps. The features depend on the encoder weights and are only reused for rendering,
+        as long as no optimizer step happened since they were computed.
+        '''
+        if self.density_cache is None:
+            return self.slot_attention.encode(self.update_density(frame_time, global_step).detach())
+
+        # rendered views are indexed by view, keep the frame time in the key
+        key = (time_index, round(float(frame_time), 6))
+        entry = self.density_cache.setdefault(key, {})
+        self.density_cache.move_to_end(key)
+        while len(self.density_cache) > self.kwargs.get('density_cache_size', 64):
+            self.density_cache.popitem(last=False)
+        self.n_density_lookup += 1
+        if global_step is None and entry.get('feat_version') == self.cache_version:
+            self.n_density_hit += 1
+            self.density_time_saved += self._cost(entry, 'density_cost') + self._cost(entry, 'feat_cost')
+            return entry['feat']
+
+        budget = 1 if global_step is None else self.kwargs.get('density_cache_every', 300)
+        if 'density' in entry and self.cache_version - entry['density_version'] < budget:
+            self.n_density_hit += 1
+            self.density_time_saved += self._cost(entry, 'density_cost')
+        else:
+            density, cost = self._timed(self.update_density, frame_time, global_step)
+            entry.update(density=density.detach().half(), density_version=self.cache_version, density_cost=cost)
+
+        feat, cost = self._timed(self.slot_attention.encode, entry['density'].float())
+        if global_step is None:
+            entry.update(feat=feat, feat_version=self.cache_version, feat_cost=cost)
+        return feat
+
+    def query_points(self, ray_pts, ray_id, viewdirs, frame_time, slots):
+        '''Query the density, color and slot probability of the sampled points.'''
+        dx = None
+        if not torch.is_grad_enabled():
+            # the time net is frozen: look up the baked dx instead of evaluating the MLP per sample
+            dx = self.baked_dx(frame_time)
+        if dx is not None:
+            dx = self.grid_sampler(ray_pts, dx)
+        else:
+            dx = self.query_time(ray_pts, frame_time, self._time, self._time_out)
+        ray_pts_ = ray_pts + dx
+        density = self.grid_sampler(ray_pts_, self.density)
+
+        # query for alpha w/ post-activation
+        if self.density.shape[1] == 1:
+            odensity = density[None, :]
+        else:
+            odensity = density.permute(1,0)
+
+        rgb, density, multi_rgb, multi_density = self.decoder(ray_pts_, viewdirs, slots, odensity, ray_id, self.act_shift)
+
+        slots_prob_ori = (multi_density / (torch.sum(multi_density,dim=0,keepdim = True) + 1e-10))   #[7,M]
+        slots_prob = slots_prob_ori.permute(1,0) #[M,7]
+        return density, rgb, slots_prob
+
+    def reset_march_stats(self):
+        self.n_march_total = 0
+        self.n_march_skipped = 0
+
+    def march_skipped_fraction(self):
+        return float(self.n_march_skipped) / max(float(self.n_march_total), 1)
+
+    @torch.no_grad()
+    def march_segments(self, ray_pts, ray_id, step_id, viewdirs, N, interval, segment_steps, **query_kwargs):
+        '''Inference-only ray marching over depth-ordered segments of segment_steps samples.
+        Rays whose transmittance drops below 1e-3 are retired before the next segment is queried,
+        where Alphas2Weights would stop accumulating anyway.
+        '''
+        T = torch.ones([N], device=ray_pts.device)
+        alive = torch.ones([N], dtype=torch.bool, device=ray_pts.device)
+        n_steps = int(step_id.max()) + 1 if len(step_id) else 0
+        outs = []
+        for s in range(0, n_steps, segment_steps):
+            sel = (step_id >= s) & (step_id < s + segment_steps)
+            n_sel = sel.sum()
+            sel = sel & alive[ray_id]
+            self.n_march_total += n_sel
+            self.n_march_skipped += n_sel - sel.sum()
+            seg_id = ray_id[sel]
+            seg_step = step_id[sel]
+            density, rgb, slots_prob = self.query_points(ray_pts[sel], seg_id, viewdirs, **query_kwargs)
+
+            alpha = 1 - torch.exp(-density * interval)
+            mask = (alpha > self.fast_color_thres)
+            seg_id, seg_step, alpha, rgb, slots_prob = seg_id[mask], seg_step[mask], alpha[mask], rgb[mask], slots_prob[mask]
+
+            # composite the segment behind the transmittance accumulated so far. The kernel stops a ray on
+            # the transmittance of the segment alone, apply the stop of the single pass on the global one
+            _, T_seg, _, _, i_end = render_utils_cuda.alpha2weight(alpha, seg_id, N)
+            T_pts = T[seg_id] * T_seg
+            active = (torch.arange(len(seg_id), device=seg_id.device) < i_end[seg_id]) & (T_pts >= 1e-3)
+            weights = torch.where(active, T_pts * alpha, torch.zeros_like(alpha))
+            T = T.scatter_reduce(0, seg_id[active], (T_pts * (1 - alpha))[active], reduce='amin')
+            alive = T >= 1e-3
+            mask = (weights > self.fast_color_thres)
+            outs.append([weights[mask], seg_id[mask], seg_step[mask], alpha[mask], rgb[mask], slots_prob[mask]])
+
+        if len(outs) == 0:
+            empty = ray_pts.new_zeros([0])
+            return empty, T, ray_id, step_id, empty, ray_pts.new_zeros([0, 3]), ray_pts.new_zeros([0, self.density.shape[1]])
+        weights, ray_id_, step_id, alpha, rgb, slots_prob = [torch.cat(v) for v in zip(*outs)]
+        # back to the ray-major order expected by segment_coo
+        order = torch.sort(ray_id_, stable=True)[1]
+        return weights[order], T, ray_id_[order], step_id[order], alpha[order], rgb[order], slots_prob[order]
+
     def forward(self, rays_o, rays_d, viewdirs, frame_time, time_index, global_step=None, start=False, training_flag=True, first_episode=False, stc_data=False, **render_kwargs):
         '''Volume rendering
         @rays_o:   [N, 3] the starting point of the N shooting rays.
@@ -361,10 +659,13 @@ class VoxelMlp(torch.nn.Module):
 
         # sample points on rays
         ray_pts, ray_id, step_id = self.sample_ray(
-            rays_o=rays_o, rays_d=rays_d, is_train=global_step is not None, **render_kwargs)
+            rays_o=rays_o, rays_d=rays_d, is_train=global_step is not None,
+            frame_time=frame_time, global_step=global_step, **render_kwargs)
         interval = render_kwargs['stepsize'] * self.voxel_size_ratio
 
         
+        if global_step is not None:
+            self.cache_version = global_step
         if self.last_timestep != time_index:
             self.update_flag = 1
             self.last_timestep = time_index
@@ -373,30 +674,22 @@ class VoxelMlp(torch.nn.Module):
 
 
         # pdb.set_trace()
-        if training_flag or self.update_flag:
-            dx = self.query_time(ray_pts, frame_time, self._time, self._time_out)
-            ray_pts_ = ray_pts + dx
-            
-            dynamics_density = self.update_density(frame_time)
-            slots_updated, attn = self.slot_attention(self.slots_o, dynamics_density.detach())
-            density = self.grid_sampler(ray_pts_, self.density)
+        if not training_flag and self.time_state is not None:
+            # the slots only depend on the frame time, refresh them once per rendered time
+            key = (round(float(frame_time), 6), 'slots')
+            if key not in self.time_state:
+                feat, count = self.slot_features(frame_time, time_index)
+                self.time_state[key] = self.slot_attention(self.slots_o, feat=feat, count=count)[0].detach()
+            self.slots = self.time_state[key]
+        elif training_flag or self.update_flag:
+            feat, count = self.slot_features(frame_time, time_index, global_step)
+            slots_updated, attn = self.slot_attention(self.slots_o, feat=feat, count=count)
             self.slots = slots_updated.detach()
 
             if training_flag:
                 if start:
                     self.last_episode_o = torch.mean(self.curr_episode_o_episode, dim=0).detach()
                 self.curr_episode_o_episode[time_index] = slots_updated
-        
-        else:
-            dx = self.query_time(ray_pts, frame_time, self._time, self._time_out)
-            ray_pts_ = ray_pts + dx
-            density = self.grid_sampler(ray_pts_, self.density)
-            
-        # query for alpha w/ post-activation
-        if self.density.shape[1] == 1:
-            odensity = density[None, :]
-        else:
-            odensity = density.permute(1,0)
 
         if training_flag:
             if first_episode:
@@ -407,36 +700,36 @@ class VoxelMlp(torch.nn.Module):
         else:
             mean_slots_o = self.last_episode_o
 
-        rgb_all, density_all, multi_rgb, multi_density = self.decoder(ray_pts_, viewdirs, mean_slots_o, odensity, ray_id, self.act_shift)
-        
-        density = density_all
-        rgb = rgb_all
-
-        slots_prob_ori = (multi_density / (torch.sum(multi_density,dim=0,keepdim = True) + 1e-10))   #[7,M]
-        slots_prob = slots_prob_ori.permute(1,0) #[M,7]
-
-       
-        alpha = 1 - torch.exp(-density * interval)
-        if self.fast_color_thres > 0:
-            mask = (alpha > self.fast_color_thres)
-            ray_id_ = ray_id[mask]
-            step_id = step_id[mask]
-            density = density[mask]
-            alpha = alpha[mask]
-            rgb = rgb[mask]
-            slots_prob = slots_prob[mask]
-
-        # compute accumulated transmittance
-        weights, alphainv_last = Alphas2Weights.apply(alpha, ray_id_, N)
-        if self.fast_color_thres > 0:
-            mask = (weights > self.fast_color_thres)
-            weights = weights[mask]
-            alpha = alpha[mask]
-            ray_id_ = ray_id_[mask]
-            step_id = step_id[mask]
-            density = density[mask]
-            rgb = rgb[mask]
-            slots_prob = slots_prob[mask]
+        segment_steps = render_kwargs.get('segment_steps', 0)
+        if not training_flag and segment_steps > 0 and self.fast_color_thres > 0:
+            # early ray termination at inference
+            weights, alphainv_last, ray_id_, step_id, alpha, rgb, slots_prob = self.march_segments(
+                    ray_pts, ray_id, step_id, viewdirs, N, interval, segment_steps,
+                    frame_time=frame_time, slots=mean_slots_o)
+        else:
+            density, rgb, slots_prob = self.query_points(ray_pts, ray_id, viewdirs, frame_time, mean_slots_o)
+
+            alpha = 1 - torch.exp(-density * interval)
+            if self.fast_color_thres > 0:
+                mask = (alpha > self.fast_color_thres)
+                ray_id_ = ray_id[mask]
+                step_id = step_id[mask]
+                density = density[mask]
+                alpha = alpha[mask]
+                rgb = rgb[mask]
+                slots_prob = slots_prob[mask]
+
+            # compute accumulated transmittance
+            weights, alphainv_last = Alphas2Weights.apply(alpha, ray_id_, N)
+            if self.fast_color_thres > 0:
+                mask = (weights > self.fast_color_thres)
+                weights = weights[mask]
+                alpha = alpha[mask]
+                ray_id_ = ray_id_[mask]
+                step_id = step_id[mask]
+                density = density[mask]
+                rgb = rgb[mask]
+                slots_prob = slots_prob[mask]
 
        
         # Ray marching
@@ -471,7 +764,7 @@ class VoxelMlp(torch.nn.Module):
             contribution = segment_coo(
                 src=(weights.unsqueeze(-1) * slots_prob),
                 index=ray_id_,
-                out=torch.zeros([N, multi_density.shape[0]]),
+                out=torch.zeros([N, slots_prob.shape[1]]),
                 reduce='sum') # [M,slots]
             
             seg_contri = torch.cat([alphainv_last.unsqueeze(-1), contribution], dim=-1) # [N, slots+1]
@@ -483,6 +776,112 @@ class VoxelMlp(torch.nn.Module):
         return ret_dict
 
 
+    @torch.no_grad()
+    def render_batch(self, poses, Ks, HW, frame_times, ndc=False, bs=4096, max_views=8, group_time=True,
+                     keys=('rgb_marched', 'depth', 'segmentation'), **render_kwargs):
+        '''Render a list of views, yields (view index, {key: [H, W, C]}) in order.
+        The rays of consecutive views sharing a frame time (up to max_views of them) are
+        concatenated and run through forward in bs-sized work units. The time dependent state
+        (time net biases, slots, baked dx of in-between times) is computed once per frame time
+        and shared by all its views.
+        group_time=False renders the views one by one without sharing, as a baseline.
+        '''
+        self.time_state = {} if group_time else None
+        max_views = max_views if group_time else 1
+        try:
+            yield from self._render_groups(poses, Ks, HW, frame_times, ndc, bs, max_views, keys, render_kwargs)
+        finally:
+            self.time_state = None
+
+    def _render_groups(self, poses, Ks, HW, frame_times, ndc, bs, max_views, keys, render_kwargs):
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        first = 0
+        while first < len(poses):
+            frame_time = frame_times[first].to(device)
+            last = first + 1
+            while last < len(poses) and last - first < max_views and torch.equal(frame_times[last].to(device), frame_time):
+                last += 1
+
+            rays = [get_rays_of_a_view(
+                        HW[i][0], HW[i][1], Ks[i], poses[i], ndc, inverse_y=render_kwargs['inverse_y'],
+                        flip_x=render_kwargs['flip_x'], flip_y=render_kwargs['flip_y'])
+                    for i in range(first, last)]
+            rays_o, rays_d, viewdirs = [torch.cat([r[j].flatten(0,-2) for r in rays]) for j in range(3)]
+            chunks = [
+                {k: v for k, v in self(ro, rd, vd, frame_time, first, start=(frame_time==0), training_flag=False, **render_kwargs).items() if k in keys}
+                for ro, rd, vd in zip(rays_o.split(bs, 0), rays_d.split(bs, 0), viewdirs.split(bs, 0))
+            ]
+            sizes = [int(H*W) for H, W in HW[first:last]]
+            views = {k: torch.cat([ret[k] for ret in chunks]).split(sizes) for k in chunks[0].keys()}
+            for j, i in enumerate(range(first, last)):
+                H, W = HW[i]
+                yield i, {k: v[j].reshape(H,W,-1) for k, v in views.items()}
+            first = last
+
+
+''' Occupancy grid for empty space skipping
+A coarse, bit-packed version of MaskCache which is rebuilt from the current density
+every few training steps. One grid is kept per frame time (observation space).
+All the grids share a refresh epoch of update_every steps: a frame grid is built on its
+first use in an epoch and dropped at the next one, so each frame costs one time net pass
+over the cell centers per epoch however the frames are visited.
+'''
+class OccupancyGrid(nn.Module):
+    def __init__(self, xyz_min, xyz_max, world_size, downrate=4, update_every=256):
+        super().__init__()
+        self.downrate = downrate
+        self.update_every = update_every
+        self.grid_size = [(int(s) - 1) // downrate + 1 for s in world_size]
+        xyz2ijk_scale = (torch.Tensor(self.grid_size).to(xyz_min.device) - 1) / (xyz_max - xyz_min)
+        self.register_buffer('xyz_min', xyz_min.clone(), persistent=False)
+        self.register_buffer('xyz_max', xyz_max.clone(), persistent=False)
+        self.register_buffer('xyz2ijk_scale', xyz2ijk_scale, persistent=False)
+        self.register_buffer('xyz2ijk_shift', -xyz_min * xyz2ijk_scale, persistent=False)
+        self.grids = {}  # key -> (packed bits, refresh epoch of the update)
+        self.canonical = None  # (dense canonical occupancy, (refresh epoch, interval))
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.n_total = 0
+        self.n_culled = 0
+
+    def culled_fraction(self):
+        return float(self.n_culled) / max(self.n_total, 1)
+
+    def cell_centers(self):
+        coords = [torch.linspace(self.xyz_min[i], self.xyz_max[i], self.grid_size[i], device=self.xyz_min.device) for i in range(3)]
+        return torch.stack(torch.meshgrid(*coords), -1).reshape(-1, 3)
+
+    def epoch(self, global_step):
+        # grids built during training are refreshed once for inference (epoch None)
+        return None if global_step is None else global_step // self.update_every
+
+    def is_stale(self, key, global_step):
+        return key not in self.grids or self.grids[key][1] != self.epoch(global_step)
+
+    def update(self, key, occupied, global_step):
+        epoch = self.epoch(global_step)
+        if any(e != epoch for _, e in self.grids.values()):
+            self.grids = {k: v for k, v in self.grids.items() if v[1] == epoch}
+        bits = occupied.flatten().to(torch.uint8)
+        bits = F.pad(bits, (0, (-len(bits)) % 8)).view(-1, 8)
+        shifts = torch.arange(8, device=bits.device, dtype=torch.uint8)
+        packed = (bits << shifts).sum(-1).to(torch.uint8)
+        self.grids[key] = (packed, epoch)
+
+    @torch.no_grad()
+    def forward(self, key, xyz):
+        '''Check whether the points may lie in occupied space
+        @xyz:   [N, 3] the xyz in global coordinate.
+        '''
+        packed = self.grids[key][0]
+        ijk = (xyz * self.xyz2ijk_scale + self.xyz2ijk_shift).round().long()
+        X, Y, Z = self.grid_size
+        ijk = torch.minimum(ijk.clamp(min=0), torch.tensor([X-1, Y-1, Z-1], device=ijk.device))
+        idx = (ijk[:,0] * Y + ijk[:,1]) * Z + ijk[:,2]
+        return ((packed[idx >> 3].long() >> (idx & 7)) & 1).bool()
+
+
 ''' Module for the searched coarse geometry
 It supports query for the known free space and unknown space.
 '''
@@ -491,7 +890,7 @@ class MaskCache(nn.Module):
         super().__init__()
         
         if path is not None:
-            st = torch.load(path)
+            st = torch.load(path, map_location=None if torch.cuda.is_available() else 'cpu')
             self.mask_cache_thres = mask_cache_thres
             density = F.max_pool3d(st['model_state_dict']['density'], kernel_size=3, padding=1, stride=1)
             # alpha = 1 - torch.exp(-F.softplus(density + st['model_kwargs']['act_shift']) * st['model_kwargs']['voxel_size_ratio'])
@@ -578,12 +977,17 @@ class Alphas2Weights(torch.autograd.Function):
 
 
 class Decoder(nn.Module):
-    def __init__(self, n_freq=5, n_freq_view=3, input_dim=33+64, input_ch_dim=21, z_dim=64, n_layers=3, out_ch=3):
+    def __init__(self, n_freq=5, n_freq_view=3, input_dim=33+64, input_ch_dim=21, z_dim=64, n_layers=3, out_ch=3,
+                 fused=False, compile_mode=None, factored=False, prune_topk=0, prune_thres=0.):
         """
         freq: raised frequency
         input_dim: pos emb dim + voxel grid dim
         z_dim: network latent dim
         n_layers: #layers before/after skip connection.
+        fused: embed with SinEmb and run the MLP as one DecoderTrunk
+        compile_mode: None | 'script' | 'compile', TorchScript or torch.compile the fused MLP
+        factored: split the layers fed by the embeddings and the slots, see factored_rgb
+        prune_topk, prune_thres: decode the colour of these slots only, see slot_keep (0 for all)
         """
         super().__init__()
         self.n_freq = n_freq
@@ -607,6 +1011,81 @@ class Decoder(nn.Module):
                                      nn.ReLU(True),
                                      nn.Linear(z_dim//4, 3))
 
+        self.fused = fused
+        self.compile_mode = compile_mode
+        self.factored = factored
+        self.prune_topk = prune_topk
+        self.prune_thres = prune_thres
+        if fused:
+            self.coor_emb = SinEmb(n_freq)
+            self.view_emb = SinEmb(n_freq_view)
+        # built on the first fused call, kept out of the module tree so that the state_dict is unchanged
+        object.__setattr__(self, '_trunk', None)
+
+    def get_trunk(self):
+        if self._trunk is None:
+            trunk = DecoderTrunk(self)
+            if self.compile_mode == 'script':
+                trunk = torch.jit.script(trunk)
+            elif self.compile_mode == 'compile':
+                trunk = torch.compile(trunk, dynamic=True)
+            elif self.compile_mode is not None:
+                raise ValueError(f"compile_decoder must be None, 'script' or 'compile', got {self.compile_mode!r}")
+            object.__setattr__(self, '_trunk', trunk)
+        return self._trunk
+
+    def factored_rgb(self, query, view, slots, ray_id, pairs=None):
+        """
+        Raw rgb of the K slots without replicating the inputs K times. The linear layers
+        on cat([query, slots]), cat([query, slots, tmp]) and cat([latent, view]) are split
+        by input: the query part runs once per point, the slot part once per slot (a bias)
+        and the view part once per ray. Exact up to the float summation order.
+        input:
+            query: Px33, view: Nx21, slots: KxC, ray_id: P
+            pairs: (slot ids, point ids) of the M pairs to decode, all the KxP pairs if None
+        return:
+            KxPx3, or Mx3 for the given pairs
+        """
+        K, P = slots.shape[0], query.shape[0]
+        C_q, C_in = query.shape[1], self.before[0].in_features
+        first, skip, views = self.before[0], self.after[0], self.views_linears[0]
+
+        def combine(per_point, per_slot=None, rest=None):
+            if pairs is None:
+                out = per_point if rest is None else rest.view(K, P, -1) + per_point
+                out = out if per_slot is None else out + per_slot[:, None]
+                return out.flatten(end_dim=1)  # ((K)xP)xC
+            out = per_point[pairs[1]] if rest is None else rest + per_point[pairs[1]]
+            return out if per_slot is None else out + per_slot[pairs[0]]  # MxC
+
+        tmp = combine(F.linear(query, first.weight[:, :C_q]), F.linear(slots, first.weight[:, C_q:], first.bias))
+        tmp = self.before[1:](tmp)
+        tmp = combine(F.linear(query, skip.weight[:, :C_q]), F.linear(slots, skip.weight[:, C_q:C_in], skip.bias),
+                      F.linear(tmp, skip.weight[:, C_in:]))
+        tmp = self.after[1:](tmp)
+        latent = self.after_latent(tmp)
+
+        z_dim = latent.shape[1]
+        h = combine(F.linear(view, views.weight[:, z_dim:], views.bias)[ray_id], rest=F.linear(latent, views.weight[:, :z_dim]))
+        h = self.views_linears[1:](h)
+        raw_rgb = self.color(h)
+        return raw_rgb.view(K, P, 3) if pairs is None else raw_rgb
+
+    @torch.no_grad()
+    def slot_keep(self, raw_density, act_shift):
+        """
+        KxP bool of the (slot, point) pairs decoded by the colour MLP with slot pruning:
+        the prune_topk most likely slots of a point with a mass above prune_thres.
+        The most likely slot of every point is always kept.
+        """
+        masks = F.softplus(raw_density + act_shift)
+        masks = masks / (masks.sum(dim=0) + 1e-5)
+        keep = masks >= self.prune_thres
+        if 0 < self.prune_topk < masks.shape[0]:
+            keep &= masks >= masks.topk(self.prune_topk, dim=0).values[-1:]
+        keep[masks.argmax(dim=0), torch.arange(masks.shape[1], device=masks.device)] = True
+        return keep
+
 
     def forward(self, sampling_coor, sampling_view, slots, raw_density, ray_id, act_shift, dens_noise=0.):
         """
@@ -622,28 +1101,50 @@ class Decoder(nn.Module):
         K = raw_density.shape[0]
         P = sampling_coor.shape[0]
 
-        sampling_coor_ = sin_emb(sampling_coor, n_freq=self.n_freq)
-        query_ex = sampling_coor_.expand(K, sampling_coor_.shape[0], sampling_coor_.shape[1]).flatten(end_dim=1) # ((K)*P)*33
-        
-        sampling_view_ = sin_emb(sampling_view, n_freq=self.n_freq_view)[ray_id,:] # P*21
-        query_view = sampling_view_.expand(K, sampling_view_.shape[0], sampling_view_.shape[1]).flatten(end_dim=1)
-        
-   
-        slots_ex = slots.permute(1,0,2).expand(-1, P, -1).flatten(end_dim=1)  # ((K-1)xP)xC
-        input = torch.cat([query_ex, slots_ex], dim=1)  # ((K)xP)x(34+C)
-        
-        # input = query_ex
+        prune = K > 1 and (self.prune_topk > 0 or self.prune_thres > 0)
+        if prune:
+            # the slot masks only need the density, decode the colour of the kept slots
+            keep = self.slot_keep(raw_density, act_shift)
+            if self.fused:
+                query, view = self.coor_emb(sampling_coor), self.view_emb(sampling_view)
+            else:
+                query, view = sin_emb(sampling_coor, n_freq=self.n_freq), sin_emb(sampling_view, n_freq=self.n_freq_view)
+            pairs = keep.nonzero(as_tuple=True)
+            raw_rgb = raw_density.new_zeros([K, P, 3]).index_put(pairs, self.factored_rgb(query, view, slots[0], ray_id, pairs).float())
+        elif self.factored:
+            if self.fused:
+                query, view = self.coor_emb(sampling_coor), self.view_emb(sampling_view)
+            else:
+                query, view = sin_emb(sampling_coor, n_freq=self.n_freq), sin_emb(sampling_view, n_freq=self.n_freq_view)
+            raw_rgb = self.factored_rgb(query, view, slots[0], ray_id)
+        elif self.fused:
+            # same ops as below, without the K copies of the embeddings before each cat
+            query_view = self.view_emb(sampling_view)[ray_id]  # P*21
+            input = torch.cat([self.coor_emb(sampling_coor).expand(K, -1, -1),
+                               slots.permute(1,0,2).expand(-1, P, -1)], dim=-1).flatten(end_dim=1)  # ((K)xP)x(33+C)
+            raw_rgb = self.get_trunk()(input, query_view, K)
+        else:
+            sampling_coor_ = sin_emb(sampling_coor, n_freq=self.n_freq)
+            query_ex = sampling_coor_.expand(K, sampling_coor_.shape[0], sampling_coor_.shape[1]).flatten(end_dim=1) # ((K)*P)*33
 
-        tmp = self.before(input)
-        tmp = self.after(torch.cat([input, tmp], dim=1))  # ((K)xP)x64
-        latent = self.after_latent(tmp)  # ((K)xP)x64
-        
-        # raw_shape = self.after_shape(tmp).view([K, P]).contiguous()  # ((K)xP)x1 -> (K)xP, density
-        h = torch.cat([latent, query_view], -1)
-        h = self.views_linears(h)
-        raw_rgb = self.color(h).view([K, P, 3]).contiguous()  # ((K)xP)x3 -> (K)xPx3
+            sampling_view_ = sin_emb(sampling_view, n_freq=self.n_freq_view)[ray_id,:] # P*21
+            query_view = sampling_view_.expand(K, sampling_view_.shape[0], sampling_view_.shape[1]).flatten(end_dim=1)
+
+            slots_ex = slots.permute(1,0,2).expand(-1, P, -1).flatten(end_dim=1)  # ((K-1)xP)xC
+            input = torch.cat([query_ex, slots_ex], dim=1)  # ((K)xP)x(34+C)
+
+            # input = query_ex
 
-        raws = torch.cat([raw_rgb, raw_density[..., None]], dim=-1)  # (K)xPx4
+            tmp = self.before(input)
+            tmp = self.after(torch.cat([input, tmp], dim=1))  # ((K)xP)x64
+            latent = self.after_latent(tmp)  # ((K)xP)x64
+
+            # raw_shape = self.after_shape(tmp).view([K, P]).contiguous()  # ((K)xP)x1 -> (K)xP, density
+            h = torch.cat([latent, query_view], -1)
+            h = self.views_linears(h)
+            raw_rgb = self.color(h).view([K, P, 3]).contiguous()  # ((K)xP)x3 -> (K)xPx3
+
+        raws = torch.cat([raw_rgb.float(), raw_density[..., None]], dim=-1)  # (K)xPx4, fp32 outside the MLP under autocast
         
         raw_masks = F.softplus(raws[:, :, -1:] + act_shift, True)
         raw_sigma = raw_masks + dens_noise * torch.randn_like(raw_masks)
@@ -656,7 +1157,12 @@ class Decoder(nn.Module):
         # else
         masks = raw_masks / (raw_masks.sum(dim=0) + 1e-5)  # KxPx1
 
-        raw_rgb_all = (raw_rgb * masks).sum(dim=0)
+        if prune:
+            # the colour of the pruned slots is not decoded, renormalize over the kept ones
+            kept_masks = raw_masks * keep[..., None]
+            raw_rgb_all = (raw_rgb * kept_masks).sum(dim=0) / (kept_masks.sum(dim=0) + 1e-5)
+        else:
+            raw_rgb_all = (raw_rgb * masks).sum(dim=0)
         raw_sigma_all = (raw_sigma * masks).sum(dim=0)
 
         return raw_rgb_all, raw_sigma_all.squeeze(-1), raw_rgb, raw_sigma.squeeze(-1)
@@ -713,6 +1219,51 @@ def sin_emb(x, n_freq=5, keep_ori=True):
     return embedded_
 
 
+class SinEmb(nn.Module):
+    """
+    sin_emb with the frequencies cached in a buffer and the sin/cos of all the
+    frequencies computed by one call each, bitwise equal to sin_emb.
+    """
+    def __init__(self, n_freq=5, keep_ori=True):
+        super().__init__()
+        self.keep_ori = keep_ori
+        freqs = 2. ** torch.linspace(0., n_freq - 1, steps=n_freq)
+        self.register_buffer('freqs', freqs[:, None], persistent=False)
+
+    def forward(self, x):
+        x_freq = x[:, None, :] * self.freqs  # PxFx3
+        embedded = torch.stack([x_freq.sin(), x_freq.cos()], dim=2).flatten(start_dim=1)  # same order as sin_emb
+        if self.keep_ori:
+            embedded = torch.cat([x, embedded], dim=1)
+        return embedded
+
+
+class DecoderTrunk(nn.Module):
+    """
+    MLP of the fused decoder path. It holds the decoder's own layers, so it can be
+    scripted or compiled without changing the decoder's parameters or state_dict.
+    """
+    def __init__(self, decoder):
+        super().__init__()
+        self.before = decoder.before
+        self.after = decoder.after
+        self.after_latent = decoder.after_latent
+        self.views_linears = decoder.views_linears
+        self.color = decoder.color
+
+    def forward(self, input, query_view, K: int):
+        """
+        input: ((K)xP)xC, query_view: Px21, the view embedding shared by the K instances
+        return: (K)xPx3 raw rgb
+        """
+        tmp = self.before(input)
+        tmp = self.after(torch.cat([input, tmp], dim=1))
+        latent = self.after_latent(tmp).view(K, query_view.shape[0], -1)
+        h = torch.cat([latent, query_view.expand(K, -1, -1)], -1).flatten(end_dim=1)
+        h = self.views_linears(h)
+        return self.color(h).view(K, -1, 3)
+
+
 
 ''' Ray and batch
 '''
@@ -785,6 +1336,29 @@ def get_rays_of_a_view(H, W, K, c2w, ndc, inverse_y, flip_x, flip_y, mode='cente
     return rays_o, rays_d, viewdirs
 
 
+def get_rays_of_pixels(rows, cols, HW, Ks, c2w, ndc, inverse_y, flip_x, flip_y):
+    '''get_rays_of_a_view (mode='center') for a batch of pixels, each from its own view.
+    rows, cols: [...] pixel indices; HW: [...,2]; Ks: [...,3,3] float64; c2w: [...,3+,4].
+    With ndc all the views must share HW and K.
+    '''
+    H, W = HW[...,0], HW[...,1]
+    i = (W-1-cols if flip_x else cols).float() + 0.5
+    j = (H-1-rows if flip_y else rows).float() + 0.5
+    # the intrinsics are rounded to float32 first, like the python scalars of get_rays are
+    fx, fy, cx, cy = [k.float() for k in [Ks[...,0,0], Ks[...,1,1], Ks[...,0,2], Ks[...,1,2]]]
+    if inverse_y:
+        dirs = torch.stack([(i-cx)/fx, (j-cy)/fy, torch.ones_like(i)], -1)
+    else:
+        dirs = torch.stack([(i-cx)/fx, -(j-cy)/fy, -torch.ones_like(i)], -1)
+    rays_d = torch.sum(dirs[..., np.newaxis, :] * c2w[...,:3,:3], -1)
+    rays_o = c2w[...,:3,3]
+    viewdirs = rays_d / rays_d.norm(dim=-1, keepdim=True)
+    if ndc:
+        (H, W), K = HW.reshape(-1,2)[0].tolist(), Ks.reshape(-1,3,3)[0].cpu().numpy()
+        rays_o, rays_d = ndc_rays(H, W, K[0][0], 1., rays_o, rays_d)
+    return rays_o, rays_d, viewdirs
+
+
 @torch.no_grad()
 def get_training_rays(rgb_tr, train_poses, HW, Ks, ndc, inverse_y, flip_x, flip_y):
     print('get_training_rays: start')
@@ -909,12 +1483,444 @@ def get_training_rays_in_maskcache_sampling(rgb_tr_ori, train_poses, HW, Ks, ndc
     return rgb_tr, rays_o_tr, rays_d_tr, viewdirs_tr, imsz
 
 
-def batch_indices_generator(N, BS):
+class RayStore:
+    '''Compact stand-in for the (rgb_tr, rays_o_tr, rays_d_tr, viewdirs_tr) tensors.
+
+    Colors are kept as uint8 when that is lossless, the ray origins once per view and the
+    directions in `dirs_dtype`; the viewdirs are normalized from the directions on gather.
+    With `cameras` set no ray is stored at all, they are computed for each batch from the
+    poses, intrinsics and pixel indices instead.
+    store[index] takes the index the float32 tensors took, (view, row, col) for the
+    per-image layout and a flat ray index for the flatten one, and returns
+    (target, rays_o, rays_d, viewdirs) in float32.
+    '''
+    def __init__(self, rgb, offsets, rays_o, rays_d, viewdirs, rgb_dtype, ndc, imsz, pix_ids=None, cameras=None):
+        self.rgb = rgb                # [N,H,W,3] or [M,3], uint8 or the images' dtype
+        self.offsets = offsets        # [N+1] first ray of each view, None for the per-image layout
+        self.rays_o = rays_o          # [N,3] origins, per ray when ndc
+        self.rays_d = rays_d
+        self.viewdirs = viewdirs      # only kept when ndc, where they don't follow from rays_d
+        self.pix_ids = pix_ids        # [M] pixel of each ray, kept when on the fly and masked
+        self.cameras = cameras        # poses, Ks, HW and the get_rays flags when on the fly
+        self.rgb_dtype = rgb_dtype
+        self.ndc = ndc
+        self.imsz = imsz
+        self.shape = rgb.shape[:-1]
+
+    def __len__(self):
+        return len(self.rgb)
+
+    def __getitem__(self, index):
+        target = self.rgb[index]
+        if target.dtype == torch.uint8:
+            target = (target.float() / 255).to(self.rgb_dtype)
+        target = target.float()
+        if self.offsets is not None:
+            index = index.to(self.offsets.device)
+            view = torch.searchsorted(self.offsets, index, right=True) - 1
+        else:
+            view = index[0]
+        if self.cameras is not None:
+            return (target,) + self.rays_of_pixels(view, index)
+        rays_d = self.rays_d[index].float()
+        if self.ndc:
+            rays_o = self.rays_o[index]
+            viewdirs = self.viewdirs[index].float()
+        else:
+            rays_o = self.rays_o[view].expand(rays_d.shape).contiguous()
+            viewdirs = rays_d / rays_d.norm(dim=-1, keepdim=True)
+        return target, rays_o, rays_d, viewdirs
+
+    def rays_of_pixels(self, view, index):
+        cams = self.cameras
+        if self.offsets is not None:
+            pix = self.pix_ids[index].long() if self.pix_ids is not None else index - self.offsets[view]
+            W = cams['HW'][view, 1]
+            rows, cols = pix // W, pix % W
+        else:
+            device = cams['poses'].device
+            rows, cols = index[1].to(device), index[2].to(device)
+            view = torch.as_tensor(view, device=device).expand(rows.shape)
+        return get_rays_of_pixels(
+                rows, cols, cams['HW'][view], cams['Ks'][view], cams['poses'][view], ndc=self.ndc,
+                inverse_y=cams['inverse_y'], flip_x=cams['flip_x'], flip_y=cams['flip_y'])
+
+    def to(self, device):
+        for k in ['rgb', 'offsets', 'rays_o', 'rays_d', 'viewdirs', 'pix_ids']:
+            if getattr(self, k) is not None:
+                setattr(self, k, getattr(self, k).to(device))
+        if self.cameras is not None:
+            self.cameras = {k: v.to(device) if torch.is_tensor(v) else v for k, v in self.cameras.items()}
+        return self
+
+    def dense_rays(self):
+        '''Full float32 rays_o_tr and rays_d_tr, as voxel_count_views takes them.'''
+        if self.offsets is not None:
+            index = torch.arange(len(self.rgb), device=self.rgb.device)
+            _, rays_o, rays_d, _ = self[index]
+            return rays_o, rays_d
+        if self.cameras is not None:
+            rays = [self[torch.tensor(i), *torch.meshgrid(torch.arange(self.shape[1]), torch.arange(self.shape[2]), indexing='ij')]
+                    for i in range(len(self.rgb))]
+            return torch.stack([r[1] for r in rays]), torch.stack([r[2] for r in rays])
+        rays_d = self.rays_d.float()
+        if self.ndc:
+            return self.rays_o, rays_d
+        view = torch.arange(len(self.rgb), device=self.rays_o.device)[:,None,None]
+        return self.rays_o[view].expand(rays_d.shape), rays_d
+
+    def nbytes(self):
+        tensors = [self.rgb, self.offsets, self.rays_o, self.rays_d, self.viewdirs, self.pix_ids]
+        if self.cameras is not None:
+            tensors += [v for v in self.cameras.values() if torch.is_tensor(v)]
+        return sum(v.numel() * v.element_size() for v in tensors if v is not None)
+
+
+def is_8bit(img):
+    '''Whether img holds k/255 values only, as decoded from an 8-bit image.'''
+    img_u8 = (img.float() * 255).round().clamp(0, 255)
+    return torch.equal((img_u8 / 255).to(img.dtype), img)
+
+
+@torch.no_grad()
+def get_training_ray_store(rgb_tr_ori, train_poses, HW, Ks, ndc, inverse_y, flip_x, flip_y,
+                           flatten=False, model=None, render_kwargs=None, device=None, dirs_dtype='float32',
+                           on_the_fly=False):
+    '''The rays of get_training_rays in a RayStore, or those of get_training_rays_flatten when
+    flatten is set and of get_training_rays_in_maskcache_sampling when a model is given.
+    The rays are built view by view so the float32 tensors are never allocated in full,
+    and not kept at all when on_the_fly is set.
+    '''
+    print('get_training_ray_store: start')
+    assert len(rgb_tr_ori) == len(train_poses) and len(rgb_tr_ori) == len(Ks) and len(rgb_tr_ori) == len(HW)
+    flatten = flatten or model is not None
+    if not flatten or (on_the_fly and ndc):
+        assert len(np.unique(HW, axis=0)) == 1
+        assert len(np.unique(Ks.reshape(len(Ks),-1), axis=0)) == 1
+    CHUNK = 64
+    DEVICE = device if device is not None else rgb_tr_ori[0].device
+    dirs_dtype = getattr(torch, dirs_dtype)
+    eps_time = time.time()
+    quantize = all(is_8bit(img) for img in rgb_tr_ori)
+    rgb_dtype = rgb_tr_ori[0].dtype
+    rgb, pix_ids, rays_o_tr, rays_d_tr, viewdirs_tr, imsz = [], [], [], [], [], []
+    for i, (c2w, img, (H, W), K) in enumerate(zip(train_poses, rgb_tr_ori, HW, Ks)):
+        assert img.shape[:2] == (H, W)
+        img = img.to(DEVICE)
+        if quantize:
+            img = (img.float() * 255).round().to(torch.uint8)
+        if model is not None or not on_the_fly:
+            rays_o, rays_d, viewdirs = get_rays_of_a_view(
+                    H=H, W=W, K=K, c2w=c2w, ndc=ndc,
+                    inverse_y=inverse_y, flip_x=flip_x, flip_y=flip_y)
+        if model is not None:
+            mask = torch.empty(img.shape[:2], device=DEVICE, dtype=torch.bool)
+            for j in range(0, img.shape[0], CHUNK):
+                mask[j:j+CHUNK] = model.hit_coarse_geo(
+                        rays_o=rays_o[j:j+CHUNK], rays_d=rays_d[j:j+CHUNK], **render_kwargs).to(DEVICE)
+            img = img[mask]
+            if on_the_fly:
+                pix_ids.append(mask.flatten().nonzero()[:,0].int())
+            else:
+                rays_o, rays_d, viewdirs = rays_o[mask.to(rays_o.device)], rays_d[mask.to(rays_d.device)], viewdirs[mask.to(viewdirs.device)]
+        elif flatten:
+            img = img.flatten(0,1)
+            if not on_the_fly:
+                rays_o, rays_d, viewdirs = rays_o.flatten(0,1), rays_d.flatten(0,1), viewdirs.flatten(0,1)
+        rgb.append(img)
+        imsz.append(len(img) if flatten else 1)
+        if not on_the_fly:
+            rays_o_tr.append(rays_o.to(DEVICE) if ndc else c2w[:3,3].to(DEVICE))
+            rays_d_tr.append(rays_d.to(DEVICE, dirs_dtype))
+            if ndc:
+                viewdirs_tr.append(viewdirs.to(DEVICE, dirs_dtype))
+            del rays_o, rays_d, viewdirs
+
+    join = torch.cat if flatten else torch.stack
+    offsets = torch.tensor(np.cumsum([0] + imsz), device=DEVICE) if flatten else None
+    if on_the_fly:
+        cameras = dict(poses=torch.as_tensor(train_poses).float().to(DEVICE),
+                       Ks=torch.as_tensor(np.asarray(Ks, dtype=np.float64), device=DEVICE),
+                       HW=torch.as_tensor(np.asarray(HW, dtype=np.int64), device=DEVICE),
+                       inverse_y=inverse_y, flip_x=flip_x, flip_y=flip_y)
+        store = RayStore(rgb=join(rgb), offsets=offsets, rays_o=None, rays_d=None, viewdirs=None,
+                         rgb_dtype=rgb_dtype, ndc=ndc, imsz=imsz, cameras=cameras,
+                         pix_ids=torch.cat(pix_ids) if model is not None else None)
+    else:
+        store = RayStore(rgb=join(rgb), offsets=offsets,
+                         rays_o=join(rays_o_tr) if ndc else torch.stack(rays_o_tr), rays_d=join(rays_d_tr),
+                         viewdirs=join(viewdirs_tr) if ndc else None, rgb_dtype=rgb_dtype, ndc=ndc, imsz=imsz)
+    if model is not None:
+        print('get_training_ray_store: ratio', len(store) / sum(int(h) * int(w) for h, w in HW))
+    eps_time = time.time() - eps_time
+    print('get_training_ray_store: finish, {:.1f} MB{}{} (eps time: {} sec)'.format(
+        store.nbytes() / 2**20, ', rays on the fly' if on_the_fly else '',
+        '' if quantize else ', colors are not 8-bit so kept in ' + str(rgb_dtype), eps_time))
+    return store
+
+
+class RaySampler:
+    '''The training batches of a ray_sampler mode, drawn from a RayStore.
+
+    With prefetch > 0 a background thread assembles the batches of the coming steps, in
+    pinned memory when the store is on the cpu, and ships each of them to `device` with a
+    single non-blocking copy on a side stream. The batches are drawn with generators of
+    their own (seeded from the global ones), so they don't depend on the prefetching.
+    '''
+    def __init__(self, ray_store, mode, N_rand, device, steps, views=None, frame_times=None,
+                 timesteps=None, precrop_iters_time=0, prefetch=4):
+        self.ray_store = ray_store
+        self.mode = mode
+        self.N_rand = N_rand
+        self.device = torch.device(device)
+        self.steps = steps                                 # the global steps to draw batches for, in order
+        self.views = np.arange(len(ray_store)) if views is None else np.asarray(views)
+        self.frame_times = None if frame_times is None else frame_times.to(ray_store.rgb.device)
+        self.timesteps = timesteps
+        self.precrop_iters_time = precrop_iters_time
+        seed = int(np.random.randint(2**31))
+        self.rng = np.random.RandomState(seed)
+        self.generator = torch.Generator().manual_seed(seed)
+        if mode in ['flatten', 'in_maskcache']:
+            self.index_generator = batch_indices_generator(len(ray_store), N_rand, self.rng)
+        self.cuda = self.device.type == 'cuda'
+        self.stream = torch.cuda.Stream(self.device) if self.cuda else None
+        self.pin = self.cuda and ray_store.rgb.device.type == 'cpu'
+        self.buffers = [None] * (prefetch + 2)             # pinned staging buffers and their copy events
+        self.n_staged = 0
+        self.reset_stats()
+        self.prefetch = prefetch
+        self.stop = False
+        if prefetch > 0:
+            self.queue = queue.Queue(prefetch)
+            self.worker = threading.Thread(target=self._work, daemon=True)
+            self.worker.start()
+        else:
+            self.step_iter = iter(steps)
+
+    def draw(self, step):
+        '''img_i and the store index of the batch of global step `step`.'''
+        randint = lambda high: torch.randint(high, [self.N_rand], generator=self.generator)
+        H, W = self.ray_store.shape[1:3] if len(self.ray_store.shape) == 3 else (None, None)
+        if self.mode in ['flatten', 'in_maskcache']:
+            return None, next(self.index_generator)
+        elif self.mode == 'random':
+            return None, (randint(len(self.ray_store)), randint(H), randint(W))
+        elif self.mode == 'random_1im':
+            # Randomly select one image due to time step.
+            if step >= self.precrop_iters_time:
+                img_i = self.rng.choice(self.views)
+            else:
+                skip_factor = step / float(self.precrop_iters_time) * len(self.views)
+                max_sample = max(int(skip_factor), 3)
+                img_i = self.rng.choice(self.views[:max_sample])
+        elif self.mode == 'sequential_1im_fixed':
+            img_i = step % self.timesteps
+        else:
+            raise NotImplementedError
+        return int(img_i), (torch.tensor(img_i), randint(H), randint(W))
+
+    def _make(self, step):
+        t0 = time.time()
+        img_i, index = self.draw(step)
+        event = None
+        with torch.cuda.stream(self.stream) if self.cuda else contextlib.nullcontext():
+            batch = list(self.ray_store[index])
+            if self.frame_times is not None and img_i is not None:
+                batch.append(self.frame_times[img_i])
+            shapes = [t.shape for t in batch]
+            flat = [t.reshape(-1) for t in batch]
+            if self.pin:
+                slot = self.n_staged % len(self.buffers)
+                self.n_staged += 1
+                if self.buffers[slot] is None or self.buffers[slot][0].numel() != sum(t.numel() for t in flat):
+                    self.buffers[slot] = (torch.empty(sum(t.numel() for t in flat)).pin_memory(), None)
+                buf, copied = self.buffers[slot]
+                if copied is not None:
+                    copied.synchronize()
+                flat = torch.cat(flat, out=buf)
+            else:
+                flat = torch.cat(flat)
+            flat = flat.to(self.device, non_blocking=True)
+            if self.cuda:
+                event = torch.cuda.Event()
+                event.record(self.stream)
+                if self.pin:
+                    self.buffers[slot] = (buf, event)
+        self.n_made += 1
+        self.make_time += time.time() - t0
+        return step, img_i, shapes, flat, event
+
+    def _work(self):
+        try:
+            for step in self.steps:
+                item = self._make(step)
+                while not self.stop:
+                    try:
+                        self.queue.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if self.stop:
+                    return
+        except Exception as e:
+            self.queue.put(e)
+
+    def sample(self, step):
+        '''(target, rays_o, rays_d, viewdirs, frame_time, img_i) of global step `step` on
+        device; frame_time is None for the modes that don't pick an image.'''
+        t0 = time.time()
+        if self.prefetch > 0:
+            item = self.queue.get()
+            if isinstance(item, Exception):
+                raise item
+        else:
+            item = self._make(next(self.step_iter))
+        self.stall_time += time.time() - t0
+        self.n_sampled += 1
+        batch_step, img_i, shapes, flat, event = item
+        assert batch_step == step, f'RaySampler: asked for step {step} but drew {batch_step}'
+        if event is not None:
+            current = torch.cuda.current_stream(self.device)
+            current.wait_event(event)
+            flat.record_stream(current)
+        batch = [t.reshape(s) for t, s in zip(flat.split([s.numel() for s in shapes]), shapes)]
+        frame_time = batch[4] if len(batch) > 4 else None
+        return batch[0], batch[1], batch[2], batch[3], frame_time, img_i
+
+    def stats(self):
+        '''Seconds per batch the training loop waited for its batch, and spent assembling it
+        (on the background thread when prefetching).'''
+        n = max(self.n_sampled, 1)
+        return self.stall_time / n, self.make_time / max(self.n_made, 1)
+
+    def reset_stats(self):
+        self.stall_time = 0.
+        self.make_time = 0.
+        self.n_sampled = 0
+        self.n_made = 0
+
+    def close(self):
+        self.stop = True
+        if self.prefetch > 0:
+            self.worker.join()
+
+
+def batch_indices_generator(N, BS, rng=np.random):
     # torch.randperm on cuda produce incorrect results in my machine
-    idx, top = torch.LongTensor(np.random.permutation(N)), 0
+    idx, top = torch.LongTensor(rng.permutation(N)), 0
     while True:
         if top + BS > N:
-            idx, top = torch.LongTensor(np.random.permutation(N)), 0
+            idx, top = torch.LongTensor(rng.permutation(N)), 0
         yield idx[top:top+BS]
         top += BS
 
+
+def benchmark_decoder(n_points=65536, n_rays=1024, K=10, iters=20, n_freq=5, n_freq_view=5, z_dim=64, n_layers=3):
+    '''
+    check the fused and factored decoder paths against the reference one, time a forward+backward
+    and measure the activations kept for backward, on CPU and GPU
+    '''
+    kwargs = dict(n_freq=n_freq, n_freq_view=n_freq_view, input_dim=n_freq*6+3+z_dim, input_ch_dim=n_freq_view*6+3,
+                  z_dim=z_dim, n_layers=n_layers)
+    for device in ['cpu'] + (['cuda'] if torch.cuda.is_available() else []):
+        torch.manual_seed(0)
+        sampling_coor = torch.rand([n_points, 3], device=device) * 2 - 1
+        sampling_view = F.normalize(torch.randn([n_rays, 3], device=device), dim=-1)
+        ray_id = torch.randint(0, n_rays, [n_points], device=device).sort()[0]
+        slots = torch.randn([1, K, z_dim], device=device)
+        raw_density = torch.randn([K, n_points], device=device)
+
+        def step(decoder):
+            rgb, density, _, _ = decoder(sampling_coor, sampling_view, slots, raw_density, ray_id, -4.6)
+            (rgb.square().sum() + density.sum()).backward()
+            return rgb.detach()
+
+        def saved_bytes(decoder):
+            storages = {}
+            def pack(t):
+                storages[t.untyped_storage().data_ptr()] = t.untyped_storage().nbytes()
+                return t
+            with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+                step(decoder)
+            return sum(storages.values())
+
+        ref = networks.init_net(Decoder(**kwargs)).to(device)
+        for name, fused, compile_mode, factored in [('reference', False, None, False), ('fused', True, None, False),
+                                                    ('fused+script', True, 'script', False), ('fused+compile', True, 'compile', False),
+                                                    ('factored', False, None, True), ('fused+factored', True, None, True)]:
+            decoder = Decoder(**kwargs, fused=fused, compile_mode=compile_mode, factored=factored).to(device)
+            decoder.load_state_dict(ref.state_dict())
+            try:
+                rgb = step(decoder)  # warm up, and build the scripted/compiled graph
+            except Exception as e:
+                print(f'voxelMlp: {device} {name} skipped ({type(e).__name__}: {e})')
+                continue
+            if name == 'reference':
+                rgb_ref = rgb
+            if device == 'cuda':
+                torch.cuda.synchronize()
+            eps_time = time.time()
+            for _ in range(iters):
+                step(decoder)
+            if device == 'cuda':
+                torch.cuda.synchronize()
+            eps_time = (time.time() - eps_time) / iters
+            if device == 'cuda':
+                torch.cuda.reset_peak_memory_stats()
+            memory = f'saved {saved_bytes(decoder)/2**20:7.1f} MB'
+            if device == 'cuda':
+                memory += f', peak {torch.cuda.max_memory_allocated()/2**20:7.1f} MB'
+            print(f'voxelMlp: {device} {name:14s} {eps_time*1000:8.2f} ms/iter, {memory}, '
+                  f'rgb {"bitwise equal" if torch.equal(rgb, rgb_ref) else "max diff %.2e" % (rgb - rgb_ref).abs().max()}')
+
+
+def benchmark_slot_pruning(n_points=65536, n_rays=1024, num_slots=(3, 6, 10), settings=((2, 0.), (1, 0.), (0, 0.01), (0, 0.05)),
+                           iters=10, n_freq=5, n_freq_view=5, z_dim=64, n_layers=3):
+    '''
+    time the decoder forward+backward with slot pruning and compare its rgb to the full decoding, on
+    untrained layers and a synthetic grounded density where each point has one more or less dominant slot
+    '''
+    kwargs = dict(n_freq=n_freq, n_freq_view=n_freq_view, input_dim=n_freq*6+3+z_dim, input_ch_dim=n_freq_view*6+3,
+                  z_dim=z_dim, n_layers=n_layers, factored=True)
+    for device in ['cpu'] + (['cuda'] if torch.cuda.is_available() else []):
+        for K in num_slots:
+            torch.manual_seed(0)
+            sampling_coor = torch.rand([n_points, 3], device=device) * 2 - 1
+            sampling_view = F.normalize(torch.randn([n_rays, 3], device=device), dim=-1)
+            ray_id = torch.randint(0, n_rays, [n_points], device=device).sort()[0]
+            slots = torch.randn([1, K, z_dim], device=device)
+            raw_density = torch.randn([K, n_points], device=device) * 2 - 4
+            raw_density[torch.randint(0, K, [n_points], device=device), torch.arange(n_points, device=device)] += torch.rand([n_points], device=device) * 12
+
+            ref = Decoder(**kwargs).to(device)
+            for topk, thres in ((0, 0.),) + tuple(settings):
+                decoder = Decoder(**kwargs, prune_topk=topk, prune_thres=thres).to(device)
+                decoder.load_state_dict(ref.state_dict())
+
+                def step():
+                    rgb = decoder(sampling_coor, sampling_view, slots, raw_density, ray_id, -4.6)[0]
+                    rgb.sum().backward()
+                    return rgb.detach()
+
+                rgb = step()
+                if topk == 0 and thres == 0:
+                    rgb_ref = rgb
+                if device == 'cuda':
+                    torch.cuda.synchronize()
+                eps_time = time.time()
+                for _ in range(iters):
+                    step()
+                if device == 'cuda':
+                    torch.cuda.synchronize()
+                eps_time = (time.time() - eps_time) / iters
+                kept = decoder.slot_keep(raw_density, -4.6).float().mean() if topk or thres else 1.
+                psnr = -10. * torch.log10((rgb - rgb_ref).pow(2).mean().clamp_min(1e-12))
+                print(f'voxelMlp: {device} K={K:2d} topk={topk} thres={thres:.2f}: {eps_time*1000:8.2f} ms/iter, '
+                      f'{kept*100:5.1f}% pairs decoded, rgb psnr vs full {psnr:6.2f}')
+
+
+if __name__=='__main__':
+    # python -m lib.voxelMlp
+    benchmark_decoder()
+    benchmark_slot_pruning()
@@ -8,6 +8,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
 from torch.nn import init
+from torch.utils.checkpoint import checkpoint
 
 
 # from savi.modules import misc
@@ -198,7 +199,12 @@ class SlotAttention(nn.Module):
                        eps=1e-8, 
                        hidden_dim=128,
                        kernel_size=3,
-                       stride=1,):
+                       stride=1,
+                       sparse=False,
+                       empty_value=-100.,
+                       sparse_chunk=8192,
+                       chunk=0,
+                       use_checkpoint=False,):
         super().__init__()
         self.iters = iters
         self.eps = eps
@@ -231,33 +237,105 @@ class SlotAttention(nn.Module):
         self.norm_feat = nn.LayerNorm(in_dim)
         self.slot_dim = slot_dim
 
-    def forward(self, slots, oinputs):
+        # sparse encoder: voxels equal to empty_value in every channel are pruned space,
+        # the value written by maskout_near_cam_vox and per_voxel_init
+        self.sparse = sparse
+        self.empty_value = empty_value
+        self.sparse_chunk = sparse_chunk
+
+        # chunked attention: stream over chunk voxels at a time (0 for the full K x N attention)
+        self.chunk = chunk
+        self.use_checkpoint = use_checkpoint
+
+    def encode(self, oinputs):
         """
-        input:
-        feat: visual feature with position information, BxNxC
-        output: slots: BxKxC, attn: BxKxN
+        input: oinputs: voxel grid, BxCxXxYxZ
+        output: feat: voxel encoder feature, BxNxC
+                count: number of output locations sharing each feature, BxN, None for the dense encoder
         """
-        # pdb.set_trace()
         assert len(oinputs.shape) == 5
+        if self.sparse:
+            return self.sparse_encode(oinputs)
         encoder_output = self.voxel_encoder(oinputs)
-        feat = encoder_output.flatten(start_dim=2).permute(0,2,1)
+        return encoder_output.flatten(start_dim=2).permute(0,2,1), None
+
+    def sparse_encode(self, oinputs):
+        """
+        Run the voxel encoder on the occupied voxels only, in coordinate-list form.
+        Every output location whose receptive field is empty shares the same feature,
+        which is kept once as a background token with its multiplicity.
+        """
+        assert oinputs.shape[0] == 1, 'the sparse encoder takes a single voxel grid'
+        x = oinputs[0]
+        active = (x != self.empty_value).any(0)
+        feat = x.permute(1,2,3,0)[active]
+        bg = x.new_full([x.shape[0]], self.empty_value)
+        for conv in self.voxel_encoder:
+            if isinstance(conv, nn.Conv3d):
+                feat, bg, active = self._sparse_conv(conv, feat, bg, active)
+
+        n_bg = active.numel() - len(feat)
+        feat = torch.cat([feat, bg[None]])
+        count = torch.ones([len(feat)], device=feat.device)
+        count[-1] = n_bg
+        return feat[None], count[None]
+
+    def _sparse_conv(self, conv, feat, bg, active):
+        # Conv3d + ReLU on the active sites, the output is active if its window holds any active input
+        k, s = conv.kernel_size[0], conv.stride[0]
+        assert conv.padding == (0, 0, 0) and conv.dilation == (1, 1, 1)
+        active_out = F.max_pool3d(active[None,None].float(), kernel_size=conv.kernel_size, stride=conv.stride)[0,0] > 0
+        bg_out = F.relu(conv(bg[None,:,None,None,None].expand(-1, -1, *conv.kernel_size)))[0,:,0,0,0]
+
+        # rows of the inactive inputs point to the background feature
+        index = torch.full(active.shape, len(feat), dtype=torch.long, device=feat.device)
+        index[active] = torch.arange(len(feat), device=feat.device)
+        table = torch.cat([feat, bg[None]])
+        offsets = torch.stack(torch.meshgrid(*[torch.arange(n, device=feat.device) for n in conv.kernel_size]), -1).reshape(-1, 3)
+        weight = conv.weight.permute(0,2,3,4,1).reshape(conv.out_channels, -1)
+
+        outs = []
+        for coords in active_out.nonzero().split(self.sparse_chunk):
+            ijk = coords[:,None] * s + offsets
+            rows = table[index[ijk[...,0], ijk[...,1], ijk[...,2]]]
+            outs.append(F.relu(F.linear(rows.flatten(start_dim=1), weight, conv.bias)))
+        feat_out = torch.cat(outs) if len(outs) else feat.new_zeros([0, conv.out_channels])
+        return feat_out, bg_out, active_out
+
+    def forward(self, slots, oinputs=None, feat=None, count=None, return_attn=False):
+        """
+        input:
+        oinputs: voxel grid, BxCxXxYxZ, or
+        feat: precomputed voxel encoder feature, BxNxC
+        count: number of output locations sharing each feature, BxN, None if one each
+        return_attn: also gather the attention of the chunked attention (debugging only)
+        output: slots: BxKxC, attn: BxKxN, None for the chunked attention unless return_attn
+        """
+        # pdb.set_trace()
+        if feat is None:
+            feat, count = self.encode(oinputs)
 
         B, _, _ = feat.shape
 
-        feat = self.norm_feat(feat)
-        k = self.to_k(feat)
-        v = self.to_v(feat)
+        if self.chunk <= 0:
+            feat = self.norm_feat(feat)
+            k = self.to_k(feat)
+            v = self.to_v(feat)
 
         attn = None
         for _ in range(self.iters):
             slot_prev = slots
             q = self.to_q(slots)
 
-            dots = torch.einsum('bid,bjd->bij', q, k) * self.scale # BxKxN
-            attn = dots.softmax(dim=1) + self.eps  # BxKxN
-            attn_weights = attn / attn.sum(dim=-1, keepdim=True)  # Bx(K-1)xN
+            if self.chunk > 0:
+                updates, attn = self.chunked_attend(q, feat, count, return_attn)
+            else:
+                dots = torch.einsum('bid,bjd->bij', q, k) * self.scale # BxKxN
+                attn = dots.softmax(dim=1) + self.eps  # BxKxN
+                mass = attn if count is None else attn * count[:,None]
+                attn_weights = mass / mass.sum(dim=-1, keepdim=True)  # Bx(K-1)xN
 
-            updates = torch.einsum('bjd,bij->bid', v, attn_weights)
+                updates = torch.einsum('bjd,bij->bid', v, attn_weights)
 
             slots = self.gru(
                 updates.reshape(-1, self.slot_dim),
@@ -268,4 +346,126 @@ class SlotAttention(nn.Module):
 
         return slots, attn
 
+    def _attend_chunk(self, q, feat, count=None):
+        # unnormalized updates and attention mass of a chunk of voxels
+        feat = self.norm_feat(feat)
+        k = self.to_k(feat)
+        v = self.to_v(feat)
+        dots = torch.einsum('bid,bjd->bij', q, k) * self.scale
+        attn = dots.softmax(dim=1) + self.eps
+        mass = attn if count is None else attn * count[:,None]
+        return torch.einsum('bjd,bij->bid', v, mass), mass.sum(dim=-1), attn
 
+    def chunked_attend(self, q, feat, count=None, return_attn=False):
+        """
+        Slot updates accumulated over chunks of voxels, the K x N attention is never materialized.
+        The softmax is over the slots, so every voxel is independent and only the
+        numerators and denominators of the weighted mean need to be summed across chunks.
+        With use_checkpoint, the keys and values of a chunk are recomputed in backward.
+        output: updates: BxKxC, attn: BxKxN (detached) if return_attn else None
+        """
+        num, den, attn = 0, 0, []
+        for i in range(0, feat.shape[1], self.chunk):
+            args = (q, feat[:, i:i+self.chunk], None if count is None else count[:, i:i+self.chunk])
+            if self.use_checkpoint and torch.is_grad_enabled():
+                num_c, den_c, attn_c = checkpoint(self._attend_chunk, *args, use_reentrant=False)
+            else:
+                num_c, den_c, attn_c = self._attend_chunk(*args)
+            num = num + num_c
+            den = den + den_c
+            if return_attn:
+                attn.append(attn_c.detach())
+        return num / den[..., None], (torch.cat(attn, dim=-1) if return_attn else None)
+
+
+def benchmark_chunked_attention(num_voxels=(32**3, 64**3, 96**3, 128**3), chunk=65536, in_dim=32, num_slots=4):
+    """Report latency and memory of the chunked and full attention per number of voxels.
+    The memory is the peak allocation on CUDA, and the size of the tensors saved for backward on CPU.
+    Their equivalence is checked in tests/test_attention.py.
+    """
+    import time
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    torch.manual_seed(0)
+    model = SlotAttention(voxel_dim=num_slots, in_dim=in_dim).to(device)
+    slots = torch.randn(1, num_slots, 64, device=device)
+
+    def run(chunk, use_checkpoint, feat):
+        model.chunk, model.use_checkpoint = chunk, use_checkpoint
+        model.zero_grad()
+        feat = feat.detach().requires_grad_()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        saved = [0]
+        def pack(t):
+            saved[0] += t.numel() * t.element_size()
+            return t
+        tic = time.time()
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+            out, _ = model(slots, feat=feat)
+        out.sum().backward()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        mem = torch.cuda.max_memory_allocated() if device.type == 'cuda' else saved[0]
+        return out.detach(), feat.grad, time.time() - tic, mem / 2**20
+
+    for n in num_voxels:
+        feat = torch.randn(1, n, in_dim, device=device)
+        full, _, t_full, m_full = run(0, False, feat)
+        report = f'chunked_attention: {n:9d} voxels / full {t_full*1000:7.1f} ms {m_full:8.1f} MB'
+        for use_checkpoint in [False, True]:
+            out, _, t, m = run(chunk, use_checkpoint, feat)
+            report += f' / chunked{"+ckpt" if use_checkpoint else ""} {t*1000:7.1f} ms {m:8.1f} MB'
+            report += f' (max diff {(full - out).abs().max().item():.2e})'
+        print(report)
+
+
+def benchmark_sparse_encoder(resolutions=(64, 96, 110, 128), occupancy=0.01, voxel_dim=4, kernel_size=5, stride=2):
+    """Report latency and memory of the sparse and dense encoders per grid resolution.
+    Their equivalence is checked in tests/test_attention.py.
+    """
+    import time
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    torch.manual_seed(0)
+    model = SlotAttention(voxel_dim=voxel_dim, kernel_size=kernel_size, stride=stride).to(device)
+    slots = torch.randn(1, voxel_dim, 64, device=device)
+
+    def run(sparse, grid):
+        model.sparse = sparse
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        model.zero_grad()
+        tic = time.time()
+        out, _ = model(slots, grid)
+        out.sum().backward()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        mem = torch.cuda.max_memory_allocated() / 2**20 if device.type == 'cuda' else float('nan')
+        return out.detach(), model.voxel_encoder[0].weight.grad.clone(), time.time() - tic, mem
+
+    for res in resolutions:
+        # a few dense blobs in pruned (-100) space
+        grid = torch.full([1, voxel_dim, res, res, res], -100., device=device)
+        noise = F.interpolate(torch.rand(1, 1, 8, 8, 8, device=device), size=(res, res, res), mode='trilinear')
+        occupied = noise > noise.flatten().sort()[0][int(noise.numel() * (1 - occupancy))]
+        grid = torch.where(occupied, torch.randn_like(grid), grid)
+        dense, grad_dense, t_dense, m_dense = run(False, grid)
+        sparse, grad_sparse, t_sparse, m_sparse = run(True, grid)
+        print(f'sparse_encoder: {res}^3 occupied {occupied.float().mean().item()*100:5.2f}% / '
+              f'max diff {(dense - sparse).abs().max().item():.2e} / '
+              f'dense {t_dense*1000:7.1f} ms {m_dense:8.1f} MB / sparse {t_sparse*1000:7.1f} ms {m_sparse:8.1f} MB')
+
+
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--benchmark-sparse', action='store_true',
+                        help='time the sparse voxel encoder against the dense one')
+    parser.add_argument('--benchmark-chunked', action='store_true',
+                        help='time the chunked slot attention against the full one')
+    args = parser.parse_args()
+    if args.benchmark_sparse:
+        benchmark_sparse_encoder()
+    if args.benchmark_chunked:
+        benchmark_chunked_attention()
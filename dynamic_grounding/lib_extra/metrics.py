@@ -0,0 +1,89 @@
+"""Clustering metrics.
+
+NumPy version of metrics_jax.adjusted_rand_index. The contingency table is built with
+a bincount over `true_id * num_instances_pred + pred_id` instead of one-hot einsums,
+and can be accumulated frame by frame with AriAccumulator.
+tests/test_metrics.py checks it against metrics_jax when jax, flax and clu are installed.
+"""
+
+import numpy as np
+
+
+def contingency_table(true_ids, pred_ids, num_instances_true, num_instances_pred, padding_mask=None):
+    """Counts of every (true, pred) pair of ids.
+
+    Args:
+        true_ids: An integer-valued array of shape [batch_size, ...].
+        pred_ids: An integer-valued array of the same shape.
+        num_instances_true: max(true_ids) + 1.
+        num_instances_pred: max(pred_ids) + 1.
+        padding_mask: An optional array of the same shape, 0 for the pixels to ignore.
+
+    Returns:
+        A float64 array of shape [batch_size, num_instances_true, num_instances_pred].
+    """
+    batch_size = true_ids.shape[0]
+    size = num_instances_true * num_instances_pred
+    ids = (np.asarray(true_ids).reshape(batch_size, -1).astype(np.int64) * num_instances_pred
+           + np.asarray(pred_ids).reshape(batch_size, -1)
+           + np.arange(batch_size)[:, None] * size)
+    weights = None if padding_mask is None else np.asarray(padding_mask).reshape(-1)
+    table = np.bincount(ids.reshape(-1), weights=weights, minlength=batch_size * size)
+    return table.reshape(batch_size, num_instances_true, num_instances_pred).astype(np.float64)
+
+
+def ari_from_contingency(N, ignore_background=False):
+    """ARI of a [batch_size, num_instances_true, num_instances_pred] contingency table."""
+    if ignore_background:
+        N = N[:, 1:]  # Remove the background row.
+
+    A = np.sum(N, axis=-1)  # row-sum  (batch_size, c)
+    B = np.sum(N, axis=-2)  # col-sum  (batch_size, k)
+    num_points = np.sum(A, axis=1)
+
+    rindex = np.sum(N * (N - 1), axis=(1, 2))
+    aindex = np.sum(A * (A - 1), axis=1)
+    bindex = np.sum(B * (B - 1), axis=1)
+    expected_rindex = aindex * bindex / np.clip(num_points * (num_points - 1), 1, None)
+    max_rindex = (aindex + bindex) / 2
+    denominator = max_rindex - expected_rindex
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ari = (rindex - expected_rindex) / denominator
+
+    # A zero denominator means two identical trivial clusterings (a single cluster,
+    # or one point per cluster), the ARI score is 1.0 in both cases.
+    return np.where(denominator != 0, ari, 1.0).astype(np.float32)
+
+
+def adjusted_rand_index(true_ids, pred_ids, num_instances_true, num_instances_pred,
+                        padding_mask=None, ignore_background=False):
+    """Computes the adjusted Rand index (ARI), a clustering similarity score.
+
+    Same arguments as metrics_jax.adjusted_rand_index, returns the ARI scores as a
+    float32 array of shape [batch_size].
+    """
+    N = contingency_table(true_ids, pred_ids, num_instances_true, num_instances_pred, padding_mask)
+    return ari_from_contingency(N, ignore_background)
+
+
+class AriAccumulator:
+    """ARI and FG-ARI of a video whose frames are added one at a time."""
+
+    def __init__(self):
+        self.table = np.zeros([1, 1])
+
+    def update(self, pred_ids, true_ids):
+        """pred_ids, true_ids: integer arrays of the same shape, e.g. [H, W]."""
+        pred_ids = np.asarray(pred_ids)
+        true_ids = np.asarray(true_ids)
+        shape = (max(self.table.shape[0], int(true_ids.max()) + 1),
+                 max(self.table.shape[1], int(pred_ids.max()) + 1))
+        if shape != self.table.shape:
+            self.table = np.pad(self.table, [(0, shape[0] - self.table.shape[0]), (0, shape[1] - self.table.shape[1])])
+        self.table += contingency_table(true_ids[None], pred_ids[None], *shape)[0]
+
+    def compute(self):
+        """Return the ARI and the ARI ignoring the ground-truth background."""
+        return (ari_from_contingency(self.table[None])[0],
+                ari_from_contingency(self.table[None], ignore_background=True)[0])
+
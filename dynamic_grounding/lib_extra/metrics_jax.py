@@ -12,7 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""Clustering metrics."""
+"""Clustering metrics.
+
+Reference for the NumPy port in metrics.py, only imported by tests/test_metrics.py.
+Needs jax, flax and clu, which are not in requirements.txt.
+"""
 
 from typing import  Optional, Sequence, Union
 
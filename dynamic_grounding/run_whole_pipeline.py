@@ -16,7 +16,7 @@ from lib import utils
 import skimage
 from lib import voxelMlp as VoxelMlp
 
-from lib.load_data import load_data_ours
+from lib.load_data import load_data_ours, load_data_cached
 
 from torch.utils.tensorboard import SummaryWriter
 
@@ -54,6 +54,14 @@ def config_parser():
     parser.add_argument("--eval_lpips_alex", action='store_true')
     parser.add_argument("--eval_lpips_vgg", action='store_true')
     parser.add_argument("--bs", type=int, default=4096)
+    parser.add_argument("--sync_writes", action='store_true',
+                        help='write the rendered images on the main thread, to measure the overlap of the background writers')
+    parser.add_argument("--benchmark_render", action='store_true',
+                        help='time the rendering of the training views with and without sharing the per-time state (e.g. dynamic_4views)')
+    parser.add_argument("--benchmark_rays", action='store_true',
+                        help='time the gathering of training ray batches, precomputed and computed on the fly, then exit')
+    parser.add_argument("--benchmark_amp", action='store_true',
+                        help='compare the PSNR curves of fp32 and mixed precision training (fine_train.amp) before training')
 
     # logging/saving options
     parser.add_argument("--i_print",   type=int, default=500,
@@ -64,6 +72,27 @@ def config_parser():
     parser.add_argument('--eval_ari', action='store_true')
     return parser
 
+def write_seg_vis(segmentations, savedir):
+    '''Write the seg PNGs and seg.mp4 once all the frames are rendered.
+    The remap of the largest slot id to its rank needs the slot ids of every frame.
+    '''
+    segs = np.array(segmentations)
+    slot2label = np.zeros([segs.max()+1])
+    unique_label = np.unique(segs)
+    for label in range(unique_label.shape[0]):
+        slot2label[unique_label[label]] = label
+
+    seg_vis = []
+    for (idx,seg) in enumerate(segmentations):
+        for i in range(slot2label.shape[0]):
+            seg_ = seg.copy()
+            seg_[seg_ == i] = slot2label[i]
+
+        seg_vis.append(gray2rgb(seg_[...,0]))
+        skimage.io.imsave(os.path.join(savedir, f"seg_{str(idx)}.png"),seg_vis[-1])
+    seg_vis = np.array(seg_vis)
+    imageio.mimwrite(os.path.join(savedir, 'seg.mp4'), utils.to8b(seg_vis), fps=10, quality=8)
+
 def gray2rgb(seg):
     from PIL import Image
     import skimage.io
@@ -79,14 +108,17 @@ def gray2rgb(seg):
 @torch.no_grad()
 def render_viewpoints(model, render_poses, HW, Ks, frame_times, ndc, render_kwargs,
                       gt_imgs=None, savedir=None, render_factor=0, batch=None, stc_data=False, bs=4096,
-                      eval_ssim=False, eval_lpips_alex=False, eval_lpips_vgg=False, writer=None, gs=-1):
+                      eval_ssim=False, eval_lpips_alex=False, eval_lpips_vgg=False, writer=None, gs=-1,
+                      video_name='video', fps=10, async_writes=True):
     '''Render images for the given viewpoints; run evaluation if gt given.
+    Every frame goes straight to the metrics and the image/video writers, nothing is kept per frame.
+    The writers run on background threads while the next frame renders.
     '''
     # init
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')    
     assert len(render_poses) == len(HW) and len(HW) == len(Ks)
 
-    ari_metrics = utils.ARI()
+    ari_metrics = utils.metrics.AriAccumulator()
 
     
     if batch is not None:
@@ -99,49 +131,41 @@ def render_viewpoints(model, render_poses, HW, Ks, frame_times, ndc, render_kwar
         HW //= render_factor
         Ks[:, :2, :3] //= render_factor
 
-    rgbs = []
-    depths = []
-    segmentations = []
     psnrs = []
     ssims = []
     lpips_alex = []
     lpips_vgg = []   
     mses = []
 
-    eps_render = time.time()
-    for i, c2w in enumerate(tqdm(render_poses)):
-
-        H, W = HW[i]
-        K = Ks[i]
-        frame_time = frame_times[i].to(device)
-        rays_o, rays_d, viewdirs = VoxelMlp.get_rays_of_a_view(
-                H, W, K, c2w, ndc, inverse_y=render_kwargs['inverse_y'],
-                flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y)
-        keys = ['rgb_marched', 'depth', 'segmentation']
-        rays_o = rays_o.flatten(0,-2)
-        rays_d = rays_d.flatten(0,-2)
-        viewdirs = viewdirs.flatten(0,-2)
-
-        # find the neighbored timesteps motion and put them on gpu memory
-        render_result_chunks = [
-            {k: v for k, v in model(ro, rd, vd, frame_time, i, start=(frame_time==0), training_flag=False, stc_data=stc_data, first_episode=False, **render_kwargs).items() if k in keys}
-            for ro, rd, vd in zip(rays_o.split(bs, 0), rays_d.split(bs, 0), viewdirs.split(bs, 0))
-        ]
-        render_result = {
-            k: torch.cat([ret[k] for ret in render_result_chunks]).reshape(H,W,-1)
-            for k in render_result_chunks[0].keys()
-        }
-
+    render_writer = None
+    segmentations = []
+    io = utils.AsyncWriter(enabled=async_writes)
+    if savedir is not None:
+        print(f'Writing images to {savedir}')
+        render_writer = utils.RenderWriter(savedir, len(render_poses), video_name=video_name, fps=fps)
 
+    eps_render = time.time()
+    model.reset_march_stats()
+    renders = model.render_batch(
+            render_poses, Ks, HW, frame_times, ndc, bs=bs, keys=['rgb_marched', 'depth', 'segmentation'],
+            stc_data=stc_data, first_episode=False, **render_kwargs)
+    for i, render_result in tqdm(renders, total=len(render_poses)):
+        c2w = render_poses[i]
         rgb = render_result['rgb_marched'].cpu().numpy()
         depth = render_result['depth'].cpu().numpy()
 
-        rgbs.append(rgb)
-        depths.append(depth)
+        if render_writer is not None:
+            io.submit('rgb', render_writer.append, i, rgb, depth)
 
         if render_kwargs.get('segmentation', True):
             seg = render_result['segmentation'].cpu().numpy()
-            segmentations.append(seg)
+            if savedir is not None:
+                # the slot ids are small, keep them as uint8 until the visualisation is written
+                segmentations.append(seg.astype(np.uint8))
+            if batch is not None:
+                ari_metrics.update(seg[...,0], gt_segmentations[0,i])
+                if savedir is not None:
+                    io.submit('vis_seg', utils.vis_seg_frame, i, video[0,i], seg, gt_segmentations[0,i,...,None], savedir)
             
 
         if i==0:
@@ -163,26 +187,17 @@ def render_viewpoints(model, render_poses, HW, Ks, frame_times, ndc, render_kwar
     eps_render = time.time() - eps_render
     eps_time_str = f'{eps_render//3600:02.0f}:{eps_render//60%60:02.0f}:{eps_render%60:02.0f}'
     print('render: render takes ', eps_time_str)
+    if render_kwargs.get('segment_steps', 0) > 0:
+        print(f'render: early ray termination skipped {model.march_skipped_fraction()*100:5.2f}% of the samples')
 
-
-    if render_kwargs.get('segmentation', True):
-        segs = np.array(segmentations)
-        slot2label = np.zeros([segs.max()+1])
-        unique_label = np.unique(segs)
-        for label in range(unique_label.shape[0]):
-            slot2label[unique_label[label]] = label
-
+    if render_writer is not None:
+        io.submit('rgb', render_writer.close)
     if len(segmentations):
-        seg_vis = []
-        for (idx,seg) in enumerate(segmentations):
-            for i in range(slot2label.shape[0]):
-                seg_ = seg.copy()
-                seg_[seg_ == i] = slot2label[i]
-            
-            seg_vis.append(gray2rgb(seg_[...,0]))
-            skimage.io.imsave(os.path.join(savedir, f"seg_{str(idx)}.png"),seg_vis[-1])
-        seg_vis = np.array(seg_vis)
-        imageio.mimwrite(os.path.join(savedir, 'seg.mp4'), utils.to8b(seg_vis), fps=10, quality=8)
+        io.submit('seg', write_seg_vis, segmentations, savedir)
+    write_time, wait_time = io.close()
+    if savedir is not None:
+        # compare with a --sync_writes run, where the render loop waits for every write
+        print(f'render: render loop waited {wait_time:.2f}s on the image writers (writer threads busy {write_time:.2f}s)')
 
     f1 = open(os.path.join(savedir, 'result.txt'), 'w')
     if len(psnrs):
@@ -210,33 +225,97 @@ def render_viewpoints(model, render_poses, HW, Ks, frame_times, ndc, render_kwar
         
         # get ari and ari_fg
         if batch is not None and render_kwargs.get('segmentation', True):
-            segmentations = np.stack(segmentations, axis=0)[None, ..., 0]
-            ari, ari_fg = ari_metrics(segmentations, gt_segmentations)
+            ari, ari_fg = ari_metrics.compute()
             print('Testing ari/ari-fg', ari, ari_fg)
             f1.write('Testing ari/ari-fg:' + str(ari) + str(ari_fg))
-
-            if savedir is not None:
-                utils.vis_seg(video[0], segmentations[0,...,None], gt_segmentations[0,...,None], savedir)
     
     f1.close()
 
 
-    if savedir is not None:
-        os.makedirs(os.path.join(savedir, 'depth'), exist_ok=True)
-        print(f'Writing images to {savedir}')
-        for i in trange(len(rgbs)):
-            rgb8 = utils.to8b(rgbs[i])
-            depth8 = utils.to8b(1 - depths[i] / np.max(depths))
-            filename = os.path.join(savedir, '{:03d}.png'.format(i))
-            imageio.imwrite(filename, rgb8)
-
-            filename = os.path.join(savedir, 'depth', '{:03d}.png'.format(i))
-            imageio.imwrite(filename, depth8)
-
-    rgbs = np.array(rgbs)
-    depths = np.array(depths)
-
-    return rgbs, depths
+@torch.no_grad()
+def benchmark_render(model, render_poses, HW, Ks, frame_times, ndc, render_kwargs, bs=4096, **kwargs):
+    '''Time render_batch on the given views, rendering them one by one and grouped by frame time.'''
+    for group_time in [False, True]:
+        for i in range(2):  # warm up, then time
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            tic = time.time()
+            for _ in model.render_batch(render_poses, Ks, HW, frame_times, ndc, bs=bs, group_time=group_time,
+                                        first_episode=False, **render_kwargs):
+                pass
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+        eps = time.time() - tic
+        n_times = len(torch.unique(frame_times))
+        print(f'benchmark_render: group_time={group_time}: {len(render_poses)} views at {n_times} times, '
+              f'{eps:.2f}s ({eps/len(render_poses)*1000:.1f} ms/view)')
+
+
+def benchmark_rays(cfg, data_dict, iters=1000):
+    '''Time the gathering of sequential_1im_fixed batches from precomputed and on-the-fly rays.'''
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    i_train = data_dict['i_train']
+    N_rand = cfg.fine_train.N_rand
+    for on_the_fly in [False, True]:
+        ray_store = VoxelMlp.get_training_ray_store(
+                rgb_tr_ori=data_dict['images'][i_train],
+                train_poses=data_dict['poses'][i_train],
+                HW=data_dict['HW'][i_train], Ks=data_dict['Ks'][i_train],
+                ndc=cfg.data.ndc, inverse_y=cfg.data.inverse_y,
+                flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y,
+                device=device, dirs_dtype=cfg.fine_train.ray_dirs_dtype, on_the_fly=on_the_fly)
+        for i in range(2):  # warm up, then time
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            tic = time.time()
+            for step in range(iters):
+                img_i = torch.tensor(step % len(ray_store), device=device)
+                sel_r = torch.randint(ray_store.shape[1], [N_rand], device=device)
+                sel_c = torch.randint(ray_store.shape[2], [N_rand], device=device)
+                target, rays_o, rays_d, viewdirs = ray_store[img_i, sel_r, sel_c]
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+        eps = time.time() - tic
+        print(f'benchmark_rays: on_the_fly={on_the_fly}: {ray_store.nbytes()/2**20:.1f} MB, '
+              f'{eps/iters*1000:.3f} ms per batch of {N_rand} rays')
+        del ray_store
+
+
+def benchmark_amp(model, ray_store, frame_times, timesteps, cfg_train, render_kwargs, iters=300, every=25):
+    '''Train copies of the model in fp32 and in mixed precision on the same batches and compare their PSNR curves.'''
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    amp = cfg_train.get('amp', None) or ('float16' if device.type == 'cuda' else 'bfloat16')
+    steps = range(iters)
+    sampler = VoxelMlp.RaySampler(ray_store, cfg_train.ray_sampler, cfg_train.N_rand, device, steps,
+                                  frame_times=frame_times, timesteps=timesteps, prefetch=0)
+    batches = [sampler.sample(step) for step in steps]
+    curves = {}
+    for mode in [None, amp]:
+        net = copy.deepcopy(model)
+        optimizer = utils.create_optimizer_or_freeze_model(net, cfg_train, global_step=0)
+        amp_dtype, scaler = utils.create_amp({'amp': mode}, device)
+        curves[mode] = []
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        tic = time.time()
+        for step, (target, rays_o, rays_d, viewdirs, frame_time, img_i) in enumerate(batches):
+            with torch.autocast(device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                ret = net(rays_o, rays_d, viewdirs, frame_time, img_i, global_step=step, start=(frame_time==0),
+                          first_episode=(step < timesteps), **render_kwargs)
+            mse = F.mse_loss(ret['rgb_marched'], target)
+            optimizer.zero_grad(set_to_none=True)
+            scaler.scale(cfg_train.weight_main * mse).backward()
+            scaler.step(optimizer)
+            scaler.update()
+            curves[mode].append(utils.mse2psnr(mse.detach()).item())
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        eps = time.time() - tic
+        print(f'benchmark_amp: {mode or "float32"}: {eps/iters*1000:.1f} ms per iter')
+        del net, optimizer
+    for i in range(0, iters, every):
+        print(f'benchmark_amp: iter {i+every:6d} / PSNR float32 {np.mean(curves[None][i:i+every]):5.2f} / '
+              f'{amp} {np.mean(curves[amp][i:i+every]):5.2f}')
 
 
 def seed_everything():
@@ -252,7 +331,7 @@ def load_everything(args, cfg):
     '''Load images / poses / camera settings / data split.
     '''
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    data_dict = load_data_ours(cfg.data)
+    data_dict = load_data_cached(cfg.data, load_data_ours)
 
     # remove useless field
     kept_keys = {
@@ -266,6 +345,9 @@ def load_everything(args, cfg):
     # construct data tensor
     if data_dict['irregular_shape']:
         data_dict['images'] = [torch.FloatTensor(im, device='cpu') for im in data_dict['images']]
+    elif data_dict['images'].dtype == np.float16:
+        # memory-mapped from the dataset cache, zero-copy
+        data_dict['images'] = torch.from_numpy(data_dict['images'])
     else:
         data_dict['images'] = torch.FloatTensor(data_dict['images'], device='cpu')
     data_dict['poses'] = torch.Tensor(data_dict['poses'])
@@ -349,6 +431,7 @@ def scene_rep_reconstruction(args, cfg, cfg_model, cfg_train, data_dict, stage,
         model = utils.load_pretrained_model_whole(model_class, num_voxels_motion, timesteps, warp_ray, 
                                         cfg_train.static_model_path, world_motion_bound_scale, model_kwargs).to(device)
     optimizer = utils.create_optimizer_or_freeze_model(model, cfg_train, global_step=0)
+    amp_dtype, scaler = utils.create_amp(cfg_train, device)
 
     # init rendering setup
     render_kwargs = {
@@ -366,49 +449,37 @@ def scene_rep_reconstruction(args, cfg, cfg_model, cfg_train, data_dict, stage,
     # init batch rays sampler
     def gather_training_rays():
         if data_dict['irregular_shape']:
-            rgb_tr_ori = [images[i].to('cpu' if cfg.data.load2gpu_on_the_fly else device) for i in i_train]
+            rgb_tr_ori = [images[i] for i in i_train]
         else:
-            rgb_tr_ori = images[i_train].to('cpu' if cfg.data.load2gpu_on_the_fly else device)
-
-        if cfg_train.ray_sampler == 'in_maskcache':
-            rgb_tr, rays_o_tr, rays_d_tr, viewdirs_tr, imsz = VoxelMlp.get_training_rays_in_maskcache_sampling(
-                    rgb_tr_ori=rgb_tr_ori,
-                    train_poses=poses[i_train],
-                    HW=HW[i_train], Ks=Ks[i_train],
-                    ndc=cfg.data.ndc, inverse_y=cfg.data.inverse_y,
-                    flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y,
-                    model=model, render_kwargs=render_kwargs)
-        elif cfg_train.ray_sampler == 'flatten':
-            rgb_tr, rays_o_tr, rays_d_tr, viewdirs_tr, imsz = VoxelMlp.get_training_rays_flatten(
+            rgb_tr_ori = images[i_train]
+
+        ray_store = VoxelMlp.get_training_ray_store(
                 rgb_tr_ori=rgb_tr_ori,
                 train_poses=poses[i_train],
-                HW=HW[i_train], Ks=Ks[i_train], ndc=cfg.data.ndc, inverse_y=cfg.data.inverse_y,
-                flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y)
-        else:
-            rgb_tr, rays_o_tr, rays_d_tr, viewdirs_tr, imsz = VoxelMlp.get_training_rays(
-                rgb_tr=rgb_tr_ori,
-                train_poses=poses[i_train],
-                HW=HW[i_train], Ks=Ks[i_train], ndc=cfg.data.ndc, inverse_y=cfg.data.inverse_y,
-                flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y)
-        index_generator = VoxelMlp.batch_indices_generator(len(rgb_tr), cfg_train.N_rand)
-        batch_index_sampler = lambda: next(index_generator)
-        return rgb_tr, rays_o_tr, rays_d_tr, viewdirs_tr, imsz, batch_index_sampler
-
-    rgb_tr, rays_o_tr, rays_d_tr, viewdirs_tr, imsz, batch_index_sampler = gather_training_rays()
-
-    if not cfg.data.load2gpu_on_the_fly:
-        rgb_tr = rgb_tr.to(device)
-        rays_o_tr = rays_o_tr.to(device)
-        rays_d_tr = rays_d_tr.to(device)
-        viewdirs_tr = viewdirs_tr.to(device)
-        frame_times = frame_times.to(device)
+                HW=HW[i_train], Ks=Ks[i_train],
+                ndc=cfg.data.ndc, inverse_y=cfg.data.inverse_y,
+                flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y,
+                flatten=(cfg_train.ray_sampler == 'flatten'),
+                model=model if cfg_train.ray_sampler == 'in_maskcache' else None, render_kwargs=render_kwargs,
+                device='cpu' if cfg.data.load2gpu_on_the_fly else device,
+                dirs_dtype=cfg_train.ray_dirs_dtype, on_the_fly=cfg_train.rays_on_the_fly)
+        return ray_store
+
+    ray_store = gather_training_rays()
+    ray_sampler = VoxelMlp.RaySampler(
+            ray_store, cfg_train.ray_sampler, cfg_train.N_rand, device, steps=range(start, cfg_train.N_iters),
+            views=i_train, frame_times=frame_times, timesteps=timesteps,
+            precrop_iters_time=cfg_train.get('precrop_iters_time', 0), prefetch=cfg_train.prefetch_batches)
+    if args.benchmark_amp:
+        benchmark_amp(model, ray_store, frame_times, timesteps, cfg_train, render_kwargs)
 
 
     # view-count-based learning rate
     if cfg_train.pervoxel_lr:
         def per_voxel_init():
+            rays_o_tr, rays_d_tr = ray_store.dense_rays()
             cnt = model.voxel_count_views(
-                    rays_o_tr=rays_o_tr, rays_d_tr=rays_d_tr, imsz=imsz, near=near, far=far,
+                    rays_o_tr=rays_o_tr, rays_d_tr=rays_d_tr, imsz=ray_store.imsz, near=near, far=far,
                     stepsize=cfg_model.stepsize, downrate=cfg_train.pervoxel_lr_downrate,
                     irregular_shape=data_dict['irregular_shape'])
             optimizer.set_pervoxel_lr(cnt)
@@ -428,61 +499,11 @@ def scene_rep_reconstruction(args, cfg, cfg_model, cfg_train, data_dict, stage,
             optimizer = utils.create_optimizer_or_freeze_model(model, cfg_train, global_step=0)
          
         # random sample rays
-        if cfg_train.ray_sampler in ['flatten', 'in_maskcache']:
-            sel_i = batch_index_sampler()
-            target = rgb_tr[sel_i]
-            rays_o = rays_o_tr[sel_i]
-            rays_d = rays_d_tr[sel_i]
-            viewdirs = viewdirs_tr[sel_i]
-        elif cfg_train.ray_sampler == 'random':
-            sel_b = torch.randint(rgb_tr.shape[0], [cfg_train.N_rand])
-            sel_r = torch.randint(rgb_tr.shape[1], [cfg_train.N_rand])
-            sel_c = torch.randint(rgb_tr.shape[2], [cfg_train.N_rand])
-            target = rgb_tr[sel_b, sel_r, sel_c]
-            rays_o = rays_o_tr[sel_b, sel_r, sel_c]
-            rays_d = rays_d_tr[sel_b, sel_r, sel_c]
-            viewdirs = viewdirs_tr[sel_b, sel_r, sel_c]
-        elif cfg_train.ray_sampler == 'random_1im':
-            # Randomly select one image due to time step.
-            if global_step >= cfg_train.precrop_iters_time:
-                img_i = np.random.choice(i_train)
-            else:
-                skip_factor = global_step / float(cfg_train.precrop_iters_time) * len(i_train)
-                max_sample = max(int(skip_factor), 3)
-                img_i = np.random.choice(i_train[:max_sample])
-            # Require i_train order is the same as the above reordering of training images. 
-            sel_r = torch.randint(rgb_tr.shape[1], [cfg_train.N_rand])
-            sel_c = torch.randint(rgb_tr.shape[2], [cfg_train.N_rand])
-            target = rgb_tr[img_i, sel_r, sel_c]
-            rays_o = rays_o_tr[img_i, sel_r, sel_c]
-            rays_d = rays_d_tr[img_i, sel_r, sel_c]
-            viewdirs = viewdirs_tr[img_i, sel_r, sel_c]
-            frame_time = frame_times[img_i].to(target.device)
-        elif cfg_train.ray_sampler == 'sequential_1im_fixed':
-            # pdb.set_trace()
-            img_i = torch.tensor(global_step % timesteps,device = "cpu" if cfg.data.load2gpu_on_the_fly else device)   
-
-            sel_r = torch.randint(rgb_tr.shape[1], [cfg_train.N_rand]).to("cpu" if cfg.data.load2gpu_on_the_fly else device)
-            sel_c = torch.randint(rgb_tr.shape[2], [cfg_train.N_rand]).to("cpu" if cfg.data.load2gpu_on_the_fly else device)
-            target = rgb_tr[img_i, sel_r, sel_c]
-            rays_o = rays_o_tr[img_i, sel_r, sel_c]
-            rays_d = rays_d_tr[img_i, sel_r, sel_c]
-            viewdirs = viewdirs_tr[img_i, sel_r, sel_c]
-            frame_time = frame_times[img_i]
-            pose = poses[i_train][img_i]
-        else:
-            raise NotImplementedError
-
-        if cfg.data.load2gpu_on_the_fly:
-            target = target.to(device)
-            rays_o = rays_o.to(device)
-            rays_d = rays_d.to(device)
-            viewdirs = viewdirs.to(device)
-            frame_time = frame_time.to(device)
-           
+        target, rays_o, rays_d, viewdirs, frame_time, img_i = ray_sampler.sample(global_step)
 
-        # volume rendering
-        render_result = model(rays_o, rays_d, viewdirs, frame_time, img_i, global_step=global_step, start=(frame_time==0), first_episode=(int(global_step/timesteps)==0), **render_kwargs)
+        # volume rendering, the MLPs and the slot encoder run in amp_dtype, their outputs and the rendering in fp32
+        with torch.autocast(device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+            render_result = model(rays_o, rays_d, viewdirs, frame_time, img_i, global_step=global_step, start=(frame_time==0), first_episode=(int(global_step/timesteps)==0), **render_kwargs)
 
         # gradient descent step
         optimizer.zero_grad(set_to_none=True)
@@ -504,7 +525,8 @@ def scene_rep_reconstruction(args, cfg, cfg_model, cfg_train, data_dict, stage,
             
         
        
-        loss.backward()
+        scaler.scale(loss).backward()
+        scaler.unscale_(optimizer)  # before the total variation grads are added
 
         writer.add_scalar('train/loss', loss.item(), global_step) 
         writer.add_scalar('train/psnr', psnr, global_step)
@@ -520,7 +542,8 @@ def scene_rep_reconstruction(args, cfg, cfg_model, cfg_train, data_dict, stage,
                 model.density_total_variation_add_grad(
                     cfg_train.weight_tv_density/len(rays_o), global_step<cfg_train.tv_dense_before)
 
-        optimizer.step()
+        scaler.step(optimizer)
+        scaler.update()
         psnr_lst.append(psnr.item())   
 
         # update lr
@@ -537,6 +560,23 @@ def scene_rep_reconstruction(args, cfg, cfg_model, cfg_train, data_dict, stage,
                        f'Loss: {loss.item():.9f} / PSNR: {np.mean(psnr_lst):5.2f} / '
                        f'Eps: {eps_time_str}')
             psnr_lst = []
+            if model.occupancy_grid is not None:
+                culled = model.occupancy_grid.culled_fraction()
+                writer.add_scalar('train/culled_fraction', culled, global_step)
+                tqdm.write(f'scene_rep_reconstruction ({stage}): occupancy grid culled {culled*100:5.2f}% of the samples')
+                model.occupancy_grid.reset_stats()
+            if model.density_cache is not None:
+                hit_rate, saved = model.density_cache_stats()
+                writer.add_scalar('train/density_cache_hit_rate', hit_rate, global_step)
+                writer.add_scalar('train/density_cache_time_saved', saved, global_step)
+                tqdm.write(f'scene_rep_reconstruction ({stage}): density cache hit rate {hit_rate*100:5.2f}% / '
+                           f'saved {saved*1000:.1f} ms per iter')
+                model.reset_density_cache_stats()
+            stall, make = ray_sampler.stats()
+            writer.add_scalar('train/ray_sampler_stall', stall, global_step)
+            tqdm.write(f'scene_rep_reconstruction ({stage}): ray sampler stalled {stall*1000:.2f} ms per iter / '
+                       f'batches take {make*1000:.2f} ms to assemble')
+            ray_sampler.reset_stats()
 
         if (global_step+1)%args.i_weights==0:
             path = os.path.join(cfg.basedir, cfg.expname, f'{stage}_{global_step:06d}.tar')
@@ -549,6 +589,7 @@ def scene_rep_reconstruction(args, cfg, cfg_model, cfg_train, data_dict, stage,
             print(f'scene_rep_reconstruction ({stage}): saved checkpoints at', path)
             test(args, cfg, str(global_step), model, writer, cfg_train.N_iters)
 
+    ray_sampler.close()
 
     if global_step != -1:
         torch.save({
@@ -601,60 +642,51 @@ def test(args, cfg, stage, model, writer, N_iters):
                 'render_depth': True,
                 'num_slots':cfg.fine_model_and_render.max_instances,
                 'segmentation': False,
+                'segment_steps': cfg.fine_model_and_render.segment_steps,
                 # TODO segmentation -- shape
             },
+            'async_writes': not args.sync_writes,
         }
 
     if args.render_train: 
 
         testsavedir = os.path.join(cfg.basedir, cfg.expname, f'render_train_{stage}')
         os.makedirs(testsavedir, exist_ok=True)
-        rgbs, depths = render_viewpoints(
+        render_viewpoints(
                 render_poses=data_dict['poses'][data_dict['i_train']],
                 HW=data_dict['HW'][data_dict['i_train']],
                 Ks=data_dict['Ks'][data_dict['i_train']],
                 frame_times=data_dict['times'][data_dict['i_train']],
-                gt_imgs=[data_dict['images'][i].cpu().numpy() for i in data_dict['i_train']],
+                gt_imgs=[data_dict['images'][i].float().numpy() for i in data_dict['i_train']],
                 savedir=testsavedir,
                 # batch = batch,
                 bs=args.bs,
                 eval_ssim=args.eval_ssim, eval_lpips_alex=args.eval_lpips_alex, eval_lpips_vgg=args.eval_lpips_vgg,
                 **render_viewpoints_kwargs)
-        
-        rgb_video = 'video.rgb.mp4'
-        depth_video = 'video.depth.mp4'
-        shape_video = 'video.shape.mp4'
-        imageio.mimwrite(os.path.join(testsavedir, rgb_video), utils.to8b(rgbs), fps=10, quality=8)
-        imageio.mimwrite(os.path.join(testsavedir, depth_video), utils.to8b(1 - depths / np.max(depths)), fps=10, quality=8)
 
 
     # render testset and eval
     if args.render_test:            
         testsavedir = os.path.join(cfg.basedir, cfg.expname, f'render_test_{stage}')
         os.makedirs(testsavedir, exist_ok=True)
-        rgbs, depths = render_viewpoints(
+        render_viewpoints(
                 render_poses=data_dict['poses'][data_dict['i_test']],
                 HW=data_dict['HW'][data_dict['i_test']],
                 Ks=data_dict['Ks'][data_dict['i_test']],
                 frame_times=data_dict['times'][data_dict['i_test']],
-                gt_imgs=[data_dict['images'][i].cpu().numpy() for i in data_dict['i_test']],
+                gt_imgs=[data_dict['images'][i].float().numpy() for i in data_dict['i_test']],
                 savedir=testsavedir,
                 bs=args.bs,
                 eval_ssim=args.eval_ssim, eval_lpips_alex=args.eval_lpips_alex, eval_lpips_vgg=args.eval_lpips_vgg,
                 writer=writer, gs=int(stage),
                 **render_viewpoints_kwargs)
 
-        rgb_video = 'video.rgb.mp4'
-        depth_video = 'video.depth.mp4'
-        shape_video = 'video.shape.mp4'
-        imageio.mimwrite(os.path.join(testsavedir, rgb_video), utils.to8b(rgbs), fps=10, quality=8)
-        imageio.mimwrite(os.path.join(testsavedir, depth_video), utils.to8b(1 - depths / np.max(depths)), fps=10, quality=8)
 
     # render video
     if args.render_video:
         testsavedir = os.path.join(cfg.basedir, cfg.expname, f'render_video_{stage}')
         os.makedirs(testsavedir, exist_ok=True)
-        rgbs, depths = render_viewpoints(
+        render_viewpoints(
                 render_poses=data_dict['render_poses'],
                 HW=data_dict['HW'][data_dict['i_test']][[0]].repeat(len(data_dict['render_poses']), 0),
                 Ks=data_dict['Ks'][data_dict['i_test']][[0]].repeat(len(data_dict['render_poses']), 0),
@@ -662,9 +694,8 @@ def test(args, cfg, stage, model, writer, N_iters):
                 render_factor=args.render_video_factor,
                 bs=args.bs,
                 savedir=testsavedir,
+                fps=30,
                 **render_viewpoints_kwargs)
-        imageio.mimwrite(os.path.join(testsavedir, 'video.rgb.mp4'), utils.to8b(rgbs), fps=30, quality=8)
-        imageio.mimwrite(os.path.join(testsavedir, 'video.depth.mp4'), utils.to8b(1 - depths / np.max(depths)), fps=30, quality=8)
 
 
 
@@ -705,13 +736,17 @@ if __name__=='__main__':
         print('done')
         sys.exit()
 
+    if args.benchmark_rays:
+        benchmark_rays(cfg, data_dict)
+        sys.exit()
+
 
     # train
     if not args.render_only:
         train(args, cfg, data_dict)
 
     # load model for rendring
-    if args.render_test or args.render_train or args.render_video:
+    if args.render_test or args.render_train or args.render_video or args.benchmark_render:
         if args.ft_path:
             ckpt_path = args.ft_path
         else:
@@ -736,10 +771,20 @@ if __name__=='__main__':
                 'flip_y': cfg.data.flip_y,
                 'render_depth': True,
                 'num_slots':cfg.fine_model_and_render.max_instances,
-                'segmentation': args.eval_ari
+                'segmentation': args.eval_ari,
+                'segment_steps': cfg.fine_model_and_render.segment_steps,
             },
+            'async_writes': not args.sync_writes,
         }
 
+    if args.benchmark_render:
+        benchmark_render(
+                render_poses=data_dict['poses'][data_dict['i_train']],
+                HW=data_dict['HW'][data_dict['i_train']],
+                Ks=data_dict['Ks'][data_dict['i_train']],
+                frame_times=data_dict['times'][data_dict['i_train']],
+                bs=args.bs,
+                **render_viewpoints_kwargs)
     
     if args.render_train:
         if args.eval_ari: 
@@ -756,24 +801,18 @@ if __name__=='__main__':
         
         testsavedir = os.path.join(cfg.basedir, cfg.expname, f'render_train_{ckpt_name}')
         os.makedirs(testsavedir, exist_ok=True)
-        rgbs, depths = render_viewpoints(
+        render_viewpoints(
                 render_poses=data_dict['poses'][data_dict['i_train']],
                 HW=data_dict['HW'][data_dict['i_train']],
                 Ks=data_dict['Ks'][data_dict['i_train']],
                 frame_times=data_dict['times'][data_dict['i_train']],
-                gt_imgs=[data_dict['images'][i].cpu().numpy() for i in data_dict['i_train']],
+                gt_imgs=[data_dict['images'][i].float().numpy() for i in data_dict['i_train']],
                 savedir=testsavedir,
                 eval_ssim=args.eval_ssim, eval_lpips_alex=args.eval_lpips_alex, eval_lpips_vgg=args.eval_lpips_vgg,
                 batch=batch,
                 bs=args.bs,
                 stc_data=False,
                 **render_viewpoints_kwargs)
-        
-        rgb_video = 'video.rgb.mp4'
-        depth_video = 'video.depth.mp4'
-        shape_video = 'video.shape.mp4'
-        imageio.mimwrite(os.path.join(testsavedir, rgb_video), utils.to8b(rgbs), fps=10, quality=8)
-        imageio.mimwrite(os.path.join(testsavedir, depth_video), utils.to8b(1 - depths / np.max(depths)), fps=10, quality=8)
 
 
     # render testset and eval
@@ -792,12 +831,12 @@ if __name__=='__main__':
 
         testsavedir = os.path.join(cfg.basedir, cfg.expname, f'render_test_{ckpt_name}')
         os.makedirs(testsavedir, exist_ok=True)
-        rgbs, depths = render_viewpoints(
+        render_viewpoints(
                 render_poses=data_dict['poses'][data_dict['i_test']],
                 HW=data_dict['HW'][data_dict['i_test']],
                 Ks=data_dict['Ks'][data_dict['i_test']],
                 frame_times=data_dict['times'][data_dict['i_test']],
-                gt_imgs=[data_dict['images'][i].cpu().numpy() for i in data_dict['i_test']],
+                gt_imgs=[data_dict['images'][i].float().numpy() for i in data_dict['i_test']],
                 savedir=testsavedir,
                 eval_ssim=args.eval_ssim, eval_lpips_alex=args.eval_lpips_alex, eval_lpips_vgg=args.eval_lpips_vgg,
                 batch=batch,
@@ -805,17 +844,12 @@ if __name__=='__main__':
                 stc_data=False,
                 **render_viewpoints_kwargs)
 
-        rgb_video = 'video.rgb.mp4'
-        depth_video = 'video.depth.mp4'
-        shape_video = 'video.shape.mp4'
-        imageio.mimwrite(os.path.join(testsavedir, rgb_video), utils.to8b(rgbs), fps=10, quality=8)
-        imageio.mimwrite(os.path.join(testsavedir, depth_video), utils.to8b(1 - depths / np.max(depths)), fps=10, quality=8)
 
     # render video
     if args.render_video:
         testsavedir = os.path.join(cfg.basedir, cfg.expname, f'render_video_{ckpt_name}')
         os.makedirs(testsavedir, exist_ok=True)
-        rgbs, depths = render_viewpoints(
+        render_viewpoints(
                 render_poses=data_dict['poses'][data_dict['i_test']][1].repeat(60,1,1),
                 HW=data_dict['HW'][data_dict['i_test']][[0]].repeat(len(data_dict['render_poses']), 0),
                 Ks=data_dict['Ks'][data_dict['i_test']][[0]].repeat(len(data_dict['render_poses']), 0),
@@ -824,9 +858,8 @@ if __name__=='__main__':
                 savedir=testsavedir,
                 stc_data=False,
                 bs=args.bs,
+                video_name='videofixed', fps=30,
                 **render_viewpoints_kwargs)
-        imageio.mimwrite(os.path.join(testsavedir, 'videofixed.rgb.mp4'), utils.to8b(rgbs), fps=30, quality=8)
-        imageio.mimwrite(os.path.join(testsavedir, 'videofixed.depth.mp4'), utils.to8b(1 - depths / np.max(depths)), fps=30, quality=8)
 
     print('Done')
 
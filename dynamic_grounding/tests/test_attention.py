@@ -0,0 +1,85 @@
+'''Equivalence of the sparse voxel encoder and the chunked attention with their dense versions.'''
+import pytest
+import torch
+import torch.nn.functional as F
+
+from lib_extra.attention import SlotAttention
+
+
+def blob_grid(res, voxel_dim, occupancy=0.05, seed=0):
+    '''A few dense blobs in pruned (-100) space.'''
+    g = torch.Generator().manual_seed(seed)
+    noise = F.interpolate(torch.rand([1, 1, 6, 6, 6], generator=g), size=(res, res, res), mode='trilinear')
+    occupied = noise > noise.flatten().sort()[0][int(noise.numel() * (1 - occupancy))]
+    grid = torch.randn([1, voxel_dim, res, res, res], generator=g)
+    return torch.where(occupied, grid, torch.full_like(grid, -100.))
+
+
+def run(model, sparse, grid, slots):
+    model.sparse = sparse
+    model.zero_grad()
+    out, _ = model(slots, grid)
+    out.sum().backward()
+    return out.detach(), [p.grad.clone() for p in model.voxel_encoder.parameters()]
+
+
+def check_sparse_matches_dense(grid, kernel_size, stride):
+    torch.manual_seed(0)
+    model = SlotAttention(voxel_dim=grid.shape[1], in_dim=16, kernel_size=kernel_size, stride=stride, sparse_chunk=512)
+    slots = torch.randn(1, grid.shape[1], 64)
+    with torch.no_grad():
+        model.sparse = False
+        feat_dense, _ = model.encode(grid)
+        model.sparse = True
+        feat_sparse, count = model.encode(grid)
+    # the sparse features are a coordinate list, compare their sums over the grid
+    torch.testing.assert_close((feat_sparse * count[..., None]).sum(1), feat_dense.sum(1), rtol=1e-4, atol=1e-3)
+
+    dense, grads_dense = run(model, False, grid, slots)
+    sparse, grads_sparse = run(model, True, grid, slots)
+    torch.testing.assert_close(sparse, dense, rtol=1e-4, atol=1e-4)
+    for g_sparse, g_dense in zip(grads_sparse, grads_dense):
+        assert (g_sparse - g_dense).norm() <= 1e-4 * g_dense.norm()
+
+
+def test_sparse_encoder_matches_dense():
+    check_sparse_matches_dense(blob_grid(40, 4), kernel_size=5, stride=2)
+
+
+def test_sparse_encoder_matches_dense_stride1():
+    check_sparse_matches_dense(blob_grid(20, 3), kernel_size=3, stride=1)
+
+
+def test_sparse_encoder_only_skips_the_sentinel():
+    # values close to, but not equal to, the sentinel are occupied space
+    grid = blob_grid(40, 4)
+    grid[:, :, 4:24, 4:24, 4:24] = -99.5
+    check_sparse_matches_dense(grid, kernel_size=5, stride=2)
+
+
+@pytest.mark.parametrize('use_checkpoint', [False, True])
+@pytest.mark.parametrize('with_count', [False, True])
+def test_chunked_attention_matches_full(use_checkpoint, with_count):
+    torch.manual_seed(0)
+    model = SlotAttention(voxel_dim=4, in_dim=32)
+    slots = torch.randn(1, 4, 64)
+    feat = torch.randn(1, 5000, 32)
+    count = torch.randint(1, 4, [1, 5000]).float() if with_count else None
+
+    def run(chunk):
+        model.chunk, model.use_checkpoint = chunk, use_checkpoint
+        model.zero_grad()
+        f = feat.clone().requires_grad_()
+        out, attn = model(slots, feat=f, count=count)
+        out.sum().backward()
+        return out.detach(), f.grad, attn
+
+    full, grad_full, attn_full = run(0)
+    out, grad, attn = run(1024)
+    assert attn is None and attn_full is not None
+    torch.testing.assert_close(out, full, rtol=1e-4, atol=1e-4)
+    assert (grad - grad_full).norm() <= 1e-4 * grad_full.norm()
+
+    with torch.no_grad():
+        _, attn = model(slots, feat=feat, count=count, return_attn=True)
+    torch.testing.assert_close(attn, attn_full.detach(), rtol=1e-4, atol=1e-5)
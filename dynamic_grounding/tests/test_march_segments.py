@@ -0,0 +1,37 @@
+'''The segmented ray marching of inference renders matches the single pass.'''
+import pytest
+import torch
+
+pytest.importorskip('torch_scatter')
+from lib import voxelMlp
+
+
+def make_model():
+    torch.manual_seed(0)
+    kwargs = dict(n_freq=5, n_freq_view=5, z_dim=32, n_layers=2, out_ch=3, max_instances=1, n_freq_t=5, n_freq_time=5,
+                  timenet_layers=4, timenet_hidden=64, skips=[2])
+    kwargs.update(max_instances=3, encoder_dim=16, num_iterations=2, hidden=32, kernel_size=5, stride=2, timesteps=4)
+    model = voxelMlp.VoxelMlp([-1,-1,-1], [1,1,1], num_voxels=32**3, num_voxels_base=32**3,
+                              alpha_init=1e-2, fast_color_thres=1e-4, **kwargs)
+    with torch.no_grad():
+        # opaque enough for most rays to terminate inside a segment
+        model.density.fill_(-5)
+        model.density[..., 6:26, 6:26, 9:23] = 8
+    return model
+
+
+@pytest.mark.parametrize('segment_steps', [4, 16, 64])
+def test_march_segments_matches_single_pass(segment_steps):
+    model = make_model()
+    rays_o = torch.tensor([[0., 0., -4.]]).repeat(1024, 1) + torch.randn(1024, 3) * 0.4
+    rays_d = torch.tensor([[0., 0., 1.]]) + torch.randn(1024, 3) * 0.15
+    viewdirs = rays_d / rays_d.norm(dim=-1, keepdim=True)
+    render_kwargs = dict(near=0.1, far=10., stepsize=0.5, bg=1, render_depth=True)
+    with torch.no_grad():
+        ref = model(rays_o, rays_d, viewdirs, torch.tensor(0.5), 1, training_flag=False, segment_steps=0, **render_kwargs)
+        out = model(rays_o, rays_d, viewdirs, torch.tensor(0.5), 1, training_flag=False, segment_steps=segment_steps, **render_kwargs)
+    assert model.march_skipped_fraction() > 0
+    for k in ['rgb_marched', 'alphainv_last', 'depth']:
+        torch.testing.assert_close(out[k], ref[k], rtol=1e-5, atol=1e-4)
+    assert torch.equal(out['ray_id'], ref['ray_id'])
+    torch.testing.assert_close(out['weights'], ref['weights'], rtol=1e-5, atol=1e-6)
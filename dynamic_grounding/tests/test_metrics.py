@@ -0,0 +1,67 @@
+'''NumPy ARI metrics against hand-computed values and the JAX reference.'''
+import numpy as np
+import pytest
+
+from lib_extra.metrics import adjusted_rand_index, AriAccumulator
+
+
+# true [0,0,0,1,1,1] / pred [0,0,1,1,2,2]: pairs 2, rows 6, cols 3 out of 15,
+# ARI = (2 - 6*3/15) / ((6+3)/2 - 6*3/15) = 8/33. Without the background row, ARI = 0.
+TRUE = np.array([[0, 0, 0, 1, 1, 1]])
+PRED = np.array([[0, 0, 1, 1, 2, 2]])
+
+
+def test_ari_hand_computed():
+    np.testing.assert_allclose(adjusted_rand_index(TRUE, PRED, 2, 3), [8/33], rtol=1e-6)
+    np.testing.assert_allclose(adjusted_rand_index(TRUE, PRED, 2, 3, ignore_background=True), [0.], atol=1e-7)
+
+
+def test_ari_permuted_labels_and_trivial_clusterings():
+    true_ids = np.array([[0, 0, 1, 1, 2]])
+    np.testing.assert_allclose(adjusted_rand_index(true_ids, (true_ids + 1) % 3, 3, 3), [1.])
+    zeros = np.zeros([1, 5], dtype=np.int64)
+    np.testing.assert_allclose(adjusted_rand_index(zeros, zeros, 1, 1), [1.])
+    ids = np.arange(5)[None]
+    np.testing.assert_allclose(adjusted_rand_index(ids, ids, 5, 5), [1.])
+
+
+def test_ari_padding_mask():
+    # dropping the last pixel: pairs 1, rows 4, cols 2 out of 10, ARI = (1 - 0.8) / (3 - 0.8) = 1/11
+    mask = np.array([[1, 1, 1, 1, 1, 0]])
+    np.testing.assert_allclose(adjusted_rand_index(TRUE, PRED, 2, 3, padding_mask=mask), [1/11], rtol=1e-6)
+
+
+def test_ari_batch():
+    true_ids = np.concatenate([TRUE, TRUE])
+    pred_ids = np.concatenate([PRED, TRUE])
+    np.testing.assert_allclose(adjusted_rand_index(true_ids, pred_ids, 2, 3), [8/33, 1.], rtol=1e-6)
+
+
+def test_ari_accumulator():
+    # frame by frame, with the ids growing across frames
+    acc = AriAccumulator()
+    acc.update(PRED[:, :3], TRUE[:, :3])
+    acc.update(PRED[:, 3:], TRUE[:, 3:])
+    ari, fg_ari = acc.compute()
+    np.testing.assert_allclose(ari, 8/33, rtol=1e-6)
+    np.testing.assert_allclose(fg_ari, 0., atol=1e-7)
+
+
+def test_ari_matches_metrics_jax():
+    jnp = pytest.importorskip('jax.numpy')
+    pytest.importorskip('flax')
+    pytest.importorskip('clu')
+    import lib_extra.metrics_jax as metrics_jax
+
+    rng = np.random.default_rng(0)
+    for trial in range(100):
+        shape = [rng.integers(1, 3), rng.integers(1, 5), rng.integers(1, 20), rng.integers(1, 20)]
+        true_ids = rng.integers(0, rng.integers(1, 6), shape)
+        pred_ids = rng.integers(0, rng.integers(1, 6), shape) if trial % 5 else (true_ids * 7 + 3) % 11
+        padding_mask = (rng.random(shape) > 0.2).astype(np.int64)
+        for ignore_background in [False, True]:
+            args = (int(true_ids.max()) + 1, int(pred_ids.max()) + 1)
+            ref = metrics_jax.adjusted_rand_index(jnp.asarray(true_ids), jnp.asarray(pred_ids), *args,
+                                                  padding_mask=jnp.asarray(padding_mask), ignore_background=ignore_background)
+            out = adjusted_rand_index(true_ids, pred_ids, *args, padding_mask=padding_mask, ignore_background=ignore_background)
+            np.testing.assert_allclose(out, np.asarray(ref), rtol=1e-6, atol=1e-6)
@@ -22,6 +22,9 @@ data = dict(
     height=None,                  # enforce image height
     llffhold=8,                   # testsplit
     load_depths=False,            # load depth
+    cache_dir=None,               # keep the decoded blender images here (float16, memory-mapped), None to disable.
+                                  # Cached runs train on float16-rounded targets, not bit-identical to uncached runs
+    load_workers=None,            # threads decoding the blender/llff images, None for min(8, #cpus), 0 to decode serially
      llffhold_view=4,              # test v
 )
 
@@ -42,6 +45,11 @@ fine_train = dict(
     lrdecay_scale=1e-1,                             # the lrate decay scale for the final fine stage
     pervoxel_lr=False,                              # view-count-based lr
     ray_sampler='sequential_1im_fixed',             # ray sampling strategies
+    ray_dirs_dtype='float32',                       # dtype of the stored ray directions, float16 halves them (not bit-exact)
+    rays_on_the_fly=False,                          # store only the images and cameras and compute the rays of each batch
+    prefetch_batches=4,                             # batches assembled ahead on a background thread, 0 to draw them in the loop
+    fuse_static_forward=False,                      # render the dynamic and static batches in one forward pass (check with --benchmark_fused first)
+    amp=None,                                       # None | 'float16' | 'bfloat16', autocast the MLPs and convolutions (bfloat16 on CPU)
     weight_main=1.0,                                # weight of photometric loss
     weight_entropy_last=0.01,                       # weight of background entropy loss
     weight_rgbper=0.1,                              # weight of per-point rgb loss
@@ -85,9 +93,15 @@ fine_model_and_render = dict(
     warp_ray=True,                                  # warp ray or warp voxel
     alpha_init=1e-2,                                # set the alpha values everywhere at the begin of training
     fast_color_thres=1e-4,                          # threshold of alpha value to skip the fine stage sampled point
+    fused_decoder=False,                            # cached sin/cos embeddings and one MLP graph in the decoder
+    compile_decoder=None,                           # None | 'script' | 'compile', TorchScript or torch.compile the fused decoder MLP
+    occupancy_grid=False,                           # skip the samples in free space with a coarse occupancy grid (approximate under large deformations)
+    occupancy_downrate=4,                           # number of voxels per occupancy cell along each axis
+    occupancy_every=256,                            # rebuild the occupancy grids of all the frames every N steps
     maskout_near_cam_vox=False,                     # maskout grid points that between cameras and their near planes
     world_motion_bound_scale=1.0,                   # rescale the Motion BBox enclosing the scene
     stepsize=0.5,                                   # sampling stepsize in volume rendering
+    segment_steps=32,                               # steps per marching segment for early ray termination at inference (0 to disable)
 )
 
 del deepcopy
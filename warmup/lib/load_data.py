@@ -1,4 +1,6 @@
+import os, glob, json, hashlib
 import numpy as np
+import torch
 
 from .load_llff import load_llff_data
 from .load_blender import load_blender_data, load_blender_data_woflow
@@ -14,7 +16,7 @@ def load_data_ours(args):
                 args.datadir, args.factor,
                 recenter=True, bd_factor=.75,
                 spherify=args.spherify,
-                load_depths=args.load_depths)
+                load_depths=args.load_depths, num_workers=args.get('load_workers'))
         hwf = poses[0,:3,-1]
         poses = poses[:,:3,:4]
         # flows_b = np.moveaxis(flows_b, -1, 0).astype(np.float32)
@@ -61,7 +63,7 @@ def load_data_ours(args):
 
     elif args.dataset_type == 'blender':
         # images, poses, times, render_poses, render_times, hwf, i_split, flows_b, flow_masks_b = load_blender_data(args.datadir, args.half_res, args.testskip)
-        images, poses, times, render_poses, render_times, hwf, i_split = load_blender_data_woflow(args.datadir, args.half_res, args.testskip)
+        images, poses, times, render_poses, render_times, hwf, i_split = load_blender_data_woflow(args.datadir, args.half_res, args.testskip, args.get('load_workers'))
         print('Loaded blender', images.shape, render_poses.shape, hwf, args.datadir)
 
         i_train, i_val, i_test = i_split
@@ -128,7 +130,7 @@ def load_data(args):
                 args.datadir, args.factor,
                 recenter=True, bd_factor=.75,
                 spherify=args.spherify,
-                load_depths=args.load_depths)
+                load_depths=args.load_depths, num_workers=args.get('load_workers'))
         hwf = poses[0,:3,-1]
         poses = poses[:,:3,:4]
         #flows_b = np.moveaxis(flows_b, -1, 0).astype(np.float32)
@@ -165,7 +167,7 @@ def load_data(args):
         print('NEAR FAR', near, far)
 
     elif args.dataset_type == 'blender':
-        images, poses, times, render_poses, render_times, hwf, i_split, flows_b, flow_masks_b = load_blender_data(args.datadir, args.half_res, args.testskip)
+        images, poses, times, render_poses, render_times, hwf, i_split, flows_b, flow_masks_b = load_blender_data(args.datadir, args.half_res, args.testskip, args.get('load_workers'))
         print('Loaded blender', images.shape, render_poses.shape, hwf, args.datadir)
 
         i_train, i_val, i_test = i_split
@@ -218,6 +220,67 @@ def load_data(args):
     )
     return data_dict
 
+
+def _blender_files(datadir):
+    '''Files read by the blender loaders: the transforms, the frames they list and the flows.'''
+    transforms = sorted(glob.glob(os.path.join(datadir, 'transforms_*.json')))
+    files = list(transforms)
+    for path in transforms:
+        with open(path) as f:
+            frames = json.load(f).get('frames', [])
+        files += [os.path.join(datadir, frame['file_path'] + '.png') for frame in frames if 'file_path' in frame]
+    return files + sorted(glob.glob(os.path.join(datadir, 'train_flow', '*')))
+
+
+def _files_signature(paths):
+    h = hashlib.sha1()
+    for path in paths:
+        st = os.stat(path) if os.path.exists(path) else None
+        h.update(f'{path}:{st and st.st_mtime_ns}:{st and st.st_size}\n'.encode())
+    return h.hexdigest()
+
+
+def load_data_cached(args, loader):
+    '''Run loader(args) once and keep its data_dict under args.cache_dir (blender only).
+    The images are stored in float16 and every array is memory-mapped on the next runs,
+    instead of decoding and resizing the PNGs again. The cache is keyed by the mtime and size
+    of every file the loader reads, so re-exported frames are converted again.
+    '''
+    if not args.get('cache_dir') or args.dataset_type != 'blender':
+        return loader(args)
+
+    key = dict(loader=loader.__name__, datadir=os.path.abspath(args.datadir), half_res=args.half_res,
+               white_bkgd=args.white_bkgd, testskip=args.testskip,
+               files=_files_signature(_blender_files(args.datadir)))
+    cachedir = os.path.join(args.cache_dir, hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16])
+    meta_path = os.path.join(cachedir, 'meta.json')
+
+    if not os.path.exists(meta_path):
+        data_dict = loader(args)
+        os.makedirs(cachedir, exist_ok=True)
+        meta = dict(key=key, values={}, arrays={})
+        for k, v in data_dict.items():
+            if isinstance(v, (np.ndarray, torch.Tensor)) and v.dtype != object:
+                meta['arrays'][k] = isinstance(v, torch.Tensor)
+                v = np.asarray(v)
+                np.save(os.path.join(cachedir, f'{k}.npy'), v.astype(np.float16) if k == 'images' else v)
+            else:
+                meta['values'][k] = v
+        # written last, an interrupted conversion is redone on the next run
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump(meta, f, default=lambda v: v.item())
+        os.replace(meta_path + '.tmp', meta_path)
+        print(f'load_data_cached: {loader.__name__} {args.datadir} cached to {cachedir}')
+
+    with open(meta_path) as f:
+        meta = json.load(f)
+    data_dict = dict(meta['values'])
+    for k, is_tensor in meta['arrays'].items():
+        v = np.load(os.path.join(cachedir, f'{k}.npy'), mmap_mode='c')
+        data_dict[k] = torch.from_numpy(v) if is_tensor else v
+    return data_dict
+
+
 def get_grid(H, W, num_img, flows_b, flow_masks_b):
 
     # |--------------------|  |--------------------|
@@ -0,0 +1,26 @@
+import os, time
+from concurrent.futures import ThreadPoolExecutor
+
+import imageio
+
+
+DEFAULT_WORKERS = min(8, os.cpu_count() or 1)
+
+
+def load_images(files, reader=imageio.imread, num_workers=None):
+    '''Decode the image files with a pool of threads, the images are returned in the order of files.
+    PIL and imageio release the GIL while decoding, so threads scale without pickling the frames back.
+    @num_workers: size of the pool, None for DEFAULT_WORKERS, 0 or 1 to decode in this thread.
+    '''
+    files = list(files)
+    num_workers = DEFAULT_WORKERS if num_workers is None else num_workers
+    tic = time.time()
+    if num_workers > 1 and len(files) > 1:
+        with ThreadPoolExecutor(min(num_workers, len(files))) as pool:
+            imgs = list(pool.map(reader, files))
+    else:
+        imgs = [reader(f) for f in files]
+    eps = max(time.time() - tic, 1e-6)
+    mbytes = sum(getattr(im, 'nbytes', 0) for im in imgs) / 2**20
+    print(f'load_images: {len(files)} images in {eps:.2f}s ({len(files)/eps:.1f} img/s, {mbytes/eps:.1f} MB/s, {max(num_workers, 1)} workers)')
+    return imgs
@@ -1,4 +1,4 @@
-import os, math
+import os, math, time, queue, threading
 import numpy as np
 import scipy.signal
 from typing import List, Optional
@@ -12,6 +12,7 @@ from .masked_adam import MaskedAdam
 import matplotlib.pyplot as plt
 from skimage.color import label2rgb
 import cv2
+import imageio
 
 from typing import Sequence, Union
 Array = Union[np.ndarray, torch.Tensor]
@@ -26,6 +27,114 @@ mse2psnr = lambda x : -10. * torch.log10(x)
 to8b = lambda x : (255*np.clip(x,0,1)).astype(np.uint8)
 
 
+class RenderWriter:
+    '''Write the rendered frames as they come, to PNGs and to the rgb/depth videos.
+    The depth maps are normalized by their max over the whole sequence, so they are
+    spilled to a memory-mapped file and written out on close().
+    '''
+    def __init__(self, savedir, n_frames, video_name='video', fps=10, depth_png=True):
+        self.savedir = savedir
+        self.n_frames = n_frames
+        self.video_name = video_name
+        self.fps = fps
+        self.depth_png = depth_png
+        self.rgb_video = None
+        self.depths = None
+        self.depth_max = -np.inf
+
+    def append(self, i, rgb, depth):
+        rgb8 = to8b(rgb)
+        imageio.imwrite(os.path.join(self.savedir, '{:03d}.png'.format(i)), rgb8)
+        if self.rgb_video is None:
+            self.rgb_video = imageio.get_writer(
+                    os.path.join(self.savedir, f'{self.video_name}.rgb.mp4'), fps=self.fps, quality=8)
+            self.depths = np.lib.format.open_memmap(
+                    os.path.join(self.savedir, f'{self.video_name}.depth.npy'), mode='w+',
+                    dtype=np.float32, shape=(self.n_frames, *depth.shape))
+        self.rgb_video.append_data(rgb8)
+        self.depths[i] = depth
+        self.depth_max = max(self.depth_max, float(depth.max()))
+
+    def close(self):
+        if self.rgb_video is None:
+            return
+        self.rgb_video.close()
+        if self.depth_png:
+            os.makedirs(os.path.join(self.savedir, 'depth'), exist_ok=True)
+        depth_video = imageio.get_writer(
+                os.path.join(self.savedir, f'{self.video_name}.depth.mp4'), fps=self.fps, quality=8)
+        for i in range(self.n_frames):
+            depth8 = to8b(1 - self.depths[i] / self.depth_max)
+            if self.depth_png:
+                imageio.imwrite(os.path.join(self.savedir, 'depth', '{:03d}.png'.format(i)), depth8)
+            depth_video.append_data(depth8)
+        depth_video.close()
+        path = self.depths.filename
+        self.rgb_video = self.depths = None
+        os.remove(path)
+
+
+class AsyncWriter:
+    '''Run the frame writers on background threads while the next frame renders.
+    Jobs of the same stream run in submission order on one thread, each stream queue
+    is bounded so a slow disk throttles rendering instead of piling frames up in memory.
+    '''
+    def __init__(self, max_queue=8, enabled=True):
+        self.max_queue = max_queue
+        self.enabled = enabled
+        self.streams = {}
+        self.errors = []
+        self.busy = 0.
+        self.waited = 0.
+        self.lock = threading.Lock()
+
+    def submit(self, stream, fn, *args):
+        if not self.enabled:
+            self._run(fn, args)
+            return
+        if stream not in self.streams:
+            jobs = queue.Queue(self.max_queue)
+            worker = threading.Thread(target=self._work, args=(jobs,), daemon=True)
+            worker.start()
+            self.streams[stream] = (jobs, worker)
+        t0 = time.time()
+        self.streams[stream][0].put((fn, args))
+        self.waited += time.time() - t0
+
+    def _run(self, fn, args):
+        t0 = time.time()
+        try:
+            fn(*args)
+        except Exception as e:
+            self.errors.append(e)
+        with self.lock:
+            self.busy += time.time() - t0
+
+    def _work(self, jobs):
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            self._run(*job)
+
+    def close(self):
+        '''Wait for every submitted job. Returns the time the writers were busy and the
+        time the caller was blocked on them (both equal when disabled).
+        '''
+        t0 = time.time()
+        for jobs, worker in self.streams.values():
+            jobs.put(None)
+        for jobs, worker in self.streams.values():
+            worker.join()
+        self.waited += time.time() - t0
+        self.streams = {}
+        if self.errors:
+            raise self.errors[0]
+        if not self.enabled:
+            self.waited = self.busy
+        return self.busy, self.waited
+
+
 def create_optimizer_or_freeze_model(model, cfg_train, global_step):
     decay_steps = cfg_train.lrate_decay * 1000
     decay_factor = 0.1 ** (global_step/decay_steps)
@@ -56,11 +165,23 @@ def create_optimizer_or_freeze_model(model, cfg_train, global_step):
     return MaskedAdam(param_group)
 
 
+def create_amp(cfg_train, device):
+    '''Autocast dtype (None for fp32) and gradient scaler of the cfg_train.amp mixed precision mode.'''
+    amp = cfg_train.get('amp', None)
+    if amp not in [None, 'float16', 'bfloat16']:
+        raise ValueError(f"amp must be None, 'float16' or 'bfloat16', got {amp!r}")
+    if amp == 'float16' and device.type != 'cuda':
+        raise ValueError("float16 autocast needs a GPU, use amp='bfloat16' on CPU")
+    # bfloat16 has the range of fp32 and needs no loss scaling
+    scaler = torch.amp.GradScaler('cuda', enabled=(amp == 'float16'))
+    return (getattr(torch, amp) if amp else None), scaler
+
+
 
 
 
 def load_model_ours(model_class, ckpt_path):
-    ckpt = torch.load(ckpt_path)
+    ckpt = torch.load(ckpt_path, map_location=None if torch.cuda.is_available() else 'cpu')
     model = model_class(**ckpt['model_kwargs'])
     model.load_state_dict(ckpt['model_state_dict'], strict=False)
     return model
@@ -1,6 +1,9 @@
 import os
 import time
+import queue
+import threading
 import functools
+import contextlib
 import numpy as np
 
 import torch
@@ -12,21 +15,9 @@ import random
 
 from torch_scatter import segment_coo
 
-from torch.utils.cpp_extension import load
-parent_dir = os.path.dirname(os.path.abspath(__file__))
-render_utils_cuda = load(
-        name='render_utils_cuda',
-        sources=[
-            os.path.join(parent_dir, path)
-            for path in ['cuda/render_utils.cpp', 'cuda/render_utils_kernel.cu']],
-        verbose=True)
-
-total_variation_cuda = load(
-        name='total_variation_cuda',
-        sources=[
-            os.path.join(parent_dir, path)
-            for path in ['cuda/total_variation.cpp', 'cuda/total_variation_kernel.cu']],
-        verbose=True)
+from lib.cuda_ext import LazyExtension
+render_utils_cuda = LazyExtension('render_utils_cuda')
+total_variation_cuda = LazyExtension('total_variation_cuda')
 
 import lib.networks as networks
 
@@ -63,7 +54,8 @@ class VoxelMlp(torch.nn.Module):
 
         # decoder
         self.decoder = networks.init_net(Decoder_woslot(n_freq=kwargs['n_freq'], n_freq_view=kwargs['n_freq_view'], input_dim=kwargs['n_freq']*6+3, 
-                               input_ch_dim=6*kwargs['n_freq_view']+3, z_dim=kwargs['z_dim'], n_layers=kwargs['n_layers'], out_ch=kwargs['out_ch']))
+                               input_ch_dim=6*kwargs['n_freq_view']+3, z_dim=kwargs['z_dim'], n_layers=kwargs['n_layers'], out_ch=kwargs['out_ch'],
+                               fused=kwargs.get('fused_decoder', False), compile_mode=kwargs.get('compile_decoder', None)))
         
         
          # local dynamics -- w/ slots
@@ -90,6 +82,12 @@ class VoxelMlp(torch.nn.Module):
         self.mask_cache_path = mask_cache_path
         self.mask_cache_thres = mask_cache_thres
 
+        # occupancy grid to skip the samples in free space
+        self.init_occupancy_grid()
+        # per-time state shared by the views of a render_batch call
+        self.time_state = None
+        self.reset_march_stats()
+
         
 
     def create_time_net(self, input_dim, input_dim_time, D, W, skips, memory=[]):
@@ -142,19 +140,32 @@ class VoxelMlp(torch.nn.Module):
             return mean_rgb
 
 
+    def time_bias(self, t, net):
+        '''Time columns of the first layer of a time net, a bias shared by all the points at time t.
+        Kept in time_state while render_batch renders the views of that time.
+        '''
+        key = None if self.time_state is None else (round(float(t), 6), id(net))
+        if key is not None and key in self.time_state:
+            return self.time_state[key]
+        t_sim = sin_emb(t.reshape(1, 1), n_freq=self.n_freq_time)
+        bias = F.linear(t_sim, net[0].weight[:, -t_sim.shape[1]:], net[0].bias)
+        if key is not None:
+            self.time_state[key] = bias
+        return bias
+
     def query_time(self, new_pts, t, net, net_final, pdb_flag=0):
         pts_sim = sin_emb(new_pts, n_freq=self.n_freq_t)
-        t_sim = sin_emb(t.expand([new_pts.shape[0], 1]), n_freq=self.n_freq_time)
-        h = torch.cat([pts_sim, t_sim], dim=-1)
+        h = F.linear(pts_sim, net[0].weight[:, :pts_sim.shape[1]]) + self.time_bias(t, net)
       
         
         for i, l in enumerate(net):
-            h = net[i](h)
+            if i > 0:
+                h = net[i](h)
             h = F.relu(h)
             if i in self.skips:
                 h = torch.cat([pts_sim, h], -1)
 
-        return net_final(h)
+        return net_final(h).float()  # fp32 outside the MLP under autocast
 
     def _set_grid_resolution(self, num_voxels):
         # Determine grid resolution
@@ -199,6 +210,11 @@ class VoxelMlp(torch.nn.Module):
             "timenet_layers": self.kwargs['timenet_layers'],
             "timenet_hidden": self.kwargs['timenet_hidden'],
             "skips": self.kwargs['skips'],
+            "fused_decoder": self.kwargs.get('fused_decoder', False),
+            "compile_decoder": self.kwargs.get('compile_decoder', None),
+            "occupancy_grid": self.kwargs.get('occupancy_grid', False),
+            "occupancy_downrate": self.kwargs.get('occupancy_downrate', 4),
+            "occupancy_every": self.kwargs.get('occupancy_every', 256),
         }
 
     @torch.no_grad()
@@ -225,6 +241,7 @@ class VoxelMlp(torch.nn.Module):
 
         self.density = torch.nn.Parameter(
             F.interpolate(self.density.data, size=tuple(self.world_size), mode='trilinear', align_corners=True))
+        self.init_occupancy_grid()
         
 
         print('voxelMlp: scale_volume_grid finish')
@@ -335,13 +352,52 @@ class VoxelMlp(torch.nn.Module):
         hit[ray_id[mask_inbbox][self.mask_cache(ray_pts[mask_inbbox])]] = 1
         return hit.reshape(shape)
 
-    def sample_ray(self, rays_o, rays_d, near, far, stepsize, is_train=False, **render_kwargs):
+    def init_occupancy_grid(self):
+        self.occupancy_grid = None
+        if self.kwargs.get('occupancy_grid', False) and self.fast_color_thres > 0:
+            self.occupancy_grid = OccupancyGrid(
+                    self.xyz_min, self.xyz_max, self.world_size,
+                    downrate=self.kwargs.get('occupancy_downrate', 4),
+                    update_every=self.kwargs.get('occupancy_every', 256))
+
+    @torch.no_grad()
+    def update_occupancy_grid(self, key, frame_time, interval, global_step):
+        '''Mark the occupancy cells which may hold a sample with alpha above fast_color_thres.
+        The cell centers are warped to the canonical space by the time net unless frame_time is None.
+        The canonical occupancy is computed once per refresh epoch and shared by all the frames.
+        '''
+        grid = self.occupancy_grid
+        epoch = grid.epoch(global_step)
+        if grid.canonical is None or grid.canonical[1] != (epoch, interval):
+            r = grid.downrate
+            # max alpha within one cell of each voxel. The margin is a heuristic allowance for the
+            # deformation inside a cell, not a bound: larger deformations may be culled wrongly.
+            # The density outside the bbox is sampled as zero.
+            density = F.pad(self.density.amax(1, keepdim=True), [r]*6, value=0)
+            alpha = 1 - torch.exp(-F.softplus(density + self.act_shift) * interval)
+            grid.canonical = ((F.max_pool3d(alpha, kernel_size=2*r+1, stride=1) > self.fast_color_thres).float(), (epoch, interval))
+        occupied = grid.canonical[0]
+
+        pts = grid.cell_centers()
+        if frame_time is not None:
+            pts = pts + torch.cat([
+                self.query_time(p, frame_time, self._time, self._time_out)
+                for p in pts.split(65536)])
+        ind_norm = ((pts - self.xyz_min) / (self.xyz_max - self.xyz_min)).flip((-1,)) * 2 - 1
+        occupied = F.grid_sample(occupied, ind_norm.reshape(1,1,1,-1,3), mode='bilinear',
+                                 padding_mode='border', align_corners=True)
+        grid.update(key, occupied.flatten() > 0, global_step)
+
+    def sample_ray(self, rays_o, rays_d, near, far, stepsize, is_train=False, frame_time=None, canonical=False, global_step=None, static_from=None, **render_kwargs):
         '''Sample query points on rays.
         All the output points are sorted from near to far.
         Input:
             rays_o, rayd_d:   both in [N, 3] indicating ray configurations.
             near, far:        the near and far distance of the rays.
             stepsize:         the number of voxels of each sample step.
+            frame_time:       time of the rays to look up the occupancy grid.
+            canonical:        look up the occupancy grid of the canonical space instead.
+            static_from:      the rays from this index on are static, looked up in the canonical space.
         Output:
             ray_pts:          [M, 3] storing all the sampled points.
             ray_id:           [M]    the index of the ray of each point.
@@ -356,93 +412,176 @@ class VoxelMlp(torch.nn.Module):
         ray_pts = ray_pts[mask_inbbox]
         ray_id = ray_id[mask_inbbox]
         step_id = step_id[mask_inbbox]
-        return ray_pts, ray_id, step_id
 
+        # skip the known free space before querying the time net and the decoder
+        if self.occupancy_grid is not None and static_from is not None:
+            # the points are ray-major, the dynamic ones come first
+            n = int((ray_id < static_from).sum())
+            dynamic = self.cull_free_space(ray_pts[:n], ray_id[:n], step_id[:n], frame_time, canonical, stepsize, global_step)
+            static = self.cull_free_space(ray_pts[n:], ray_id[n:], step_id[n:], None, True, stepsize, global_step)
+            ray_pts, ray_id, step_id = [torch.cat(v) for v in zip(dynamic, static)]
+        elif self.occupancy_grid is not None and (canonical or frame_time is not None):
+            ray_pts, ray_id, step_id = self.cull_free_space(ray_pts, ray_id, step_id, frame_time, canonical, stepsize, global_step)
+        return ray_pts, ray_id, step_id
 
-    def forward(self, rays_o, rays_d, viewdirs, frame_time, time_index, global_step=None, bg_points_sel=None,start=False, training_flag=True, stc_data=False,mask = None,slot_idx = -1,**render_kwargs):
-        '''Volume rendering
-        @rays_o:   [N, 3] the starting point of the N shooting rays.
-        @rays_d:   [N, 3] the shooting direction of the N rays.
-        @viewdirs: [N, 3] viewing direction to compute positional embedding for MLP.
-        mask [1,K,H,W,D]  for per-slot rendering(only for inference)
-        slot_idx 0--K : which slot to render(only for inference) 
+    def cull_free_space(self, ray_pts, ray_id, step_id, frame_time, canonical, stepsize, global_step):
+        '''Drop the points in the known free space of the occupancy grid at frame_time (or canonical).'''
+        key = None if canonical else round(float(frame_time), 6)
+        if self.occupancy_grid.is_stale(key, global_step):
+            self.update_occupancy_grid(
+                    key, None if canonical else frame_time, stepsize * self.voxel_size_ratio, global_step)
+        mask_occupied = self.occupancy_grid(key, ray_pts)
+        self.occupancy_grid.n_total += len(ray_pts)
+        self.occupancy_grid.n_culled += (~mask_occupied).sum()
+        return ray_pts[mask_occupied], ray_id[mask_occupied], step_id[mask_occupied]
+
+
+    def query_points(self, ray_pts, ray_id, viewdirs, frame_time, start=False, stc_data=False, mask=None, slot_idx=-1, cycle=True, static_from=None):
+        '''Query the density, color and slot probability of the sampled points.
+        @mask     [1,K,H,W,D] for per-slot rendering(only for inference)
+        @slot_idx 0--K : which slot to render(only for inference)
+        @static_from  the points from this index on are static and not warped
         '''
-        assert len(rays_o.shape)==2 and rays_o.shape[-1]==3, 'Only suuport point queries in [N, 3] format'
-
-        ret_dict = {}
-        N = len(rays_o)
-
-        # sample points on rays
-        ray_pts, ray_id, step_id = self.sample_ray(
-            rays_o=rays_o, rays_d=rays_d, is_train=global_step is not None, **render_kwargs)
-        interval = render_kwargs['stepsize'] * self.voxel_size_ratio
-
-
         cycle_loss = 0
-        if stc_data:
+        if stc_data or start:
             density = self.grid_sampler(ray_pts, self.density)
             ray_pts_ = ray_pts
-        
+
         # dynamics data
         else:
-            if start:
-                density = self.grid_sampler(ray_pts, self.density)
-                ray_pts_ = ray_pts
-                
-            else:
-                dx = self.query_time(ray_pts, frame_time, self._time, self._time_out)
-                ray_pts_ = ray_pts + dx
+            pts = ray_pts if static_from is None else ray_pts[:static_from]
+            dx = self.query_time(pts, frame_time, self._time, self._time_out)
+            pts_ = pts + dx
+            ray_pts_ = pts_ if static_from is None else torch.cat([pts_, ray_pts[static_from:]])
 
-                density = self.grid_sampler(ray_pts_, self.density)
-                dx_inverse = self.query_time(ray_pts_.detach(),frame_time, self._time_inverse, self._time_out_inverse)
-                ray_pts_inverse = ray_pts_.detach() + dx_inverse
-                cycle_loss = F.mse_loss(ray_pts_inverse, ray_pts.detach())
+            density = self.grid_sampler(ray_pts_, self.density)
+            if cycle:
+                dx_inverse = self.query_time(pts_.detach(),frame_time, self._time_inverse, self._time_out_inverse)
+                ray_pts_inverse = pts_.detach() + dx_inverse
+                cycle_loss = F.mse_loss(ray_pts_inverse, pts.detach())
 
         if self.density.shape[1] == 1:
             odensity = density[None, :]  #[K,P]  in warm up stage, K=1 while training.
         else:
             raise NotImplementedError
 
+        rgb, density, multi_rgb, multi_density = self.decoder(ray_pts_, viewdirs, odensity, ray_id, self.act_shift)
 
-        rgb_all, density_all, multi_rgb, multi_density = self.decoder(ray_pts_, viewdirs, odensity, ray_id, self.act_shift) 
-
-        
-        density = density_all
-        rgb = rgb_all
-       
-        
         if mask is not None:
             mask = self.grid_sampler(ray_pts_,mask)  #[P,K]
             if slot_idx != -1:
                 mask = mask[:,slot_idx]
                 density = density * mask
 
-        
-
         slots_prob_ori = (multi_density / (torch.sum(multi_density,dim=0,keepdim = True) + 1e-10))   #[7,M]
         slots_prob = slots_prob_ori.permute(1,0) #[M,7]
+        return density, rgb, slots_prob, cycle_loss
 
-        alpha = 1 - torch.exp(-density * interval)
-        if self.fast_color_thres > 0:
-            mask = (alpha > self.fast_color_thres)
-            ray_id_ = ray_id[mask]
-            step_id = step_id[mask]
-            density = density[mask]
-            alpha = alpha[mask]
-            rgb = rgb[mask]
-            slots_prob = slots_prob[mask]
+    def reset_march_stats(self):
+        self.n_march_total = 0
+        self.n_march_skipped = 0
 
-        # compute accumulated transmittance
-        weights, alphainv_last = Alphas2Weights.apply(alpha, ray_id_, N)
-        if self.fast_color_thres > 0:
+    def march_skipped_fraction(self):
+        return float(self.n_march_skipped) / max(float(self.n_march_total), 1)
+
+    @torch.no_grad()
+    def march_segments(self, ray_pts, ray_id, step_id, viewdirs, N, interval, segment_steps, **query_kwargs):
+        '''Inference-only ray marching over depth-ordered segments of segment_steps samples.
+        Rays whose transmittance drops below 1e-3 are retired before the next segment is queried,
+        where Alphas2Weights would stop accumulating anyway.
+        '''
+        T = torch.ones([N], device=ray_pts.device)
+        alive = torch.ones([N], dtype=torch.bool, device=ray_pts.device)
+        n_steps = int(step_id.max()) + 1 if len(step_id) else 0
+        outs = []
+        for s in range(0, n_steps, segment_steps):
+            sel = (step_id >= s) & (step_id < s + segment_steps)
+            n_sel = sel.sum()
+            sel = sel & alive[ray_id]
+            self.n_march_total += n_sel
+            self.n_march_skipped += n_sel - sel.sum()
+            seg_id = ray_id[sel]
+            seg_step = step_id[sel]
+            density, rgb, slots_prob, _ = self.query_points(ray_pts[sel], seg_id, viewdirs, cycle=False, **query_kwargs)
+
+            alpha = 1 - torch.exp(-density * interval)
+            mask = (alpha > self.fast_color_thres)
+            seg_id, seg_step, alpha, rgb, slots_prob = seg_id[mask], seg_step[mask], alpha[mask], rgb[mask], slots_prob[mask]
+
+            # composite the segment behind the transmittance accumulated so far. The kernel stops a ray on
+            # the transmittance of the segment alone, apply the stop of the single pass on the global one
+            _, T_seg, _, _, i_end = render_utils_cuda.alpha2weight(alpha, seg_id, N)
+            T_pts = T[seg_id] * T_seg
+            active = (torch.arange(len(seg_id), device=seg_id.device) < i_end[seg_id]) & (T_pts >= 1e-3)
+            weights = torch.where(active, T_pts * alpha, torch.zeros_like(alpha))
+            T = T.scatter_reduce(0, seg_id[active], (T_pts * (1 - alpha))[active], reduce='amin')
+            alive = T >= 1e-3
             mask = (weights > self.fast_color_thres)
-            weights = weights[mask]
-            alpha = alpha[mask]
-            ray_id_ = ray_id_[mask]
-            step_id = step_id[mask]
-            density = density[mask]
-            rgb = rgb[mask]
-            slots_prob = slots_prob[mask]
+            outs.append([weights[mask], seg_id[mask], seg_step[mask], alpha[mask], rgb[mask], slots_prob[mask]])
+
+        if len(outs) == 0:
+            empty = ray_pts.new_zeros([0])
+            return empty, T, ray_id, step_id, empty, ray_pts.new_zeros([0, 3]), ray_pts.new_zeros([0, self.density.shape[1]])
+        weights, ray_id_, step_id, alpha, rgb, slots_prob = [torch.cat(v) for v in zip(*outs)]
+        # back to the ray-major order expected by segment_coo
+        order = torch.sort(ray_id_, stable=True)[1]
+        return weights[order], T, ray_id_[order], step_id[order], alpha[order], rgb[order], slots_prob[order]
+
+    def forward(self, rays_o, rays_d, viewdirs, frame_time, time_index, global_step=None, bg_points_sel=None,start=False, training_flag=True, stc_data=False,mask = None,slot_idx = -1,static_from=None,**render_kwargs):
+        '''Volume rendering
+        @rays_o:   [N, 3] the starting point of the N shooting rays.
+        @rays_d:   [N, 3] the shooting direction of the N rays.
+        @viewdirs: [N, 3] viewing direction to compute positional embedding for MLP.
+        mask [1,K,H,W,D]  for per-slot rendering(only for inference)
+        slot_idx 0--K : which slot to render(only for inference) 
+        static_from: the rays from this index on are static data (training only, see forward_fused)
+        '''
+        assert len(rays_o.shape)==2 and rays_o.shape[-1]==3, 'Only suuport point queries in [N, 3] format'
+
+        ret_dict = {}
+        N = len(rays_o)
+
+        # sample points on rays
+        ray_pts, ray_id, step_id = self.sample_ray(
+            rays_o=rays_o, rays_d=rays_d, is_train=global_step is not None,
+            frame_time=frame_time, canonical=stc_data or start, global_step=global_step, static_from=static_from, **render_kwargs)
+        interval = render_kwargs['stepsize'] * self.voxel_size_ratio
+        if static_from is not None:
+            static_from = int((ray_id < static_from).sum())
+
+        segment_steps = render_kwargs.get('segment_steps', 0)
+        if not training_flag and segment_steps > 0 and self.fast_color_thres > 0:
+            # early ray termination at inference
+            cycle_loss = 0
+            weights, alphainv_last, ray_id_, step_id, alpha, rgb, slots_prob = self.march_segments(
+                    ray_pts, ray_id, step_id, viewdirs, N, interval, segment_steps,
+                    frame_time=frame_time, start=start, stc_data=stc_data, mask=mask, slot_idx=slot_idx)
+        else:
+            density, rgb, slots_prob, cycle_loss = self.query_points(
+                    ray_pts, ray_id, viewdirs, frame_time, start=start, stc_data=stc_data, mask=mask, slot_idx=slot_idx,
+                    cycle=global_step is not None, static_from=static_from)
+
+            alpha = 1 - torch.exp(-density * interval)
+            if self.fast_color_thres > 0:
+                mask = (alpha > self.fast_color_thres)
+                ray_id_ = ray_id[mask]
+                step_id = step_id[mask]
+                density = density[mask]
+                alpha = alpha[mask]
+                rgb = rgb[mask]
+                slots_prob = slots_prob[mask]
+
+            # compute accumulated transmittance
+            weights, alphainv_last = Alphas2Weights.apply(alpha, ray_id_, N)
+            if self.fast_color_thres > 0:
+                mask = (weights > self.fast_color_thres)
+                weights = weights[mask]
+                alpha = alpha[mask]
+                ray_id_ = ray_id_[mask]
+                step_id = step_id[mask]
+                density = density[mask]
+                rgb = rgb[mask]
+                slots_prob = slots_prob[mask]
 
         
         rgb_marched = segment_coo(
@@ -476,7 +615,7 @@ class VoxelMlp(torch.nn.Module):
             contribution = segment_coo(
                 src=(weights.unsqueeze(-1) * slots_prob),
                 index=ray_id_,
-                out=torch.zeros([N, multi_density.shape[0]]),
+                out=torch.zeros([N, slots_prob.shape[1]]),
                 reduce='sum') # [M,slots]
             
             seg_contri = torch.cat([alphainv_last.unsqueeze(-1), contribution], dim=-1) # [N, slots+1]
@@ -487,7 +626,67 @@ class VoxelMlp(torch.nn.Module):
         
         
         return ret_dict
+
+    def forward_fused(self, rays_o, rays_d, viewdirs, frame_time, rays_o_stc, rays_d_stc, viewdirs_stc,
+                      time_index=None, global_step=None, start=False, **render_kwargs):
+        '''Training forward of a dynamic and a static batch in a single pass.
+        The rays of both are sampled, decoded and composited together and only the dynamic
+        points go through the time net. Returns the ret_dict of each batch, as forward and
+        forward(stc_data=True) return them (the cycle loss is in the dynamic one).
+        '''
+        N = len(rays_o)
+        ret = self(torch.cat([rays_o, rays_o_stc]), torch.cat([rays_d, rays_d_stc]), torch.cat([viewdirs, viewdirs_stc]),
+                   frame_time, time_index, global_step=global_step, start=start, static_from=N, **render_kwargs)
+        # per point outputs are ray-major, the dynamic rays come first
+        n = int((ret['ray_id'] < N).sum())
+        ret_dict, ret_dict_stc = {'cycle_loss': ret.pop('cycle_loss')}, {'cycle_loss': 0}
+        for k, v in ret.items():
+            split = n if k in ['weights', 'raw_alpha', 'raw_rgb', 'ray_id'] else N
+            ret_dict[k], ret_dict_stc[k] = v[:split], v[split:]
+        ret_dict_stc['ray_id'] = ret_dict_stc['ray_id'] - N
+        return ret_dict, ret_dict_stc
     
+    @torch.no_grad()
+    def render_batch(self, poses, Ks, HW, frame_times, ndc=False, bs=4096, max_views=8, group_time=True,
+                     keys=('rgb_marched', 'depth', 'segmentation'), **render_kwargs):
+        '''Render a list of views, yields (view index, {key: [H, W, C]}) in order.
+        The rays of consecutive views sharing a frame time (up to max_views of them) are
+        concatenated and run through forward in bs-sized work units. The time dependent state
+        (time net biases) is computed once per frame time and shared by all its views.
+        group_time=False renders the views one by one without sharing, as a baseline.
+        '''
+        self.time_state = {} if group_time else None
+        max_views = max_views if group_time else 1
+        try:
+            yield from self._render_groups(poses, Ks, HW, frame_times, ndc, bs, max_views, keys, render_kwargs)
+        finally:
+            self.time_state = None
+
+    def _render_groups(self, poses, Ks, HW, frame_times, ndc, bs, max_views, keys, render_kwargs):
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        first = 0
+        while first < len(poses):
+            frame_time = frame_times[first].to(device)
+            last = first + 1
+            while last < len(poses) and last - first < max_views and torch.equal(frame_times[last].to(device), frame_time):
+                last += 1
+
+            rays = [get_rays_of_a_view(
+                        HW[i][0], HW[i][1], Ks[i], poses[i], ndc, inverse_y=render_kwargs['inverse_y'],
+                        flip_x=render_kwargs['flip_x'], flip_y=render_kwargs['flip_y'])
+                    for i in range(first, last)]
+            rays_o, rays_d, viewdirs = [torch.cat([r[j].flatten(0,-2) for r in rays]) for j in range(3)]
+            chunks = [
+                {k: v for k, v in self(ro, rd, vd, frame_time, first, start=(frame_time==0), training_flag=False, **render_kwargs).items() if k in keys}
+                for ro, rd, vd in zip(rays_o.split(bs, 0), rays_d.split(bs, 0), viewdirs.split(bs, 0))
+            ]
+            sizes = [int(H*W) for H, W in HW[first:last]]
+            views = {k: torch.cat([ret[k] for ret in chunks]).split(sizes) for k in chunks[0].keys()}
+            for j, i in enumerate(range(first, last)):
+                H, W = HW[i]
+                yield i, {k: v[j].reshape(H,W,-1) for k, v in views.items()}
+            first = last
+
     def forward_imp(self, rays_o, rays_d, viewdirs, frame_time,  time_index, start = False,bg_points_sel=None,pseudo_grid = None, global_step=None, **render_kwargs):
         '''Volume rendering
         @rays_o:   [N, 3] the starting point of the N shooting rays.
@@ -501,7 +700,8 @@ class VoxelMlp(torch.nn.Module):
 
         # sample points on rays
         ray_pts, ray_id, step_id = self.sample_ray(
-            rays_o=rays_o, rays_d=rays_d, is_train=global_step is not None, **render_kwargs)
+            rays_o=rays_o, rays_d=rays_d, is_train=global_step is not None,
+            frame_time=frame_time, canonical=start, global_step=global_step, **render_kwargs)
         interval = render_kwargs['stepsize'] * self.voxel_size_ratio
 
 
@@ -568,6 +768,69 @@ class VoxelMlp(torch.nn.Module):
         return ret_dict
 
 
+''' Occupancy grid for empty space skipping
+A coarse, bit-packed version of MaskCache which is rebuilt from the current density
+every few training steps. One grid is kept per frame time (observation space).
+All the grids share a refresh epoch of update_every steps: a frame grid is built on its
+first use in an epoch and dropped at the next one, so each frame costs one time net pass
+over the cell centers per epoch however the frames are visited.
+'''
+class OccupancyGrid(nn.Module):
+    def __init__(self, xyz_min, xyz_max, world_size, downrate=4, update_every=256):
+        super().__init__()
+        self.downrate = downrate
+        self.update_every = update_every
+        self.grid_size = [(int(s) - 1) // downrate + 1 for s in world_size]
+        xyz2ijk_scale = (torch.Tensor(self.grid_size).to(xyz_min.device) - 1) / (xyz_max - xyz_min)
+        self.register_buffer('xyz_min', xyz_min.clone(), persistent=False)
+        self.register_buffer('xyz_max', xyz_max.clone(), persistent=False)
+        self.register_buffer('xyz2ijk_scale', xyz2ijk_scale, persistent=False)
+        self.register_buffer('xyz2ijk_shift', -xyz_min * xyz2ijk_scale, persistent=False)
+        self.grids = {}  # key -> (packed bits, refresh epoch of the update)
+        self.canonical = None  # (dense canonical occupancy, (refresh epoch, interval))
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.n_total = 0
+        self.n_culled = 0
+
+    def culled_fraction(self):
+        return float(self.n_culled) / max(self.n_total, 1)
+
+    def cell_centers(self):
+        coords = [torch.linspace(self.xyz_min[i], self.xyz_max[i], self.grid_size[i], device=self.xyz_min.device) for i in range(3)]
+        return torch.stack(torch.meshgrid(*coords), -1).reshape(-1, 3)
+
+    def epoch(self, global_step):
+        # grids built during training are refreshed once for inference (epoch None)
+        return None if global_step is None else global_step // self.update_every
+
+    def is_stale(self, key, global_step):
+        return key not in self.grids or self.grids[key][1] != self.epoch(global_step)
+
+    def update(self, key, occupied, global_step):
+        epoch = self.epoch(global_step)
+        if any(e != epoch for _, e in self.grids.values()):
+            self.grids = {k: v for k, v in self.grids.items() if v[1] == epoch}
+        bits = occupied.flatten().to(torch.uint8)
+        bits = F.pad(bits, (0, (-len(bits)) % 8)).view(-1, 8)
+        shifts = torch.arange(8, device=bits.device, dtype=torch.uint8)
+        packed = (bits << shifts).sum(-1).to(torch.uint8)
+        self.grids[key] = (packed, epoch)
+
+    @torch.no_grad()
+    def forward(self, key, xyz):
+        '''Check whether the points may lie in occupied space
+        @xyz:   [N, 3] the xyz in global coordinate.
+        '''
+        packed = self.grids[key][0]
+        ijk = (xyz * self.xyz2ijk_scale + self.xyz2ijk_shift).round().long()
+        X, Y, Z = self.grid_size
+        ijk = torch.minimum(ijk.clamp(min=0), torch.tensor([X-1, Y-1, Z-1], device=ijk.device))
+        idx = (ijk[:,0] * Y + ijk[:,1]) * Z + ijk[:,2]
+        return ((packed[idx >> 3].long() >> (idx & 7)) & 1).bool()
+
+
 ''' Module for the searched coarse geometry
 It supports query for the known free space and unknown space.
 '''
@@ -576,7 +839,7 @@ class MaskCache(nn.Module):
         super().__init__()
         
         if path is not None:
-            st = torch.load(path)
+            st = torch.load(path, map_location=None if torch.cuda.is_available() else 'cpu')
             self.mask_cache_thres = mask_cache_thres
             density = F.max_pool3d(st['model_state_dict']['density'], kernel_size=3, padding=1, stride=1)
             # alpha = 1 - torch.exp(-F.softplus(density + st['model_kwargs']['act_shift']) * st['model_kwargs']['voxel_size_ratio'])
@@ -661,12 +924,15 @@ class Alphas2Weights(torch.autograd.Function):
 
 
 class Decoder_woslot(nn.Module):
-    def __init__(self, n_freq=5, n_freq_view=3, input_dim=33+64, input_ch_dim=21, z_dim=64, n_layers=3, out_ch=3):
+    def __init__(self, n_freq=5, n_freq_view=3, input_dim=33+64, input_ch_dim=21, z_dim=64, n_layers=3, out_ch=3,
+                 fused=False, compile_mode=None):
         """
         freq: raised frequency
         input_dim: pos emb dim + voxel grid dim
         z_dim: network latent dim
         n_layers: #layers before/after skip connection.
+        fused: embed with SinEmb and run the MLP as one DecoderTrunk
+        compile_mode: None | 'script' | 'compile', TorchScript or torch.compile the fused MLP
         """
         super().__init__()
         self.n_freq = n_freq
@@ -689,6 +955,26 @@ class Decoder_woslot(nn.Module):
                                      nn.ReLU(True),
                                      nn.Linear(z_dim//4, 3))
 
+        self.fused = fused
+        self.compile_mode = compile_mode
+        if fused:
+            self.coor_emb = SinEmb(n_freq)
+            self.view_emb = SinEmb(n_freq_view)
+        # built on the first fused call, kept out of the module tree so that the state_dict is unchanged
+        object.__setattr__(self, '_trunk', None)
+
+    def get_trunk(self):
+        if self._trunk is None:
+            trunk = DecoderTrunk(self)
+            if self.compile_mode == 'script':
+                trunk = torch.jit.script(trunk)
+            elif self.compile_mode == 'compile':
+                trunk = torch.compile(trunk, dynamic=True)
+            elif self.compile_mode is not None:
+                raise ValueError(f"compile_decoder must be None, 'script' or 'compile', got {self.compile_mode!r}")
+            object.__setattr__(self, '_trunk', trunk)
+        return self._trunk
+
 
     def forward(self, sampling_coor, sampling_view,  raw_density, ray_id, act_shift,dens_noise=0.):
         """
@@ -704,24 +990,29 @@ class Decoder_woslot(nn.Module):
         K = raw_density.shape[0]
         P = sampling_coor.shape[0]
 
-        sampling_coor_ = sin_emb(sampling_coor, n_freq=self.n_freq)
-        query_ex = sampling_coor_.expand(K, sampling_coor_.shape[0], sampling_coor_.shape[1]).flatten(end_dim=1) # ((K)*P)*33
-        
-        sampling_view_ = sin_emb(sampling_view, n_freq=self.n_freq_view)[ray_id,:] # P*21
-        query_view = sampling_view_.expand(K, sampling_view_.shape[0], sampling_view_.shape[1]).flatten(end_dim=1)
-        
-        input = query_ex  # ((K)xP)x(34+C)
-        
+        if self.fused:
+            # same ops as below, without the K copies of the embeddings
+            query_view = self.view_emb(sampling_view)[ray_id]  # P*21
+            input = self.coor_emb(sampling_coor).expand(K, -1, -1).flatten(end_dim=1)  # ((K)*P)*33
+            raw_rgb = self.get_trunk()(input, query_view, K)
+        else:
+            sampling_coor_ = sin_emb(sampling_coor, n_freq=self.n_freq)
+            query_ex = sampling_coor_.expand(K, sampling_coor_.shape[0], sampling_coor_.shape[1]).flatten(end_dim=1) # ((K)*P)*33
 
-        tmp = self.before(input)
-        tmp = self.after(torch.cat([input, tmp], dim=1))  # ((K)xP)x64
-        latent = self.after_latent(tmp)  # ((K)xP)x64
-        
-        h = torch.cat([latent, query_view], -1)
-        h = self.views_linears(h)
-        raw_rgb = self.color(h).view([K, P, 3]).contiguous()  # ((K)xP)x3 -> (K)xPx3
+            sampling_view_ = sin_emb(sampling_view, n_freq=self.n_freq_view)[ray_id,:] # P*21
+            query_view = sampling_view_.expand(K, sampling_view_.shape[0], sampling_view_.shape[1]).flatten(end_dim=1)
+
+            input = query_ex  # ((K)xP)x(34+C)
 
-        raws = torch.cat([raw_rgb, raw_density[..., None]], dim=-1)  # (K)xPx4
+            tmp = self.before(input)
+            tmp = self.after(torch.cat([input, tmp], dim=1))  # ((K)xP)x64
+            latent = self.after_latent(tmp)  # ((K)xP)x64
+
+            h = torch.cat([latent, query_view], -1)
+            h = self.views_linears(h)
+            raw_rgb = self.color(h).view([K, P, 3]).contiguous()  # ((K)xP)x3 -> (K)xPx3
+
+        raws = torch.cat([raw_rgb.float(), raw_density[..., None]], dim=-1)  # (K)xPx4, fp32 outside the MLP under autocast
         
         raw_masks = F.softplus(raws[:, :, -1:] + act_shift, True)
         raw_sigma = raw_masks + dens_noise * torch.randn_like(raw_masks)
@@ -757,6 +1048,51 @@ def sin_emb(x, n_freq=5, keep_ori=True):
     return embedded_
 
 
+class SinEmb(nn.Module):
+    """
+    sin_emb with the frequencies cached in a buffer and the sin/cos of all the
+    frequencies computed by one call each, bitwise equal to sin_emb.
+    """
+    def __init__(self, n_freq=5, keep_ori=True):
+        super().__init__()
+        self.keep_ori = keep_ori
+        freqs = 2. ** torch.linspace(0., n_freq - 1, steps=n_freq)
+        self.register_buffer('freqs', freqs[:, None], persistent=False)
+
+    def forward(self, x):
+        x_freq = x[:, None, :] * self.freqs  # PxFx3
+        embedded = torch.stack([x_freq.sin(), x_freq.cos()], dim=2).flatten(start_dim=1)  # same order as sin_emb
+        if self.keep_ori:
+            embedded = torch.cat([x, embedded], dim=1)
+        return embedded
+
+
+class DecoderTrunk(nn.Module):
+    """
+    MLP of the fused decoder path. It holds the decoder's own layers, so it can be
+    scripted or compiled without changing the decoder's parameters or state_dict.
+    """
+    def __init__(self, decoder):
+        super().__init__()
+        self.before = decoder.before
+        self.after = decoder.after
+        self.after_latent = decoder.after_latent
+        self.views_linears = decoder.views_linears
+        self.color = decoder.color
+
+    def forward(self, input, query_view, K: int):
+        """
+        input: ((K)xP)xC, query_view: Px21, the view embedding shared by the K instances
+        return: (K)xPx3 raw rgb
+        """
+        tmp = self.before(input)
+        tmp = self.after(torch.cat([input, tmp], dim=1))
+        latent = self.after_latent(tmp).view(K, query_view.shape[0], -1)
+        h = torch.cat([latent, query_view.expand(K, -1, -1)], -1).flatten(end_dim=1)
+        h = self.views_linears(h)
+        return self.color(h).view(K, -1, 3)
+
+
 
 def get_rays(H, W, K, c2w, inverse_y, flip_x, flip_y, mode='center'):
     i, j = torch.meshgrid(
@@ -827,6 +1163,29 @@ def get_rays_of_a_view(H, W, K, c2w, ndc, inverse_y, flip_x, flip_y, mode='cente
     return rays_o, rays_d, viewdirs
 
 
+def get_rays_of_pixels(rows, cols, HW, Ks, c2w, ndc, inverse_y, flip_x, flip_y):
+    '''get_rays_of_a_view (mode='center') for a batch of pixels, each from its own view.
+    rows, cols: [...] pixel indices; HW: [...,2]; Ks: [...,3,3] float64; c2w: [...,3+,4].
+    With ndc all the views must share HW and K.
+    '''
+    H, W = HW[...,0], HW[...,1]
+    i = (W-1-cols if flip_x else cols).float() + 0.5
+    j = (H-1-rows if flip_y else rows).float() + 0.5
+    # the intrinsics are rounded to float32 first, like the python scalars of get_rays are
+    fx, fy, cx, cy = [k.float() for k in [Ks[...,0,0], Ks[...,1,1], Ks[...,0,2], Ks[...,1,2]]]
+    if inverse_y:
+        dirs = torch.stack([(i-cx)/fx, (j-cy)/fy, torch.ones_like(i)], -1)
+    else:
+        dirs = torch.stack([(i-cx)/fx, -(j-cy)/fy, -torch.ones_like(i)], -1)
+    rays_d = torch.sum(dirs[..., np.newaxis, :] * c2w[...,:3,:3], -1)
+    rays_o = c2w[...,:3,3]
+    viewdirs = rays_d / rays_d.norm(dim=-1, keepdim=True)
+    if ndc:
+        (H, W), K = HW.reshape(-1,2)[0].tolist(), Ks.reshape(-1,3,3)[0].cpu().numpy()
+        rays_o, rays_d = ndc_rays(H, W, K[0][0], 1., rays_o, rays_d)
+    return rays_o, rays_d, viewdirs
+
+
 @torch.no_grad()
 def get_training_rays(rgb_tr, train_poses, HW, Ks, ndc, inverse_y, flip_x, flip_y):
     print('get_training_rays: start')
@@ -951,11 +1310,379 @@ def get_training_rays_in_maskcache_sampling(rgb_tr_ori, train_poses, HW, Ks, ndc
     return rgb_tr, rays_o_tr, rays_d_tr, viewdirs_tr, imsz
 
 
-def batch_indices_generator(N, BS):
+class RayStore:
+    '''Compact stand-in for the (rgb_tr, rays_o_tr, rays_d_tr, viewdirs_tr) tensors.
+
+    Colors are kept as uint8 when that is lossless, the ray origins once per view and the
+    directions in `dirs_dtype`; the viewdirs are normalized from the directions on gather.
+    With `cameras` set no ray is stored at all, they are computed for each batch from the
+    poses, intrinsics and pixel indices instead.
+    store[index] takes the index the float32 tensors took, (view, row, col) for the
+    per-image layout and a flat ray index for the flatten one, and returns
+    (target, rays_o, rays_d, viewdirs) in float32.
+    '''
+    def __init__(self, rgb, offsets, rays_o, rays_d, viewdirs, rgb_dtype, ndc, imsz, pix_ids=None, cameras=None):
+        self.rgb = rgb                # [N,H,W,3] or [M,3], uint8 or the images' dtype
+        self.offsets = offsets        # [N+1] first ray of each view, None for the per-image layout
+        self.rays_o = rays_o          # [N,3] origins, per ray when ndc
+        self.rays_d = rays_d
+        self.viewdirs = viewdirs      # only kept when ndc, where they don't follow from rays_d
+        self.pix_ids = pix_ids        # [M] pixel of each ray, kept when on the fly and masked
+        self.cameras = cameras        # poses, Ks, HW and the get_rays flags when on the fly
+        self.rgb_dtype = rgb_dtype
+        self.ndc = ndc
+        self.imsz = imsz
+        self.shape = rgb.shape[:-1]
+
+    def __len__(self):
+        return len(self.rgb)
+
+    def __getitem__(self, index):
+        target = self.rgb[index]
+        if target.dtype == torch.uint8:
+            target = (target.float() / 255).to(self.rgb_dtype)
+        target = target.float()
+        if self.offsets is not None:
+            index = index.to(self.offsets.device)
+            view = torch.searchsorted(self.offsets, index, right=True) - 1
+        else:
+            view = index[0]
+        if self.cameras is not None:
+            return (target,) + self.rays_of_pixels(view, index)
+        rays_d = self.rays_d[index].float()
+        if self.ndc:
+            rays_o = self.rays_o[index]
+            viewdirs = self.viewdirs[index].float()
+        else:
+            rays_o = self.rays_o[view].expand(rays_d.shape).contiguous()
+            viewdirs = rays_d / rays_d.norm(dim=-1, keepdim=True)
+        return target, rays_o, rays_d, viewdirs
+
+    def rays_of_pixels(self, view, index):
+        cams = self.cameras
+        if self.offsets is not None:
+            pix = self.pix_ids[index].long() if self.pix_ids is not None else index - self.offsets[view]
+            W = cams['HW'][view, 1]
+            rows, cols = pix // W, pix % W
+        else:
+            device = cams['poses'].device
+            rows, cols = index[1].to(device), index[2].to(device)
+            view = torch.as_tensor(view, device=device).expand(rows.shape)
+        return get_rays_of_pixels(
+                rows, cols, cams['HW'][view], cams['Ks'][view], cams['poses'][view], ndc=self.ndc,
+                inverse_y=cams['inverse_y'], flip_x=cams['flip_x'], flip_y=cams['flip_y'])
+
+    def to(self, device):
+        for k in ['rgb', 'offsets', 'rays_o', 'rays_d', 'viewdirs', 'pix_ids']:
+            if getattr(self, k) is not None:
+                setattr(self, k, getattr(self, k).to(device))
+        if self.cameras is not None:
+            self.cameras = {k: v.to(device) if torch.is_tensor(v) else v for k, v in self.cameras.items()}
+        return self
+
+    def dense_rays(self):
+        '''Full float32 rays_o_tr and rays_d_tr, as voxel_count_views takes them.'''
+        if self.offsets is not None:
+            index = torch.arange(len(self.rgb), device=self.rgb.device)
+            _, rays_o, rays_d, _ = self[index]
+            return rays_o, rays_d
+        if self.cameras is not None:
+            rays = [self[torch.tensor(i), *torch.meshgrid(torch.arange(self.shape[1]), torch.arange(self.shape[2]), indexing='ij')]
+                    for i in range(len(self.rgb))]
+            return torch.stack([r[1] for r in rays]), torch.stack([r[2] for r in rays])
+        rays_d = self.rays_d.float()
+        if self.ndc:
+            return self.rays_o, rays_d
+        view = torch.arange(len(self.rgb), device=self.rays_o.device)[:,None,None]
+        return self.rays_o[view].expand(rays_d.shape), rays_d
+
+    def nbytes(self):
+        tensors = [self.rgb, self.offsets, self.rays_o, self.rays_d, self.viewdirs, self.pix_ids]
+        if self.cameras is not None:
+            tensors += [v for v in self.cameras.values() if torch.is_tensor(v)]
+        return sum(v.numel() * v.element_size() for v in tensors if v is not None)
+
+
+def is_8bit(img):
+    '''Whether img holds k/255 values only, as decoded from an 8-bit image.'''
+    img_u8 = (img.float() * 255).round().clamp(0, 255)
+    return torch.equal((img_u8 / 255).to(img.dtype), img)
+
+
+@torch.no_grad()
+def get_training_ray_store(rgb_tr_ori, train_poses, HW, Ks, ndc, inverse_y, flip_x, flip_y,
+                           flatten=False, model=None, render_kwargs=None, device=None, dirs_dtype='float32',
+                           on_the_fly=False):
+    '''The rays of get_training_rays in a RayStore, or those of get_training_rays_flatten when
+    flatten is set and of get_training_rays_in_maskcache_sampling when a model is given.
+    The rays are built view by view so the float32 tensors are never allocated in full,
+    and not kept at all when on_the_fly is set.
+    '''
+    print('get_training_ray_store: start')
+    assert len(rgb_tr_ori) == len(train_poses) and len(rgb_tr_ori) == len(Ks) and len(rgb_tr_ori) == len(HW)
+    flatten = flatten or model is not None
+    if not flatten or (on_the_fly and ndc):
+        assert len(np.unique(HW, axis=0)) == 1
+        assert len(np.unique(Ks.reshape(len(Ks),-1), axis=0)) == 1
+    CHUNK = 64
+    DEVICE = device if device is not None else rgb_tr_ori[0].device
+    dirs_dtype = getattr(torch, dirs_dtype)
+    eps_time = time.time()
+    quantize = all(is_8bit(img) for img in rgb_tr_ori)
+    rgb_dtype = rgb_tr_ori[0].dtype
+    rgb, pix_ids, rays_o_tr, rays_d_tr, viewdirs_tr, imsz = [], [], [], [], [], []
+    for i, (c2w, img, (H, W), K) in enumerate(zip(train_poses, rgb_tr_ori, HW, Ks)):
+        assert img.shape[:2] == (H, W)
+        img = img.to(DEVICE)
+        if quantize:
+            img = (img.float() * 255).round().to(torch.uint8)
+        if model is not None or not on_the_fly:
+            rays_o, rays_d, viewdirs = get_rays_of_a_view(
+                    H=H, W=W, K=K, c2w=c2w, ndc=ndc,
+                    inverse_y=inverse_y, flip_x=flip_x, flip_y=flip_y)
+        if model is not None:
+            mask = torch.empty(img.shape[:2], device=DEVICE, dtype=torch.bool)
+            for j in range(0, img.shape[0], CHUNK):
+                mask[j:j+CHUNK] = model.hit_coarse_geo(
+                        rays_o=rays_o[j:j+CHUNK], rays_d=rays_d[j:j+CHUNK], **render_kwargs).to(DEVICE)
+            img = img[mask]
+            if on_the_fly:
+                pix_ids.append(mask.flatten().nonzero()[:,0].int())
+            else:
+                rays_o, rays_d, viewdirs = rays_o[mask.to(rays_o.device)], rays_d[mask.to(rays_d.device)], viewdirs[mask.to(viewdirs.device)]
+        elif flatten:
+            img = img.flatten(0,1)
+            if not on_the_fly:
+                rays_o, rays_d, viewdirs = rays_o.flatten(0,1), rays_d.flatten(0,1), viewdirs.flatten(0,1)
+        rgb.append(img)
+        imsz.append(len(img) if flatten else 1)
+        if not on_the_fly:
+            rays_o_tr.append(rays_o.to(DEVICE) if ndc else c2w[:3,3].to(DEVICE))
+            rays_d_tr.append(rays_d.to(DEVICE, dirs_dtype))
+            if ndc:
+                viewdirs_tr.append(viewdirs.to(DEVICE, dirs_dtype))
+            del rays_o, rays_d, viewdirs
+
+    join = torch.cat if flatten else torch.stack
+    offsets = torch.tensor(np.cumsum([0] + imsz), device=DEVICE) if flatten else None
+    if on_the_fly:
+        cameras = dict(poses=torch.as_tensor(train_poses).float().to(DEVICE),
+                       Ks=torch.as_tensor(np.asarray(Ks, dtype=np.float64), device=DEVICE),
+                       HW=torch.as_tensor(np.asarray(HW, dtype=np.int64), device=DEVICE),
+                       inverse_y=inverse_y, flip_x=flip_x, flip_y=flip_y)
+        store = RayStore(rgb=join(rgb), offsets=offsets, rays_o=None, rays_d=None, viewdirs=None,
+                         rgb_dtype=rgb_dtype, ndc=ndc, imsz=imsz, cameras=cameras,
+                         pix_ids=torch.cat(pix_ids) if model is not None else None)
+    else:
+        store = RayStore(rgb=join(rgb), offsets=offsets,
+                         rays_o=join(rays_o_tr) if ndc else torch.stack(rays_o_tr), rays_d=join(rays_d_tr),
+                         viewdirs=join(viewdirs_tr) if ndc else None, rgb_dtype=rgb_dtype, ndc=ndc, imsz=imsz)
+    if model is not None:
+        print('get_training_ray_store: ratio', len(store) / sum(int(h) * int(w) for h, w in HW))
+    eps_time = time.time() - eps_time
+    print('get_training_ray_store: finish, {:.1f} MB{}{} (eps time: {} sec)'.format(
+        store.nbytes() / 2**20, ', rays on the fly' if on_the_fly else '',
+        '' if quantize else ', colors are not 8-bit so kept in ' + str(rgb_dtype), eps_time))
+    return store
+
+
+class RaySampler:
+    '''The training batches of a ray_sampler mode, drawn from a RayStore.
+
+    With prefetch > 0 a background thread assembles the batches of the coming steps, in
+    pinned memory when the store is on the cpu, and ships each of them to `device` with a
+    single non-blocking copy on a side stream. The batches are drawn with generators of
+    their own (seeded from the global ones), so they don't depend on the prefetching.
+    '''
+    def __init__(self, ray_store, mode, N_rand, device, steps, views=None, frame_times=None,
+                 timesteps=None, precrop_iters_time=0, prefetch=4):
+        self.ray_store = ray_store
+        self.mode = mode
+        self.N_rand = N_rand
+        self.device = torch.device(device)
+        self.steps = steps                                 # the global steps to draw batches for, in order
+        self.views = np.arange(len(ray_store)) if views is None else np.asarray(views)
+        self.frame_times = None if frame_times is None else frame_times.to(ray_store.rgb.device)
+        self.timesteps = timesteps
+        self.precrop_iters_time = precrop_iters_time
+        seed = int(np.random.randint(2**31))
+        self.rng = np.random.RandomState(seed)
+        self.generator = torch.Generator().manual_seed(seed)
+        if mode in ['flatten', 'in_maskcache']:
+            self.index_generator = batch_indices_generator(len(ray_store), N_rand, self.rng)
+        self.cuda = self.device.type == 'cuda'
+        self.stream = torch.cuda.Stream(self.device) if self.cuda else None
+        self.pin = self.cuda and ray_store.rgb.device.type == 'cpu'
+        self.buffers = [None] * (prefetch + 2)             # pinned staging buffers and their copy events
+        self.n_staged = 0
+        self.reset_stats()
+        self.prefetch = prefetch
+        self.stop = False
+        if prefetch > 0:
+            self.queue = queue.Queue(prefetch)
+            self.worker = threading.Thread(target=self._work, daemon=True)
+            self.worker.start()
+        else:
+            self.step_iter = iter(steps)
+
+    def draw(self, step):
+        '''img_i and the store index of the batch of global step `step`.'''
+        randint = lambda high: torch.randint(high, [self.N_rand], generator=self.generator)
+        H, W = self.ray_store.shape[1:3] if len(self.ray_store.shape) == 3 else (None, None)
+        if self.mode in ['flatten', 'in_maskcache']:
+            return None, next(self.index_generator)
+        elif self.mode == 'random':
+            return None, (randint(len(self.ray_store)), randint(H), randint(W))
+        elif self.mode == 'random_1im':
+            # Randomly select one image due to time step.
+            if step >= self.precrop_iters_time:
+                img_i = self.rng.choice(self.views)
+            else:
+                skip_factor = step / float(self.precrop_iters_time) * len(self.views)
+                max_sample = max(int(skip_factor), 3)
+                img_i = self.rng.choice(self.views[:max_sample])
+        elif self.mode == 'sequential_1im_fixed':
+            img_i = step % self.timesteps
+        else:
+            raise NotImplementedError
+        return int(img_i), (torch.tensor(img_i), randint(H), randint(W))
+
+    def _make(self, step):
+        t0 = time.time()
+        img_i, index = self.draw(step)
+        event = None
+        with torch.cuda.stream(self.stream) if self.cuda else contextlib.nullcontext():
+            batch = list(self.ray_store[index])
+            if self.frame_times is not None and img_i is not None:
+                batch.append(self.frame_times[img_i])
+            shapes = [t.shape for t in batch]
+            flat = [t.reshape(-1) for t in batch]
+            if self.pin:
+                slot = self.n_staged % len(self.buffers)
+                self.n_staged += 1
+                if self.buffers[slot] is None or self.buffers[slot][0].numel() != sum(t.numel() for t in flat):
+                    self.buffers[slot] = (torch.empty(sum(t.numel() for t in flat)).pin_memory(), None)
+                buf, copied = self.buffers[slot]
+                if copied is not None:
+                    copied.synchronize()
+                flat = torch.cat(flat, out=buf)
+            else:
+                flat = torch.cat(flat)
+            flat = flat.to(self.device, non_blocking=True)
+            if self.cuda:
+                event = torch.cuda.Event()
+                event.record(self.stream)
+                if self.pin:
+                    self.buffers[slot] = (buf, event)
+        self.n_made += 1
+        self.make_time += time.time() - t0
+        return step, img_i, shapes, flat, event
+
+    def _work(self):
+        try:
+            for step in self.steps:
+                item = self._make(step)
+                while not self.stop:
+                    try:
+                        self.queue.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if self.stop:
+                    return
+        except Exception as e:
+            self.queue.put(e)
+
+    def sample(self, step):
+        '''(target, rays_o, rays_d, viewdirs, frame_time, img_i) of global step `step` on
+        device; frame_time is None for the modes that don't pick an image.'''
+        t0 = time.time()
+        if self.prefetch > 0:
+            item = self.queue.get()
+            if isinstance(item, Exception):
+                raise item
+        else:
+            item = self._make(next(self.step_iter))
+        self.stall_time += time.time() - t0
+        self.n_sampled += 1
+        batch_step, img_i, shapes, flat, event = item
+        assert batch_step == step, f'RaySampler: asked for step {step} but drew {batch_step}'
+        if event is not None:
+            current = torch.cuda.current_stream(self.device)
+            current.wait_event(event)
+            flat.record_stream(current)
+        batch = [t.reshape(s) for t, s in zip(flat.split([s.numel() for s in shapes]), shapes)]
+        frame_time = batch[4] if len(batch) > 4 else None
+        return batch[0], batch[1], batch[2], batch[3], frame_time, img_i
+
+    def stats(self):
+        '''Seconds per batch the training loop waited for its batch, and spent assembling it
+        (on the background thread when prefetching).'''
+        n = max(self.n_sampled, 1)
+        return self.stall_time / n, self.make_time / max(self.n_made, 1)
+
+    def reset_stats(self):
+        self.stall_time = 0.
+        self.make_time = 0.
+        self.n_sampled = 0
+        self.n_made = 0
+
+    def close(self):
+        self.stop = True
+        if self.prefetch > 0:
+            self.worker.join()
+
+
+def batch_indices_generator(N, BS, rng=np.random):
     # torch.randperm on cuda produce incorrect results in my machine
-    idx, top = torch.LongTensor(np.random.permutation(N)), 0
+    idx, top = torch.LongTensor(rng.permutation(N)), 0
     while True:
         if top + BS > N:
-            idx, top = torch.LongTensor(np.random.permutation(N)), 0
+            idx, top = torch.LongTensor(rng.permutation(N)), 0
         yield idx[top:top+BS]
         top += BS
+
+
+def benchmark_decoder(n_points=65536, n_rays=1024, K=1, iters=20, n_freq=5, n_freq_view=5, z_dim=64, n_layers=3):
+    '''check the fused decoder paths against the reference one and time a forward+backward on CPU and GPU'''
+    kwargs = dict(n_freq=n_freq, n_freq_view=n_freq_view, input_dim=n_freq*6+3, input_ch_dim=n_freq_view*6+3,
+                  z_dim=z_dim, n_layers=n_layers)
+    for device in ['cpu'] + (['cuda'] if torch.cuda.is_available() else []):
+        torch.manual_seed(0)
+        sampling_coor = torch.rand([n_points, 3], device=device) * 2 - 1
+        sampling_view = F.normalize(torch.randn([n_rays, 3], device=device), dim=-1)
+        ray_id = torch.randint(0, n_rays, [n_points], device=device).sort()[0]
+        raw_density = torch.randn([K, n_points], device=device)
+
+        def step(decoder):
+            rgb, density, _, _ = decoder(sampling_coor, sampling_view, raw_density, ray_id, -4.6)
+            (rgb.square().sum() + density.sum()).backward()
+            return rgb.detach()
+
+        ref = networks.init_net(Decoder_woslot(**kwargs)).to(device)
+        for name, fused, compile_mode in [('reference', False, None), ('fused', True, None),
+                                     ('fused+script', True, 'script'), ('fused+compile', True, 'compile')]:
+            decoder = Decoder_woslot(**kwargs, fused=fused, compile_mode=compile_mode).to(device)
+            decoder.load_state_dict(ref.state_dict())
+            try:
+                rgb = step(decoder)  # warm up, and build the scripted/compiled graph
+            except Exception as e:
+                print(f'voxelMlp: {device} {name} skipped ({type(e).__name__}: {e})')
+                continue
+            if name == 'reference':
+                rgb_ref = rgb
+            if device == 'cuda':
+                torch.cuda.synchronize()
+            eps_time = time.time()
+            for _ in range(iters):
+                step(decoder)
+            if device == 'cuda':
+                torch.cuda.synchronize()
+            eps_time = (time.time() - eps_time) / iters
+            print(f'voxelMlp: {device} {name:14s} {eps_time*1000:8.2f} ms/iter, '
+                  f'rgb {"bitwise equal" if torch.equal(rgb, rgb_ref) else "max diff %.2e" % (rgb - rgb_ref).abs().max()}')
+
+
+if __name__=='__main__':
+    # python -m lib.voxelMlp
+    benchmark_decoder()
@@ -5,85 +5,103 @@ import numpy as np
 from sklearn.cluster import DBSCAN
 import skimage
 
-import dgl
-import networkx
-from tqdm import tqdm
 from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components as graph_components
+
+
+def neighbour_offsets(connectivity=26):
+    #one offset per undirected pair of neighbours, 13 for 26-connectivity and 3 for 6-connectivity
+    assert connectivity in [6, 26]
+    offsets = np.stack(np.meshgrid([-1, 0, 1], [-1, 0, 1], [-1, 0, 1], indexing='ij'), -1).reshape(-1, 3)
+    if connectivity == 6:
+        offsets = offsets[np.abs(offsets).sum(1) == 1]
+    return np.array([o for o in offsets if tuple(o) > (0, 0, 0)])
+
 #density thresh 1e-2, dx_thresh 0.08, rgb= 0.06 by default , rgb = 0.3 for metal
-def connected_components(binary_mask,dx,rgb, dx_thresh= 0.08, rgb_thresh = 0.06):
+def connected_components(binary_mask,dx,rgb, dx_thresh= 0.08, rgb_thresh = 0.06, connectivity = 26):
     #binary_mask[H,W,D]
     #dx [T, 3, H, W,D]
     #rgb[3,H,W,D]
     #This algorithm is not so sensitive to hyperparameters, and usually a value between the mean and median is a good choice.
-    num_nodes = np.sum(binary_mask > 0)
-    print(rgb.shape)
-    g = dgl.graph([],num_nodes = num_nodes)
-    
-    idx2num = (np.zeros(binary_mask.shape) -1).astype(np.int32)
-    idx2num[binary_mask == 1] = np.arange(num_nodes)
-    
-    obj_x, obj_y, obj_z = np.nonzero(binary_mask)
+    #Two occupied neighbours are connected if their dx and rgb are both close, edges are built for all
+    #the neighbour offsets at once and labelled as a sparse graph.
+    binary_mask = binary_mask > 0
+    num_nodes = int(binary_mask.sum())
+
+    idx2num = np.full(binary_mask.shape, -1, dtype=np.int64)
+    idx2num[binary_mask] = np.arange(num_nodes)
+
+    obj = np.stack(np.nonzero(binary_mask), -1)  #[N,3]
+    dx_obj = dx[:, :, obj[:,0], obj[:,1], obj[:,2]]  #[T,3,N]
+    rgb_obj = rgb[:, obj[:,0], obj[:,1], obj[:,2]]  #[3,N]
+
     srcs = []
     tgts = []
-    dx_dists = []
-    rgb_dists = []
-    
-    for i in tqdm(range(obj_x.shape[0])):
-        x, y, z = obj_x[i], obj_y[i], obj_z[i]
-        src = idx2num[x,y,z]
-        dx_src = dx[:,:,x,y,z]
-        rgb_src = rgb[:, x, y, z]
-        for u in range(x-1,x+1):
-            for v in range(y-1, y+1):
-                for k in range(z-1,z+1):
-                    tgt = idx2num[u,v,k]
-                    if tgt ==-1 or tgt==src:
-                        continue
-                    dx_tgt = dx[:,:,u,v,k]  #[T,3]
-
-                    dx_dist = np.sqrt(((dx_tgt - dx_src)**2).sum(1)).max()
-                    dx_dists.append(dx_dist)
-
-                    rgb_tgt = rgb[:, u, v, k]
-                    rgb_dist = np.sqrt(((rgb_src - rgb_tgt)**2).sum())
-
-                    rgb_dists.append(rgb_dist)
-
-                    if dx_dist < dx_thresh and rgb_dist< rgb_thresh:
-                        srcs.append(src)
-                        tgts.append(tgt)
-              
- 
-    g = dgl.add_edges(g,srcs,tgts)
-    
-    ngx = dgl.to_networkx(g)
-    ngx = ngx.to_undirected()
-   
-    labels_ = np.zeros([num_nodes],dtype = np.int32)
-    compnts = networkx.connected_components(ngx)
-    for (label, node_list) in enumerate(compnts):
-        for node in node_list:
-            labels_[node] = label + 1
-    
+    for offset in neighbour_offsets(connectivity):
+        nb = obj + offset
+        inside = ((nb >= 0) & (nb < binary_mask.shape)).all(1)
+        src = np.nonzero(inside)[0]
+        tgt = idx2num[nb[inside,0], nb[inside,1], nb[inside,2]]
+        src, tgt = src[tgt >= 0], tgt[tgt >= 0]
+
+        dx_dist = np.sqrt(((dx_obj[:,:,src] - dx_obj[:,:,tgt])**2).sum(1)).max(0, initial=0)
+        rgb_dist = np.sqrt(((rgb_obj[:,src] - rgb_obj[:,tgt])**2).sum(0))
+        edge = (dx_dist < dx_thresh) & (rgb_dist < rgb_thresh)
+        srcs.append(src[edge])
+        tgts.append(tgt[edge])
+
+    srcs = np.concatenate(srcs)
+    tgts = np.concatenate(tgts)
+    g = coo_matrix((np.ones(len(srcs), dtype=np.int8), (srcs, tgts)), shape=(num_nodes, num_nodes))
+    _, labels_ = graph_components(g, directed=False)
+
     labels = np.zeros(binary_mask.shape,dtype = np.int32)
-    labels[binary_mask > 0] = labels_
-    #print(max(dx_dists),min(dx_dists), sum(dx_dists)/len(dx_dists))
+    labels[binary_mask] = labels_ + 1
+    return labels
 
-    dx_dists.sort()
-    mid = len(dx_dists) // 2
-    res = (dx_dists[mid] + dx_dists[~mid]) / 2
-    #print(res)
+#connected_components
 
-    #print(max(rgb_dists),min(rgb_dists), sum(rgb_dists)/len(rgb_dists))
+def labels_to_density(labels, density, binary_mask, importance, num_slots):
+    #labels[X,Y,Z], 0 for background
+    #density[X,Y,Z]
+    #return the density split into [1, num_slots, X, Y, Z]
+    num_labels = labels.max()
 
-    rgb_dists.sort()
-    mid = len(rgb_dists) // 2
-    res = (rgb_dists[mid] +rgb_dists[~mid]) / 2
-    #print(res)
+    #calculate the size of each connected components by their contribution to the rendered image
+    size = np.bincount(labels.reshape(-1), weights=(binary_mask * importance).reshape(-1), minlength=num_labels+1)[1:]
+    sort_idx = np.argsort(size)[::-1]
 
-    return labels
+    new_density = np.zeros([1, num_slots, *density.shape])
 
-#connected_components
+    #process background
+    bg = labels == 0
+    new_density[0][:, bg] = np.minimum(density[bg] / num_slots, 1e-4)
+
+    print(num_labels)
+
+    # re-organize label by their size
+    lut = np.zeros([num_labels+1], dtype=labels.dtype)
+    lut[sort_idx+1] = np.arange(1, num_labels+1)
+    labels = lut[labels]
+
+    # using nearest interpolation for N-num_slots smallest connected components
+    labels_nearest = labels.copy()
+    labels_copy = labels.copy()
+    labels_nearest[labels_nearest>num_slots] = 0
+    labels_nearest = 1 - (labels_nearest >0)
+    _,indices = ndimage.distance_transform_edt(labels_nearest,return_indices = True)
+    x,y,z = indices[:,...]
+    labels_copy = labels_copy[x,y,z]
+    labels[labels>0] = labels_copy[labels > 0]
+
+    #the remaining labels fill the slots in order of size, the last slot takes the rest
+    present = np.unique(labels[labels > 0])
+    slot = np.zeros([num_labels+1], dtype=np.int64)
+    slot[present] = np.minimum(np.arange(len(present)), num_slots-1)
+    fg = np.nonzero(labels > 0)
+    new_density[0, slot[labels[fg]], fg[0], fg[1], fg[2]] = density[fg]
+    return new_density
 
 def post_process(density, act_shift,num_slots,dx,rgb,thresh = 1e-3,method = 'cc',hyper=False, importance = None):
    
@@ -115,71 +133,54 @@ def post_process(density, act_shift,num_slots,dx,rgb,thresh = 1e-3,method = 'cc'
         assert labels.min() == 0
 
         #make labels continuous
-        unique_labels = np.unique(labels)
-        new_label = np.zeros(labels.shape)
-        for (idx, i ) in enumerate(unique_labels):
-            new_label[labels == i] = idx
-        labels = new_label.copy().astype(np.int64).reshape(binary_mask.shape)
+        _, labels = np.unique(labels, return_inverse=True)
+        labels = labels.astype(np.int64).reshape(binary_mask.shape)
 
     else:
         raise NotImplementedError
 
-    #calculate the size of each connected components by their contribution to the rendered image
-    size = np.zeros([labels.max()])
-    for i in range(1, labels.max() + 1):
-        size[i-1] =(binary_mask[labels == i] *  (importance[labels == i])).sum()
-
-    sort_idx = np.argsort(size)[::-1]
-    sorted_size = size[sort_idx]
-
-
-    new_density = np.zeros([1, num_slots, *density.shape])
-
-    #process background
-    bg = np.where(labels == 0 )
-    base_density = (density[bg[0], bg[1], bg[2]] / num_slots)[:, None].repeat(num_slots,axis = 1)
-    base_density[base_density>1e-4] = 1e-4
-    new_density[0,:,bg[0], bg[1], bg[2]] = base_density
-
-    size = np.zeros([labels.max()])  
-    print(labels.max())
-
-    # re-organize label by their size
-    labels_copy = labels.copy()
-    for i in range(sort_idx.shape[0]):
-        x ,y,z= np.where(labels == (sort_idx[i]+1))
-        labels_copy[labels==(sort_idx[i] + 1)] = (i+1)
-
-    labels = labels_copy.copy()
-    
-
-    # using nearest interpolation for N-num_slots smallest connected components
-    labels_nearest = labels.copy()
-    labels_copy = labels.copy()
-    labels_nearest[labels_nearest>num_slots] = 0
-    labels_nearest = 1 - (labels_nearest >0)
-    _,indices = ndimage.distance_transform_edt(labels_nearest,return_indices = True)
-    x,y,z = indices[:,...]
-    labels_copy = labels_copy[x,y,z]
-    labels[labels>0] = labels_copy[labels > 0]
-    
-   
-
-    
-
-    count =0
-    for i in range(sort_idx.shape[0]):
-        if not (labels==(i+1)).any():
-            continue
-        new_density[0,count, labels == (i + 1)] = density[labels == (i + 1)]
-        count += 1
-        count = min(num_slots-1, count)
-
+    new_density = labels_to_density(labels, density, binary_mask, importance, num_slots)
 
     new_density = torch.from_numpy(new_density)        
     masks = new_density / (new_density.sum(1,keepdim = True) + 1e-5)
-    torch.set_default_tensor_type(torch.cuda.FloatTensor)
+    if torch.cuda.is_available():
+        torch.set_default_tensor_type(torch.cuda.FloatTensor)
     return masks
    
 
 
+def benchmark_relabel(label_counts=(10, 100, 1000, 10000), shape=(110, 110, 110), num_slots=10):
+    #time labels_to_density against the number of fragments
+    import time
+    rng = np.random.default_rng(0)
+    density = rng.random(shape)
+    importance = rng.random(shape)
+    for num_labels in label_counts:
+        labels = rng.integers(0, num_labels+1, shape)
+        tic = time.time()
+        labels_to_density(labels, density, labels > 0, importance, num_slots)
+        print(f'post_process: relabel {num_labels} components on {shape} in {time.time()-tic:.2f}s')
+
+
+if __name__=='__main__':
+    #time the labelling on the volumes saved by run_full.py --dump_volumes
+    import time
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('volumes', nargs='?', help='npz file with density, act_shift, dx and rgb')
+    parser.add_argument('--thresh', type=float, default=1e-2, help='thresh to determine forground and background.')
+    parser.add_argument('--benchmark_relabel', action='store_true', help='time the relabelling against the number of components')
+    args = parser.parse_args()
+
+    if args.benchmark_relabel:
+        benchmark_relabel()
+    if args.volumes is None:
+        exit()
+    volumes = np.load(args.volumes)
+    density = F.softplus(torch.from_numpy(volumes['density'][0,0]) + float(volumes['act_shift'])).numpy()
+    binary_mask = density >= args.thresh
+    for connectivity in [6, 26]:
+        tic = time.time()
+        labels = connected_components(binary_mask, volumes['dx'], volumes['rgb'], connectivity=connectivity)
+        print(f'post_process: {connectivity}-connectivity over {binary_mask.sum()} voxels, '
+              f'{labels.max()} components in {time.time()-tic:.2f}s')
@@ -15,7 +15,7 @@ import torch.nn.functional as F
 from lib import utils
 from lib import voxelMlp as VoxelMlp
 
-from lib.load_data import load_data_ours
+from lib.load_data import load_data_ours, load_data_cached
 from lib.load_data import load_data
 from post_process import post_process
 from torch.utils.tensorboard import SummaryWriter
@@ -54,6 +54,8 @@ def config_parser():
     parser.add_argument("--eval_lpips_alex", action='store_true')
     parser.add_argument("--eval_lpips_vgg", action='store_true')
     parser.add_argument("--bs", type=int, default=4096)
+    parser.add_argument("--sync_writes", action='store_true',
+                        help='write the rendered images on the main thread, to measure the overlap of the background writers')
 
     # logging/saving options
     parser.add_argument("--i_print",   type=int, default=500,
@@ -65,14 +67,20 @@ def config_parser():
     parser.add_argument('--per_slot', action='store_true',help = 'whether to render per slot result')
     parser.add_argument("--num_slots",   type=int, default=10,help = 'number of slots')
     parser.add_argument("--thresh",   type=float, default=1e-2,help='thresh to determine forground and background.')
+    parser.add_argument('--dump_volumes', action='store_true',help = 'save the inputs of post_process to benchmark it')
+    parser.add_argument('--benchmark_fused', action='store_true',help = 'time the dynamic+static training step as two passes and fused before training')
+    parser.add_argument('--benchmark_amp', action='store_true',help = 'compare the PSNR curves of fp32 and mixed precision training (fine_train.amp) before training')
     return parser
 
 
 @torch.no_grad()
 def render_viewpoints(model, render_poses, HW, Ks, frame_times, ndc, render_kwargs,
                       gt_imgs=None, savedir=None, render_factor=0,  stc_data=False, bs=4096,
-                      eval_ssim=False, eval_lpips_alex=False, slot_idx = -1,mask = None,eval_lpips_vgg=False, writer=None, gs=-1):
+                      eval_ssim=False, eval_lpips_alex=False, slot_idx = -1,mask = None,eval_lpips_vgg=False, writer=None, gs=-1,
+                      video_name='video', fps=10, async_writes=True):
     '''Render images for the given viewpoints; run evaluation if gt given.
+    Every frame goes straight to the metrics and the image/video writers, nothing is kept per frame.
+    The writers run on background threads while the next frame renders.
     '''
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')    
 
@@ -82,52 +90,30 @@ def render_viewpoints(model, render_poses, HW, Ks, frame_times, ndc, render_kwar
         HW //= render_factor
         Ks[:, :2, :3] //= render_factor
 
-    rgbs = []
-    depths = []
-    segmentations = []
     psnrs = []
     ssims = []
     lpips_alex = []
     lpips_vgg = []   
     mses = []
 
-    eps_render = time.time()
-    for i, c2w in enumerate(tqdm(render_poses)):
-
-        H, W = HW[i]
-        K = Ks[i]
-        frame_time = frame_times[i]
-    
-        frame_time = frame_time.to(device)
-        rays_o, rays_d, viewdirs = VoxelMlp.get_rays_of_a_view(
-                H, W, K, c2w, ndc, inverse_y=render_kwargs['inverse_y'],
-                flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y)
-        keys = ['rgb_marched', 'depth', 'segmentation']
-        rays_o = rays_o.flatten(0,-2)
-        rays_d = rays_d.flatten(0,-2)
-        viewdirs = viewdirs.flatten(0,-2)
-
-
-        render_result_chunks = [
-            {k: v for k, v in model(ro, rd, vd, frame_time, i, start=(frame_time==0), training_flag=False, stc_data=stc_data, slot_idx = slot_idx,mask =mask,**render_kwargs).items() if k in keys}
-            for ro, rd, vd in zip(rays_o.split(bs, 0), rays_d.split(bs, 0), viewdirs.split(bs, 0))
-        ]
-
-        render_result = {
-            k: torch.cat([ret[k] for ret in render_result_chunks]).reshape(H,W,-1)
-            for k in render_result_chunks[0].keys()
-        }
-
+    render_writer = None
+    io = utils.AsyncWriter(enabled=async_writes)
+    if savedir is not None:
+        print(f'Writing images to {savedir}')
+        render_writer = utils.RenderWriter(savedir, len(render_poses), video_name=video_name, fps=fps, depth_png=False)
 
+    eps_render = time.time()
+    model.reset_march_stats()
+    renders = model.render_batch(
+            render_poses, Ks, HW, frame_times, ndc, bs=bs, keys=['rgb_marched', 'depth', 'segmentation'],
+            stc_data=stc_data, slot_idx=slot_idx, mask=mask, **render_kwargs)
+    for i, render_result in tqdm(renders, total=len(render_poses)):
+        c2w = render_poses[i]
         rgb = render_result['rgb_marched'].cpu().numpy()
         depth = render_result['depth'].cpu().numpy()
 
-        rgbs.append(rgb)
-        depths.append(depth)
-
-        if render_kwargs.get('segmentation', True):
-            seg = render_result['segmentation'].cpu().numpy()
-            segmentations.append(seg)
+        if render_writer is not None:
+            io.submit('rgb', render_writer.append, i, rgb, depth)
 
         if i==0:
             print('Testing', rgb.shape)
@@ -147,6 +133,15 @@ def render_viewpoints(model, render_poses, HW, Ks, frame_times, ndc, render_kwar
     eps_render = time.time() - eps_render
     eps_time_str = f'{eps_render//3600:02.0f}:{eps_render//60%60:02.0f}:{eps_render%60:02.0f}'
     print('render: render takes ', eps_time_str)
+    if render_kwargs.get('segment_steps', 0) > 0:
+        print(f'render: early ray termination skipped {model.march_skipped_fraction()*100:5.2f}% of the samples')
+
+    if render_writer is not None:
+        io.submit('rgb', render_writer.close)
+    write_time, wait_time = io.close()
+    if savedir is not None:
+        # compare with a --sync_writes run, where the render loop waits for every write
+        print(f'render: render loop waited {wait_time:.2f}s on the image writers (writer threads busy {write_time:.2f}s)')
 
     if len(psnrs):
         print('Testing psnr', np.mean(psnrs), '(avg)')
@@ -168,20 +163,73 @@ def render_viewpoints(model, render_poses, HW, Ks, frame_times, ndc, render_kwar
             if writer is not None:
                 writer.add_scalar('test/alex', np.mean(lpips_alex), gs)
 
-    if savedir is not None:
-        os.makedirs(os.path.join(savedir, 'depth'), exist_ok=True)
-        print(f'Writing images to {savedir}')
-        for i in trange(len(rgbs)):
-            rgb8 = utils.to8b(rgbs[i])
-            depth8 = utils.to8b(1 - depths[i] / np.max(depths))
-            filename = os.path.join(savedir, '{:03d}.png'.format(i))
-            imageio.imwrite(filename, rgb8)
-
-
-    rgbs = np.array(rgbs)
-    depths = np.array(depths)
 
-    return rgbs, depths
+def benchmark_fused_forward(model, ray_store, ray_store_stc, views_stc, frame_times, cfg_train, render_kwargs, iters=20):
+    '''Time the forward and backward of a dynamic and a static training batch, as two passes and fused.'''
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    steps = range(iters)
+    sampler = VoxelMlp.RaySampler(ray_store, cfg_train.ray_sampler, cfg_train.N_rand, device, steps,
+                                  frame_times=frame_times, timesteps=frame_times.shape[0], prefetch=0)
+    sampler_stc = VoxelMlp.RaySampler(ray_store_stc, 'random_1im', cfg_train.N_rand, device, steps, views=views_stc, prefetch=0)
+    batches = [(sampler.sample(step), sampler_stc.sample(step)) for step in steps]
+    frame_time_stc = frame_times[0].to(device)
+    for fused in [False, True]:
+        for i in range(2):  # warm up, then time
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            tic = time.time()
+            for step, (batch, batch_stc) in enumerate(batches):
+                target, rays_o, rays_d, viewdirs, frame_time, img_i = batch
+                target_stc, rays_o_stc, rays_d_stc, viewdirs_stc, _, _ = batch_stc
+                if fused:
+                    ret, ret_stc = model.forward_fused(rays_o, rays_d, viewdirs, frame_time, rays_o_stc, rays_d_stc, viewdirs_stc,
+                                                       img_i, global_step=step, start=(frame_time==0), **render_kwargs)
+                else:
+                    ret = model(rays_o, rays_d, viewdirs, frame_time, img_i, global_step=step, start=(frame_time==0), **render_kwargs)
+                    ret_stc = model(rays_o_stc, rays_d_stc, viewdirs_stc, frame_time_stc, 0, global_step=step, start=True, stc_data=True, **render_kwargs)
+                loss = F.mse_loss(ret['rgb_marched'], target) + F.mse_loss(ret_stc['rgb_marched'], target_stc) + ret['cycle_loss']
+                loss.backward()
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+        eps = time.time() - tic
+        print(f'benchmark_fused_forward: fused={fused}: {eps/iters*1000:.1f} ms per iter')
+    model.zero_grad(set_to_none=True)
+
+
+def benchmark_amp(model, ray_store, frame_times, timesteps, cfg_train, render_kwargs, iters=300, every=25):
+    '''Train copies of the model in fp32 and in mixed precision on the same batches and compare their PSNR curves.'''
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    amp = cfg_train.get('amp', None) or ('float16' if device.type == 'cuda' else 'bfloat16')
+    steps = range(iters)
+    sampler = VoxelMlp.RaySampler(ray_store, cfg_train.ray_sampler, cfg_train.N_rand, device, steps,
+                                  frame_times=frame_times, timesteps=timesteps, prefetch=0)
+    batches = [sampler.sample(step) for step in steps]
+    curves = {}
+    for mode in [None, amp]:
+        net = copy.deepcopy(model)
+        optimizer = utils.create_optimizer_or_freeze_model(net, cfg_train, global_step=0)
+        amp_dtype, scaler = utils.create_amp({'amp': mode}, device)
+        curves[mode] = []
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        tic = time.time()
+        for step, (target, rays_o, rays_d, viewdirs, frame_time, img_i) in enumerate(batches):
+            with torch.autocast(device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                ret = net(rays_o, rays_d, viewdirs, frame_time, img_i, global_step=step, start=(frame_time==0), **render_kwargs)
+            mse = F.mse_loss(ret['rgb_marched'], target)
+            optimizer.zero_grad(set_to_none=True)
+            scaler.scale(cfg_train.weight_main * mse + cfg_train.weight_cycle * ret['cycle_loss']).backward()
+            scaler.step(optimizer)
+            scaler.update()
+            curves[mode].append(utils.mse2psnr(mse.detach()).item())
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        eps = time.time() - tic
+        print(f'benchmark_amp: {mode or "float32"}: {eps/iters*1000:.1f} ms per iter')
+        del net, optimizer
+    for i in range(0, iters, every):
+        print(f'benchmark_amp: iter {i+every:6d} / PSNR float32 {np.mean(curves[None][i:i+every]):5.2f} / '
+              f'{amp} {np.mean(curves[amp][i:i+every]):5.2f}')
 
 
 def seed_everything():
@@ -197,8 +245,8 @@ def load_everything(args, cfg):
     '''Load images / poses / camera settings / data split.
     '''
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    data_dict = load_data_ours(cfg.data)
-    data_dict_static = load_data(cfg.data_static)
+    data_dict = load_data_cached(cfg.data, load_data_ours)
+    data_dict_static = load_data_cached(cfg.data_static, load_data)
 
     # remove useless field
     kept_keys = {
@@ -212,6 +260,9 @@ def load_everything(args, cfg):
     # construct data tensor
     if data_dict['irregular_shape']:
         data_dict['images'] = [torch.FloatTensor(im, device='cpu') for im in data_dict['images']]
+    elif data_dict['images'].dtype == np.float16:
+        # memory-mapped from the dataset cache, zero-copy
+        data_dict['images'] = torch.from_numpy(data_dict['images'])
     else:
         data_dict['images'] = torch.FloatTensor(data_dict['images'], device='cpu')
     data_dict['poses'] = torch.Tensor(data_dict['poses'])
@@ -233,6 +284,9 @@ def load_everything(args, cfg):
     # construct data tensor
     if data_dict_static['irregular_shape']:
         data_dict_static['images'] = [torch.FloatTensor(im, device='cpu') for im in data_dict_static['images']]
+    elif data_dict_static['images'].dtype == np.float16:
+        # memory-mapped from the dataset cache, zero-copy
+        data_dict_static['images'] = torch.from_numpy(data_dict_static['images'])
     else:
         data_dict_static['images'] = torch.FloatTensor(data_dict_static['images'], device='cpu')
     data_dict_static['poses'] = torch.Tensor(data_dict_static['poses'])
@@ -313,6 +367,7 @@ def scene_rep_reconstruction(args, cfg, cfg_model, cfg_train, data_dict, data_di
 
     model = model_class(num_voxels = num_voxels, timesteps=timesteps, warp_ray=warp_ray, world_motion_bound_scale=world_motion_bound_scale, **model_kwargs)
     optimizer = utils.create_optimizer_or_freeze_model(model, cfg_train, global_step=0)
+    amp_dtype, scaler = utils.create_amp(cfg_train, device)
 
     if model_kwargs.maskout_near_cam_vox:
         print("maskout near vox")
@@ -341,79 +396,61 @@ def scene_rep_reconstruction(args, cfg, cfg_model, cfg_train, data_dict, data_di
     }
 
     def gather_static_training_rays():
-        
-        rgb_tr_ori = images_stc[i_train_stc].to('cpu' if cfg.data.load2gpu_on_the_fly else device)
-
-        # if cfg_train.ray_sampler == 'in_maskcache':
-        rgb_tr, rays_o_tr, rays_d_tr, viewdirs_tr, imsz = VoxelMlp.get_training_rays(
-                    rgb_tr=rgb_tr_ori,
+        ray_store = VoxelMlp.get_training_ray_store(
+                    rgb_tr_ori=images_stc[i_train_stc],
                     train_poses=poses_stc[i_train_stc],
                     HW=HW_stc[i_train_stc], Ks=Ks_stc[i_train_stc],
                     ndc=cfg.data.ndc, inverse_y=cfg.data.inverse_y,
                     flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y,
-                    )
-        
-        index_generator = VoxelMlp.batch_indices_generator(len(rgb_tr), cfg_train.N_rand)
-        batch_index_sampler = lambda: next(index_generator)
-        return rgb_tr, rays_o_tr, rays_d_tr, viewdirs_tr, imsz, batch_index_sampler
+                    device='cpu' if cfg.data.load2gpu_on_the_fly else device,
+                    dirs_dtype=cfg_train.ray_dirs_dtype, on_the_fly=cfg_train.rays_on_the_fly)
+        return ray_store
 
     
     def gather_training_rays():
         if data_dict['irregular_shape']:
-            rgb_tr_ori = [images[i].to('cpu' if cfg.data.load2gpu_on_the_fly else device) for i in i_train]
+            rgb_tr_ori = [images[i] for i in i_train]
         else:
-            rgb_tr_ori = images[i_train].to('cpu' if cfg.data.load2gpu_on_the_fly else device)
+            rgb_tr_ori = images[i_train]
 
-        if cfg_train.ray_sampler == 'in_maskcache':
-            rgb_tr, rays_o_tr, rays_d_tr, viewdirs_tr, imsz = VoxelMlp.get_training_rays_in_maskcache_sampling(
-                    rgb_tr_ori=rgb_tr_ori,
-                    train_poses=poses[i_train],
-                    HW=HW[i_train], Ks=Ks[i_train],
-                    ndc=cfg.data.ndc, inverse_y=cfg.data.inverse_y,
-                    flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y,
-                    model=model, render_kwargs=render_kwargs)
-        elif cfg_train.ray_sampler == 'flatten':
-            rgb_tr, rays_o_tr, rays_d_tr, viewdirs_tr, imsz = VoxelMlp.get_training_rays_flatten(
+        ray_store = VoxelMlp.get_training_ray_store(
                 rgb_tr_ori=rgb_tr_ori,
                 train_poses=poses[i_train],
-                HW=HW[i_train], Ks=Ks[i_train], ndc=cfg.data.ndc, inverse_y=cfg.data.inverse_y,
-                flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y)
-        else:
-            rgb_tr, rays_o_tr, rays_d_tr, viewdirs_tr, imsz = VoxelMlp.get_training_rays(
-                rgb_tr=rgb_tr_ori,
-                train_poses=poses[i_train],
-                HW=HW[i_train], Ks=Ks[i_train], ndc=cfg.data.ndc, inverse_y=cfg.data.inverse_y,
-                flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y)
-        index_generator = VoxelMlp.batch_indices_generator(len(rgb_tr), cfg_train.N_rand)
-        batch_index_sampler = lambda: next(index_generator)
-        return rgb_tr, rays_o_tr, rays_d_tr, viewdirs_tr, imsz, batch_index_sampler
-
-    rgb_tr, rays_o_tr, rays_d_tr, viewdirs_tr, imsz, batch_index_sampler = gather_training_rays()
-    rgb_tr_stc, rays_o_tr_stc, rays_d_tr_stc, viewdirs_tr_stc, imsz_stc, batch_index_sampler_stc = gather_static_training_rays()
-
-
-    if not cfg.data.load2gpu_on_the_fly:
-        rgb_tr = rgb_tr.to(device)
-        rays_o_tr = rays_o_tr.to(device)
-        rays_d_tr = rays_d_tr.to(device)
-        viewdirs_tr = viewdirs_tr.to(device)
-        frame_times = frame_times.to(device)
-        rgb_tr_stc = rgb_tr_stc.to(device)
-        rays_o_tr_stc = rays_o_tr_stc.to(device)
-        rays_d_tr_stc = rays_d_tr_stc.to(device)
-        viewdirs_tr_stc = viewdirs_tr_stc.to(device)
-
-        if not cfg.data.ndc:
-            rgb_tr_stc = rgb_tr.to(device)
-            rays_o_tr_stc = rays_o_tr.to(device)
-            rays_d_tr_stc = rays_d_tr.to(device)
-            viewdirs_tr_stc = viewdirs_tr.to(device)
+                HW=HW[i_train], Ks=Ks[i_train],
+                ndc=cfg.data.ndc, inverse_y=cfg.data.inverse_y,
+                flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y,
+                flatten=(cfg_train.ray_sampler == 'flatten'),
+                model=model if cfg_train.ray_sampler == 'in_maskcache' else None, render_kwargs=render_kwargs,
+                device='cpu' if cfg.data.load2gpu_on_the_fly else device,
+                dirs_dtype=cfg_train.ray_dirs_dtype, on_the_fly=cfg_train.rays_on_the_fly)
+        return ray_store
+
+    ray_store = gather_training_rays()
+    steps = range(start, cfg_train.N_iters)
+    ray_sampler = VoxelMlp.RaySampler(
+            ray_store, cfg_train.ray_sampler, cfg_train.N_rand, device, steps=steps,
+            views=i_train, frame_times=frame_times, timesteps=frame_times.shape[0],
+            precrop_iters_time=cfg_train.get('precrop_iters_time', 0), prefetch=cfg_train.prefetch_batches)
+    ray_sampler_stc = None
+    if not cfg.data.ndc:
+        # without load2gpu_on_the_fly the static batches are drawn from the dynamic rays
+        ray_store_stc = gather_static_training_rays() if cfg.data.load2gpu_on_the_fly else ray_store
+        ray_sampler_stc = VoxelMlp.RaySampler(
+                ray_store_stc, 'random_1im', cfg_train.N_rand, device, steps=steps,
+                views=i_train_stc[:cfg.data_static.num_train], prefetch=cfg_train.prefetch_batches)
+    frame_time_stc = frame_times[0].to(device)
+    if args.benchmark_fused and not cfg.data.ndc:
+        benchmark_fused_forward(model, ray_store, ray_store_stc, i_train_stc[:cfg.data_static.num_train],
+                                frame_times, cfg_train, render_kwargs)
+    if args.benchmark_amp:
+        benchmark_amp(model, ray_store, frame_times, timesteps, cfg_train, render_kwargs)
 
     # view-count-based learning rate
     if cfg_train.pervoxel_lr:
         def per_voxel_init():
+            rays_o_tr, rays_d_tr = ray_store.dense_rays()
             cnt = model.voxel_count_views(
-                    rays_o_tr=rays_o_tr, rays_d_tr=rays_d_tr, imsz=imsz, near=near, far=far,
+                    rays_o_tr=rays_o_tr, rays_d_tr=rays_d_tr, imsz=ray_store.imsz, near=near, far=far,
                     stepsize=cfg_model.stepsize, downrate=cfg_train.pervoxel_lr_downrate,
                     irregular_shape=data_dict['irregular_shape'])
             optimizer.set_pervoxel_lr(cnt)
@@ -442,82 +479,26 @@ def scene_rep_reconstruction(args, cfg, cfg_model, cfg_train, data_dict, data_di
     
 
         # random sample rays
-        if cfg_train.ray_sampler in ['flatten', 'in_maskcache']:
-            sel_i = batch_index_sampler()
-            target = rgb_tr[sel_i]
-            rays_o = rays_o_tr[sel_i]
-            rays_d = rays_d_tr[sel_i]
-            viewdirs = viewdirs_tr[sel_i]
-        elif cfg_train.ray_sampler == 'random':
-            sel_b = torch.randint(rgb_tr.shape[0], [cfg_train.N_rand])
-            sel_r = torch.randint(rgb_tr.shape[1], [cfg_train.N_rand])
-            sel_c = torch.randint(rgb_tr.shape[2], [cfg_train.N_rand])
-            target = rgb_tr[sel_b, sel_r, sel_c]
-            rays_o = rays_o_tr[sel_b, sel_r, sel_c]
-            rays_d = rays_d_tr[sel_b, sel_r, sel_c]
-            viewdirs = viewdirs_tr[sel_b, sel_r, sel_c]
-        elif cfg_train.ray_sampler == 'random_1im':
-            # Randomly select one image due to time step.
-            if global_step >= cfg_train.precrop_iters_time:
-                img_i = np.random.choice(i_train)
-            else:
-                skip_factor = global_step / float(cfg_train.precrop_iters_time) * len(i_train)
-                max_sample = max(int(skip_factor), 3)
-                img_i = np.random.choice(i_train[:max_sample])
-            # Require i_train order is the same as the above reordering of training images. 
-            sel_r = torch.randint(rgb_tr.shape[1], [cfg_train.N_rand])
-            sel_c = torch.randint(rgb_tr.shape[2], [cfg_train.N_rand])
-            target = rgb_tr[img_i, sel_r, sel_c]
-            rays_o = rays_o_tr[img_i, sel_r, sel_c]
-            rays_d = rays_d_tr[img_i, sel_r, sel_c]
-            viewdirs = viewdirs_tr[img_i, sel_r, sel_c]
-            frame_time = frame_times[img_i].to(target.device)
-        elif cfg_train.ray_sampler == 'sequential_1im_fixed':
-
-            img_i = global_step % frame_times.shape[0]
-
-            img_i = torch.tensor(img_i,device = "cpu" if cfg.data.load2gpu_on_the_fly else device)
-            sel_r = torch.randint(rgb_tr.shape[1], [cfg_train.N_rand]).to("cpu" if cfg.data.load2gpu_on_the_fly else device)
-            sel_c = torch.randint(rgb_tr.shape[2], [cfg_train.N_rand]).to("cpu" if cfg.data.load2gpu_on_the_fly else device)
-            target = rgb_tr[img_i, sel_r, sel_c]
-            rays_o = rays_o_tr[img_i, sel_r, sel_c]
-            rays_d = rays_d_tr[img_i, sel_r, sel_c]
-            viewdirs = viewdirs_tr[img_i, sel_r, sel_c]
-            frame_time = frame_times[img_i]
-          
-        else:
-            raise NotImplementedError
+        target, rays_o, rays_d, viewdirs, frame_time, img_i = ray_sampler.sample(global_step)
 
         # model for static data
         if not cfg.data.ndc:
-            img_i_stc = np.random.choice(i_train_stc[:cfg.data_static.num_train])
-            sel_r_stc = torch.randint(rgb_tr_stc.shape[1], [cfg_train.N_rand])
-            sel_c_stc = torch.randint(rgb_tr_stc.shape[2], [cfg_train.N_rand])
-            img_i_stc = torch.tensor(img_i_stc,device = device)
-            target_stc = rgb_tr_stc[img_i_stc, sel_r_stc, sel_c_stc]
-            rays_o_stc = rays_o_tr_stc[img_i_stc, sel_r_stc, sel_c_stc]
-            rays_d_stc = rays_d_tr_stc[img_i_stc, sel_r_stc, sel_c_stc]
-            viewdirs_stc = viewdirs_tr_stc[img_i_stc, sel_r_stc, sel_c_stc]
-            frame_time_stc = frame_times[0]
-
-        if cfg.data.load2gpu_on_the_fly:
-            target = target.to(device)
-            rays_o = rays_o.to(device)
-            rays_d = rays_d.to(device)
-            viewdirs = viewdirs.to(device)
-            frame_time = frame_time.to(device)
-            target_stc = target_stc.to(device)
-            rays_o_stc = rays_o_stc.to(device)
-            rays_d_stc = rays_d_stc.to(device)
-            viewdirs_stc = viewdirs_stc.to(device)
-            frame_time_stc = frame_time_stc.to(device)
+            target_stc, rays_o_stc, rays_d_stc, viewdirs_stc, _, _ = ray_sampler_stc.sample(global_step)
 
        
-        render_result = model(rays_o, rays_d, viewdirs, frame_time, img_i, global_step=global_step, start=(frame_time==0), **render_kwargs)
+        # the MLPs run in amp_dtype, their outputs and the rendering in fp32
+        with torch.autocast(device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+            if not cfg.data.ndc and cfg_train.fuse_static_forward:
+                # dynamic and static volume rendering in one pass
+                render_result, render_result_stc = model.forward_fused(
+                        rays_o, rays_d, viewdirs, frame_time, rays_o_stc, rays_d_stc, viewdirs_stc, img_i,
+                        global_step=global_step, start=(frame_time==0), **render_kwargs)
+            else:
+                render_result = model(rays_o, rays_d, viewdirs, frame_time, img_i, global_step=global_step, start=(frame_time==0), **render_kwargs)
 
-        # static volume rendering
-        if not cfg.data.ndc:
-            render_result_stc = model(rays_o_stc, rays_d_stc, viewdirs_stc, frame_time_stc, 0, global_step=global_step, start=True, stc_data=True, **render_kwargs)
+                # static volume rendering
+                if not cfg.data.ndc:
+                    render_result_stc = model(rays_o_stc, rays_d_stc, viewdirs_stc, frame_time_stc, 0, global_step=global_step, start=True, stc_data=True, **render_kwargs)
 
         # gradient descent step
         optimizer.zero_grad(set_to_none=True)
@@ -555,7 +536,8 @@ def scene_rep_reconstruction(args, cfg, cfg_model, cfg_train, data_dict, data_di
 
         loss += cfg.data_static.num_train / timesteps  * cfg_train.weight_static * loss_static
        
-        loss.backward()
+        scaler.scale(loss).backward()
+        scaler.unscale_(optimizer)  # before the total variation grads are added
 
         writer.add_scalar('train/loss', loss.item(), global_step)
         if not cfg.data.ndc:
@@ -569,7 +551,8 @@ def scene_rep_reconstruction(args, cfg, cfg_model, cfg_train, data_dict, data_di
                     cfg_train.weight_tv_density/len(rays_o), global_step<cfg_train.tv_dense_before)
          
 
-        optimizer.step()
+        scaler.step(optimizer)
+        scaler.update()
         psnr_lst.append(psnr.item())   
 
         # update lr
@@ -586,6 +569,19 @@ def scene_rep_reconstruction(args, cfg, cfg_model, cfg_train, data_dict, data_di
                        f'Loss: {loss.item():.9f} / PSNR: {np.mean(psnr_lst):5.2f} / '
                        f'Eps: {eps_time_str}')
             psnr_lst = []
+            if model.occupancy_grid is not None:
+                culled = model.occupancy_grid.culled_fraction()
+                writer.add_scalar('train/culled_fraction', culled, global_step)
+                tqdm.write(f'scene_rep_reconstruction ({stage}): occupancy grid culled {culled*100:5.2f}% of the samples')
+                model.occupancy_grid.reset_stats()
+            stall, make = ray_sampler.stats()
+            if ray_sampler_stc is not None:
+                stall, make = stall + ray_sampler_stc.stats()[0], make + ray_sampler_stc.stats()[1]
+                ray_sampler_stc.reset_stats()
+            writer.add_scalar('train/ray_sampler_stall', stall, global_step)
+            tqdm.write(f'scene_rep_reconstruction ({stage}): ray samplers stalled {stall*1000:.2f} ms per iter / '
+                       f'batches take {make*1000:.2f} ms to assemble')
+            ray_sampler.reset_stats()
 
         if (global_step+1)%args.i_weights==0:
             path = os.path.join(cfg.basedir, cfg.expname, f'{stage}_{global_step:06d}.tar')
@@ -599,6 +595,9 @@ def scene_rep_reconstruction(args, cfg, cfg_model, cfg_train, data_dict, data_di
             print(f'scene_rep_reconstruction ({stage}): saved checkpoints at', path)
             test(args, cfg, str(global_step), model, writer)
 
+    ray_sampler.close()
+    if ray_sampler_stc is not None:
+        ray_sampler_stc.close()
 
     if global_step != -1:
         torch.save({
@@ -707,58 +706,50 @@ def test(args, cfg, stage, model, writer):
                 'render_depth': True,
                 'num_slots':cfg.fine_model_and_render.max_instances,
                 'segmentation': False,
+                'segment_steps': cfg.fine_model_and_render.segment_steps,
             },
+            'async_writes': not args.sync_writes,
         }
 
     if args.render_train:
            
         testsavedir = os.path.join(cfg.basedir, cfg.expname, f'render_train_{stage}')
         os.makedirs(testsavedir, exist_ok=True)
-        rgbs, depths = render_viewpoints(
+        render_viewpoints(
                 render_poses=data_dict['poses'][data_dict['i_train']],
                 HW=data_dict['HW'][data_dict['i_train']],
                 Ks=data_dict['Ks'][data_dict['i_train']],
                 frame_times=data_dict['times'][data_dict['i_train']],
-                gt_imgs=[data_dict['images'][i].cpu().numpy() for i in data_dict['i_train']],
+                gt_imgs=[data_dict['images'][i].float().numpy() for i in data_dict['i_train']],
                 savedir=testsavedir,
                 bs=args.bs,
                 eval_ssim=args.eval_ssim, eval_lpips_alex=args.eval_lpips_alex, eval_lpips_vgg=args.eval_lpips_vgg,
                 **render_viewpoints_kwargs)
         
-        rgb_video = 'video.rgb.mp4'
-        depth_video = 'video.depth.mp4'
-        shape_video = 'video.shape.mp4'
-        imageio.mimwrite(os.path.join(testsavedir, rgb_video), utils.to8b(rgbs), fps=10, quality=8)
-        imageio.mimwrite(os.path.join(testsavedir, depth_video), utils.to8b(1 - depths / np.max(depths)), fps=10, quality=8)
     
 
     # render testset and eval
     if args.render_test:        
         testsavedir = os.path.join(cfg.basedir, cfg.expname, f'render_test_{stage}')
         os.makedirs(testsavedir, exist_ok=True)
-        rgbs, depths = render_viewpoints(
+        render_viewpoints(
                 render_poses=data_dict['poses'][data_dict['i_test']],
                 HW=data_dict['HW'][data_dict['i_test']],
                 Ks=data_dict['Ks'][data_dict['i_test']],
                 frame_times=data_dict['times'][data_dict['i_test']],
-                gt_imgs=[data_dict['images'][i].cpu().numpy() for i in data_dict['i_test']],
+                gt_imgs=[data_dict['images'][i].float().numpy() for i in data_dict['i_test']],
                 savedir=testsavedir,
                 bs=args.bs,
                 eval_ssim=args.eval_ssim, eval_lpips_alex=args.eval_lpips_alex, eval_lpips_vgg=args.eval_lpips_vgg,
                 writer=writer, gs=int(stage),
                 **render_viewpoints_kwargs)
 
-        rgb_video = 'video.rgb.mp4'
-        depth_video = 'video.depth.mp4'
-        shape_video = 'video.shape.mp4'
-        imageio.mimwrite(os.path.join(testsavedir, rgb_video), utils.to8b(rgbs), fps=10, quality=8)
-        imageio.mimwrite(os.path.join(testsavedir, depth_video), utils.to8b(1 - depths / np.max(depths)), fps=10, quality=8)
       
     # render video
     if args.render_video:
         testsavedir = os.path.join(cfg.basedir, cfg.expname, f'render_video_{stage}')
         os.makedirs(testsavedir, exist_ok=True)
-        rgbs, depths = render_viewpoints(
+        render_viewpoints(
                 render_poses=data_dict['render_poses'],
                 HW=data_dict['HW'][data_dict['i_test']][[0]].repeat(len(data_dict['render_poses']), 0),
                 Ks=data_dict['Ks'][data_dict['i_test']][[0]].repeat(len(data_dict['render_poses']), 0),
@@ -766,9 +757,8 @@ def test(args, cfg, stage, model, writer):
                 render_factor=args.render_video_factor,
                 bs=args.bs,
                 savedir=testsavedir,
+                fps=30,
                 **render_viewpoints_kwargs)
-        imageio.mimwrite(os.path.join(testsavedir, 'video.rgb.mp4'), utils.to8b(rgbs), fps=30, quality=8)
-        imageio.mimwrite(os.path.join(testsavedir, 'video.depth.mp4'), utils.to8b(1 - depths / np.max(depths)), fps=30, quality=8)
 
 
 
@@ -842,8 +832,10 @@ if __name__=='__main__':
                 'flip_y': cfg.data.flip_y,
                 'render_depth': True,
                 'num_slots':cfg.fine_model_and_render.max_instances,
-                'segmentation': args.eval_ari
+                'segmentation': args.eval_ari,
+                'segment_steps': cfg.fine_model_and_render.segment_steps,
             },
+            'async_writes': not args.sync_writes,
         }
 
     
@@ -879,6 +871,11 @@ if __name__=='__main__':
     
     mean_rgb = mean_rgb.cpu().numpy()
 
+    if args.dump_volumes:
+        path = os.path.join(cfg.basedir, cfg.expname, 'post_process_volumes.npz')
+        np.savez(path, density=model.density.detach().cpu().numpy(), act_shift=model.act_shift,
+                 dx=dx, rgb=mean_rgb, importance=imp)
+        print('post_process: volumes saved at', path)
     
     if args.per_slot:
         #per slot rendering
@@ -920,12 +917,12 @@ if __name__=='__main__':
             else:
                 testsavedir = os.path.join(cfg.basedir, cfg.expname, f'render_train_{ckpt_name}_slot{i}')
             os.makedirs(testsavedir, exist_ok=True)
-            rgbs, depths = render_viewpoints(
+            render_viewpoints(
                     render_poses=data_dict['poses'][data_dict['i_train']][:3],
                     HW=data_dict['HW'][data_dict['i_train']],
                     Ks=data_dict['Ks'][data_dict['i_train']],
                     frame_times=data_dict['times'][data_dict['i_train']],
-                    gt_imgs=[data_dict['images'][i].cpu().numpy() for i in data_dict['i_train']],
+                    gt_imgs=[data_dict['images'][i].float().numpy() for i in data_dict['i_train']],
                     savedir=testsavedir,
                     eval_ssim=args.eval_ssim, eval_lpips_alex=args.eval_lpips_alex, eval_lpips_vgg=args.eval_lpips_vgg,
                     slot_idx = i,
@@ -934,11 +931,6 @@ if __name__=='__main__':
                     stc_data=False,
                     **render_viewpoints_kwargs)
         
-            rgb_video = 'video.rgb.mp4'
-            depth_video = 'video.depth.mp4'
-            shape_video = 'video.shape.mp4'
-            imageio.mimwrite(os.path.join(testsavedir, rgb_video), utils.to8b(rgbs), fps=10, quality=8)
-            imageio.mimwrite(os.path.join(testsavedir, depth_video), utils.to8b(1 - depths / np.max(depths)), fps=10, quality=8)
         
 
 
@@ -950,12 +942,12 @@ if __name__=='__main__':
             else:
                 testsavedir = os.path.join(cfg.basedir, cfg.expname, f'render_test_{ckpt_name}_slot{i}')
             os.makedirs(testsavedir, exist_ok=True)
-            rgbs, depths = render_viewpoints(
+            render_viewpoints(
                     render_poses=data_dict['poses'][data_dict['i_test']][:3],
                     HW=data_dict['HW'][data_dict['i_test']],
                     Ks=data_dict['Ks'][data_dict['i_test']],
                     frame_times=data_dict['times'][data_dict['i_test']],
-                    gt_imgs=[data_dict['images'][i].cpu().numpy() for i in data_dict['i_test']],
+                    gt_imgs=[data_dict['images'][i].float().numpy() for i in data_dict['i_test']],
                     savedir=testsavedir,
                     eval_ssim=args.eval_ssim, eval_lpips_alex=args.eval_lpips_alex, eval_lpips_vgg=args.eval_lpips_vgg,
                     slot_idx = i,
@@ -965,18 +957,13 @@ if __name__=='__main__':
                     stc_data=False,
                     **render_viewpoints_kwargs)
 
-            rgb_video = 'video.rgb.mp4'
-            depth_video = 'video.depth.mp4'
-            shape_video = 'video.shape.mp4'
-            imageio.mimwrite(os.path.join(testsavedir, rgb_video), utils.to8b(rgbs), fps=10, quality=8)
-            imageio.mimwrite(os.path.join(testsavedir, depth_video), utils.to8b(1 - depths / np.max(depths)), fps=10, quality=8)
         
 
     # render video
     if args.render_video:
         testsavedir = os.path.join(cfg.basedir, cfg.expname, f'render_video_{ckpt_name}')
         os.makedirs(testsavedir, exist_ok=True)
-        rgbs, depths = render_viewpoints(
+        render_viewpoints(
                 render_poses=data_dict['render_poses'],
                 HW=data_dict['HW'][data_dict['i_test']][[0]].repeat(len(data_dict['render_poses']), 0),
                 Ks=data_dict['Ks'][data_dict['i_test']][[0]].repeat(len(data_dict['render_poses']), 0),
@@ -986,9 +973,8 @@ if __name__=='__main__':
                 stc_data=False,
                 #timesteps = cfg.fine_model_and_render.timesteps,
                 bs=args.bs,
+                fps=30,
                 **render_viewpoints_kwargs)
-        imageio.mimwrite(os.path.join(testsavedir, 'video.rgb.mp4'), utils.to8b(rgbs), fps=30, quality=8)
-        imageio.mimwrite(os.path.join(testsavedir, 'video.depth.mp4'), utils.to8b(1 - depths / np.max(depths)), fps=30, quality=8)
     
     print('Done')
 
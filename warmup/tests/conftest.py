@@ -0,0 +1,5 @@
+import os
+import sys
+
+# make the stage root importable as in `python run_full.py`
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
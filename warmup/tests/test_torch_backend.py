@@ -0,0 +1,131 @@
+'''Parity of lib/torch_backend.py with the custom CUDA extensions on random inputs.
+Skipped when CUDA or the extensions are unavailable.
+'''
+import pytest
+import torch
+
+from lib import cuda_ext, torch_backend
+
+
+def load_ext(name):
+    if not cuda_ext.cuda_available():
+        pytest.skip('CUDA toolkit not available')
+    try:
+        return cuda_ext.get_extension(name)
+    except Exception as e:
+        pytest.skip(f'{name} failed to build: {e}')
+
+
+@pytest.fixture(scope='module')
+def render_utils_cuda():
+    return load_ext('render_utils_cuda')
+
+
+@pytest.fixture(scope='module')
+def total_variation_cuda():
+    return load_ext('total_variation_cuda')
+
+
+@pytest.fixture(scope='module')
+def adam_upd_cuda():
+    return load_ext('adam_upd_cuda')
+
+
+def assert_all_close(a, b, rtol=1e-4, atol=1e-5):
+    assert len(a) == len(b)
+    for x, y in zip(a, b):
+        if x.dtype.is_floating_point:
+            torch.testing.assert_close(x, y, rtol=rtol, atol=atol)
+        else:
+            assert torch.equal(x, y)
+
+
+def random_rays(n_rays=256, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    rays_o = (torch.rand([n_rays, 3], generator=g) * 4 - 2).cuda()
+    rays_d = torch.randn([n_rays, 3], generator=g).cuda()
+    xyz_min = torch.tensor([-1., -1., -1.]).cuda()
+    xyz_max = torch.tensor([1., 1., 1.]).cuda()
+    return rays_o, rays_d, xyz_min, xyz_max
+
+
+def random_alpha(render_utils_cuda, seed=0):
+    rays_o, rays_d, xyz_min, xyz_max = random_rays(seed=seed)
+    _, _, ray_id, _, _, _, _ = render_utils_cuda.sample_pts_on_rays(
+            rays_o, rays_d, xyz_min, xyz_max, 0.2, 1e9, 0.05)
+    g = torch.Generator().manual_seed(seed)
+    density = (torch.randn([len(ray_id)], generator=g) * 4).cuda()
+    return density, ray_id, len(rays_o)
+
+
+def test_sample_pts_on_rays(render_utils_cuda):
+    rays_o, rays_d, xyz_min, xyz_max = random_rays()
+    args = (rays_o, rays_d, xyz_min, xyz_max, 0.2, 1e9, 0.05)
+    assert_all_close(torch_backend.sample_pts_on_rays(*args), render_utils_cuda.sample_pts_on_rays(*args))
+
+
+def test_maskcache_lookup(render_utils_cuda):
+    g = torch.Generator().manual_seed(0)
+    world = (torch.rand([20, 24, 28], generator=g) > 0.5).cuda()
+    xyz = (torch.rand([4096, 3], generator=g) * 2.4 - 1.2).cuda()
+    xyz2ijk_scale = torch.tensor([19., 23., 27.]).cuda() / 2
+    xyz2ijk_shift = xyz2ijk_scale  # xyz_min = -1
+    args = (world, xyz, xyz2ijk_scale, xyz2ijk_shift)
+    assert torch.equal(torch_backend.maskcache_lookup(*args), render_utils_cuda.maskcache_lookup(*args))
+
+
+def test_raw2alpha(render_utils_cuda):
+    density, _, _ = random_alpha(render_utils_cuda)
+    shift, interval = -4.0, 0.5
+    exp_d, alpha = torch_backend.raw2alpha(density, shift, interval)
+    assert_all_close([exp_d, alpha], render_utils_cuda.raw2alpha(density, shift, interval))
+    grad_back = torch.randn_like(alpha)
+    torch.testing.assert_close(
+            torch_backend.raw2alpha_backward(exp_d, grad_back, interval),
+            render_utils_cuda.raw2alpha_backward(exp_d, grad_back, interval),
+            rtol=1e-4, atol=1e-5)
+
+
+def test_alpha2weight(render_utils_cuda):
+    density, ray_id, n_rays = random_alpha(render_utils_cuda)
+    alpha = render_utils_cuda.raw2alpha(density, -4.0, 0.5)[1]
+    out = torch_backend.alpha2weight(alpha, ray_id, n_rays)
+    out_cuda = render_utils_cuda.alpha2weight(alpha, ray_id, n_rays)
+    assert_all_close(out, out_cuda)
+
+    weight, T, alphainv_last, i_start, i_end = out_cuda
+    grad_weights = torch.randn_like(weight)
+    grad_last = torch.randn_like(alphainv_last)
+    args = (alpha, weight, T, alphainv_last, i_start, i_end, n_rays, grad_weights, grad_last)
+    torch.testing.assert_close(
+            torch_backend.alpha2weight_backward(*args),
+            render_utils_cuda.alpha2weight_backward(*args),
+            rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize('dense_mode', [True, False])
+def test_total_variation_add_grad(total_variation_cuda, dense_mode):
+    g = torch.Generator().manual_seed(0)
+    param = torch.randn([1, 4, 10, 12, 14], generator=g).cuda()
+    grad = torch.randn_like(param) * (torch.rand_like(param) > 0.5)
+    grad_cuda = grad.clone()
+    torch_backend.total_variation_add_grad(param, grad, 1e-2, 2e-2, 3e-2, dense_mode)
+    total_variation_cuda.total_variation_add_grad(param, grad_cuda, 1e-2, 2e-2, 3e-2, dense_mode)
+    torch.testing.assert_close(grad, grad_cuda)
+
+
+@pytest.mark.parametrize('op', ['adam_upd', 'masked_adam_upd', 'adam_upd_with_perlr'])
+def test_adam_upd(adam_upd_cuda, op):
+    g = torch.Generator().manual_seed(0)
+    param = torch.randn([4, 32, 32], generator=g).cuda()
+    grad = torch.randn_like(param) * (torch.rand_like(param) > 0.3)
+    exp_avg = torch.randn_like(param) * 1e-2
+    exp_avg_sq = torch.rand_like(param) * 1e-2
+    state = [param, grad, exp_avg, exp_avg_sq]
+    if op == 'adam_upd_with_perlr':
+        state.append(torch.rand_like(param))
+    state_cuda = [t.clone() for t in state]
+    hyper = (3, 0.9, 0.99, 1e-2, 1e-8)
+    getattr(torch_backend, op)(*state, *hyper)
+    getattr(adam_upd_cuda, op)(*state_cuda, *hyper)
+    assert_all_close(state, state_cuda)